@@ -0,0 +1,305 @@
+import argparse
+import base64
+import collections
+import hashlib
+import hmac
+import ipaddress
+import io
+import json
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+import pandas as pd
+
+from psalmy import SharedDocumentStore, select_view, draw_pretty_sankey_final, save_png_within_budget
+from wykresy_pionowe import (
+    DEFAULT_MAPPINGS, COLORS_NUNS, parse_mapping_values,
+    compute_population_segments, draw_population_chart, stage_columns
+)
+from figury import figure_scope, figure_stats
+from zadania import RenderScheduler, PRIORITY_INTERACTIVE
+from metryki import REGISTRY, PARSE_SECONDS, start_exporter_from_env
+
+# ==========================================
+# LOKALNE API RENDEROWANIA WYKRESÓW
+# ==========================================
+# Uruchomienie: python api_wykresow.py [--host 127.0.0.1] [--port 8502]
+#
+#   POST /documents                 treść: plik .docx -> {"hash", "psalms"}
+#   GET  /documents/<hash>          -> {"hash", "psalms"}
+#   POST /workbooks                 treść: plik .xlsx -> {"hash", "sheets"}
+#   POST /render/psalm              JSON -> PNG (porównanie psalmu)
+#   POST /render/nuns               JSON -> PNG (stan populacji zakonnic)
+#   GET  /health                    -> {"status": "ok"}
+#   GET  /metrics                   -> metryki w formacie tekstowym Prometheusa
+#
+# Dokument/skoroszyt wskazuje się przez "document"/"workbook" (hash z uploadu)
+# albo wysyła w tym samym żądaniu jako "docx_base64"/"xlsx_base64".
+# Serwer mówi HTTP/1.1, więc klient może wysłać wiele żądań po jednym połączeniu.
+# API nie ma logowania aplikacji: domyślnie słucha tylko na loopback. Na innym adresie wymaga
+# RENDER_API_TOKEN (nagłówek "Authorization: Bearer <token>").
+# Raster PNG jest ograniczony do MAX_MEGAPIXELS - przy większym DPI rozdzielczość jest obniżana.
+
+API_HOST = os.environ.get("RENDER_API_HOST", "127.0.0.1")
+API_PORT = int(os.environ.get("RENDER_API_PORT", "8502"))
+DEFAULT_DPI = 200
+MIN_DPI = 50
+MAX_DPI = 450
+MAX_BODY_BYTES = 64 * 1024 * 1024
+MAX_MEGAPIXELS = int(os.environ.get("RENDER_API_MAX_MEGAPIXELS", "40"))
+API_TOKEN = os.environ.get("RENDER_API_TOKEN", "")
+
+# Parametry wyglądu, które klient może nadpisać w "style"
+PSALM_STYLE_KEYS = {
+    "colors", "link_color", "link_alpha", "ribbon_width_scale", "font_size", "wrap_chars",
+    "compact", "show_links", "show_stripe", "show_verse_nums", "show_ids",
+    "show_row_ids_left", "show_zebra", "show_diff", "badge_text_colors"
+}
+DEFAULT_PSALM_STYLE = {
+    "colors": ("#a6cee3", "#6BB72B", "#1f78b4"),
+    "link_color": "#2253BD",
+    "link_alpha": 0.18,
+    "ribbon_width_scale": 0.88,
+    "font_size": 10,
+    "wrap_chars": 46,
+    "badge_text_colors": ("#FFFFFF", "#FFFFFF", "#FFFFFF"),
+}
+DEFAULT_LABELS = ("Officium 1571", "Vulgata 1592", "Bellarmine 1611")
+
+
+class ApiError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+def requested_dpi(payload):
+    # Liczba całkowita > 0, przycięta do [MIN_DPI, MAX_DPI]; inna wartość to błąd klienta, nie 500
+    dpi = payload.get("dpi", DEFAULT_DPI)
+    if isinstance(dpi, float) and dpi.is_integer():
+        dpi = int(dpi)
+    if isinstance(dpi, bool) or not isinstance(dpi, int) or dpi <= 0:
+        raise ApiError(400, f"Niepoprawne dpi: {dpi!r} - podaj dodatnią liczbę całkowitą.")
+    return max(MIN_DPI, min(dpi, MAX_DPI))
+
+
+class WorkbookStore:
+    """Wgrane skoroszyty (surowe bajty) w LRU, pod skrótem zawartości."""
+
+    def __init__(self, max_workbooks=8):
+        self.max_workbooks = max_workbooks
+        self._workbooks = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def put(self, data):
+        digest = hashlib.sha256(data).hexdigest()
+        with self._lock:
+            self._workbooks[digest] = data
+            self._workbooks.move_to_end(digest)
+            while len(self._workbooks) > self.max_workbooks:
+                self._workbooks.popitem(last=False)
+        return digest
+
+    def get(self, digest):
+        with self._lock:
+            data = self._workbooks.get(digest)
+            if data is not None:
+                self._workbooks.move_to_end(digest)
+            return data
+
+
+class RenderApi:
+    def __init__(self, max_concurrent=2):
+        self.documents = SharedDocumentStore()
+        self.workbooks = WorkbookStore()
+        self.scheduler = RenderScheduler(max_concurrent=max_concurrent, reserved_interactive=0)
+        REGISTRY.function(
+            "filigran_render_slots", "Zajęte i oczekujące sloty renderowania.",
+            lambda: {(state,): n for state, n in self.scheduler.stats().items()},
+            labelnames=("state",)
+        )
+
+    # --- Dokumenty ---
+    def add_document(self, data):
+        digest = hashlib.sha256(data).hexdigest()
+        return digest, self.documents.get_or_parse(digest, data)
+
+    def resolve_document(self, payload):
+        if payload.get("docx_base64"):
+            return self.add_document(base64.b64decode(payload["docx_base64"]))[1]
+        digest = payload.get("document")
+        doc = self.documents.get(digest) if digest else None
+        if doc is None:
+            raise ApiError(404, "Nieznany dokument - wyślij go najpierw na /documents albo jako docx_base64.")
+        return doc
+
+    def resolve_workbook(self, payload):
+        if payload.get("xlsx_base64"):
+            return base64.b64decode(payload["xlsx_base64"])
+        data = self.workbooks.get(payload.get("workbook"))
+        if data is None:
+            raise ApiError(404, "Nieznany skoroszyt - wyślij go najpierw na /workbooks albo jako xlsx_base64.")
+        return data
+
+    # --- Renderowanie ---
+    def render_psalm(self, payload):
+        doc = self.resolve_document(payload)
+        psalm = payload.get("psalm")
+        if psalm not in doc:
+            raise ApiError(404, f"Brak psalmu: {psalm!r}")
+        unknown = set(payload.get("style", {})) - PSALM_STYLE_KEYS
+        if unknown:
+            raise ApiError(400, f"Nieznane parametry stylu: {', '.join(sorted(unknown))}")
+        style = dict(DEFAULT_PSALM_STYLE, **payload.get("style", {}))
+        dpi = requested_dpi(payload)
+
+        view_ids, blocks_view, id_to_index_view = select_view(doc[psalm], payload.get("ids") or None)
+        if not view_ids:
+            raise ApiError(404, "Brak wierszy dla podanych ID.")
+        with self.scheduler.slot("api-psalm", PRIORITY_INTERACTIVE), figure_scope():
+            fig = draw_pretty_sankey_final(
+                title=payload.get("title") or psalm,
+                sorted_ids=view_ids,
+                blocks=blocks_view,
+                id_to_index=id_to_index_view,
+                labels=tuple(payload.get("labels") or DEFAULT_LABELS),
+                show_header=payload.get("header", True),
+                **style
+            )
+            return self.png(fig, dpi)
+
+    def render_nuns(self, payload):
+        data = self.resolve_workbook(payload)
+        sheet = payload.get("sheet", 0)
+        with PARSE_SECONDS.time(format="xlsx"):
+            df = pd.read_excel(io.BytesIO(data), sheet_name=sheet)
+        columns = payload.get("columns") or stage_columns(df)
+        missing = [c for c in columns if c not in df.columns]
+        if missing:
+            raise ApiError(400, f"Brak kolumn: {', '.join(map(str, missing))}")
+
+        mapping_text = dict(DEFAULT_MAPPINGS, **payload.get("mappings", {}))
+        active = {loc: True for loc in COLORS_NUNS if loc != 'Deceased'}
+        active.update(payload.get("active", {}))
+        mappings = {loc: parse_mapping_values(mapping_text.get(loc, "")) if active.get(loc) else [] for loc in active}
+        dpi = requested_dpi(payload)
+
+        segments_data = compute_population_segments(df, columns, mappings, active)
+        if not segments_data:
+            raise ApiError(400, "Brak danych do wykresu.")
+        with self.scheduler.slot("api-nuns", PRIORITY_INTERACTIVE), figure_scope():
+            fig = draw_population_chart(
+                segments_data, payload.get("title") or f"Population Status: {sheet} Timeline", mappings, active,
+                show_values=payload.get("show_values", True), show_total=payload.get("show_total", True),
+                show_legend=payload.get("show_legend", True), legend_loc=payload.get("legend_loc", "upper right"),
+                custom_labels=payload.get("labels", {})
+            )
+            return self.png(fig, dpi)
+
+    @staticmethod
+    def png(fig, dpi):
+        # Ten sam budżet pikseli co eksport w aplikacji - duże DPI nie alokuje gigantycznego rastra
+        pages, _, _ = save_png_within_budget(fig, dpi, MAX_MEGAPIXELS * 1_000_000)
+        return pages[0]
+
+
+def make_handler(api):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"   # keep-alive: wiele żądań na jednym połączeniu
+
+        def _send(self, status, body, content_type):
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            if self.close_connection:
+                self.send_header("Connection", "close")
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _send_json(self, status, obj):
+            self._send(status, json.dumps(obj, ensure_ascii=False).encode("utf-8"), "application/json; charset=utf-8")
+
+        def _body(self):
+            length = int(self.headers.get("Content-Length") or 0)
+            if length > MAX_BODY_BYTES:
+                # Treść zostaje nieprzeczytana - połączenia nie da się użyć dla kolejnego żądania
+                self.close_connection = True
+                raise ApiError(413, "Za duże żądanie.")
+            return self.rfile.read(length)
+
+        def _json_body(self):
+            try:
+                return json.loads(self._body() or b"{}")
+            except ValueError:
+                raise ApiError(400, "Niepoprawny JSON.")
+
+        def _dispatch(self, method):
+            path = urlparse(self.path).path.rstrip("/")
+            try:
+                if API_TOKEN and not hmac.compare_digest(self.headers.get("Authorization", ""), f"Bearer {API_TOKEN}"):
+                    # Treść żądania nieprzeczytana - zamykamy połączenie
+                    self.close_connection = True
+                    raise ApiError(401, "Brak lub niepoprawny token API.")
+                if method == "GET" and path == "/health":
+                    return self._send_json(200, {"status": "ok", **api.scheduler.stats(), "figures": figure_stats()})
+                if method == "GET" and path == "/metrics":
+                    return self._send(200, REGISTRY.render().encode("utf-8"), "text/plain; version=0.0.4; charset=utf-8")
+                if method == "GET" and path.startswith("/documents/"):
+                    digest = path.split("/", 2)[2]
+                    doc = api.documents.get(digest)
+                    if doc is None:
+                        raise ApiError(404, "Nieznany dokument.")
+                    return self._send_json(200, {"hash": digest, "psalms": list(doc.keys())})
+                if method == "POST" and path == "/documents":
+                    digest, doc = api.add_document(self._body())
+                    return self._send_json(200, {"hash": digest, "psalms": list(doc.keys())})
+                if method == "POST" and path == "/workbooks":
+                    data = self._body()
+                    digest = api.workbooks.put(data)
+                    sheets = pd.ExcelFile(io.BytesIO(data)).sheet_names
+                    return self._send_json(200, {"hash": digest, "sheets": sheets})
+                if method == "POST" and path == "/render/psalm":
+                    return self._send(200, api.render_psalm(self._json_body()), "image/png")
+                if method == "POST" and path == "/render/nuns":
+                    return self._send(200, api.render_nuns(self._json_body()), "image/png")
+                raise ApiError(404, "Nieznany adres.")
+            except ApiError as e:
+                self._send_json(e.status, {"error": str(e)})
+            except Exception as e:
+                self._send_json(500, {"error": f"Błąd: {e}"})
+
+        def do_GET(self):
+            self._dispatch("GET")
+
+        def do_POST(self):
+            self._dispatch("POST")
+
+    return Handler
+
+
+def is_loopback(host):
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return host == "localhost"
+
+
+def serve(host=API_HOST, port=API_PORT, max_concurrent=2):
+    if not is_loopback(host) and not API_TOKEN:
+        raise SystemExit(f"API bez logowania nie może słuchać na {host} - ustaw RENDER_API_TOKEN albo użyj 127.0.0.1.")
+    server = ThreadingHTTPServer((host, port), make_handler(RenderApi(max_concurrent=max_concurrent)))
+    server.daemon_threads = True
+    start_exporter_from_env()
+    print(f"API wykresów nasłuchuje na http://{host}:{port}")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Lokalne API renderowania wykresów psalmów i zakonnic.")
+    parser.add_argument("--host", default=API_HOST)
+    parser.add_argument("--port", type=int, default=API_PORT)
+    parser.add_argument("--max-concurrent", type=int, default=int(os.environ.get("MAX_HEAVY_RENDERS", "2")))
+    args = parser.parse_args()
+    serve(args.host, args.port, args.max_concurrent)
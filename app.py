@@ -1,15 +1,16 @@
 import streamlit as st
-import pandas as pd
-import matplotlib.pyplot as plt
-import matplotlib.colors as mcolors
-import matplotlib.patches as mpatches
-import textwrap
 import io
 import os
 import zipfile
-import re
-from docx import Document
-import numpy as np
+import tempfile
+import collections
+import hashlib
+import functools
+import contextlib
+import importlib
+import threading
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
 
 # ==========================================
 # 1. KONFIGURACJA I STAŁE
@@ -18,6 +19,22 @@ st.set_page_config(page_title="Filigran", layout="wide")
 
 APP_PASSWORD = os.environ.get("APP_PASSWORD", "b12345")
 
+# pandas, matplotlib i python-docx importujemy dopiero po zalogowaniu - ekran logowania nie czeka na nie.
+# Z PRELOAD_MODULES=1 (domyślnie) wątek w tle ładuje je już wtedy, gdy ekran logowania czeka na hasło.
+PRELOAD_MODULES = os.environ.get("PRELOAD_MODULES", "1") == "1"
+HEAVY_MODULES = ("pandas", "matplotlib.backends.backend_pdf", "psalmy", "wykresy_pionowe", "wykresy", "raport", "tabela", "zadania")
+
+@st.cache_resource(show_spinner=False)
+def preload_modules():
+    def run():
+        for name in HEAVY_MODULES:
+            importlib.import_module(name)
+        importlib.import_module("psalmy").warm_font_cache()
+
+    thread = threading.Thread(target=run, name="preload", daemon=True)
+    thread.start()
+    return thread
+
 def check_password():
     if "authenticated" not in st.session_state:
         st.session_state.authenticated = False
@@ -32,452 +49,294 @@ def check_password():
                 st.error("Błędne hasło!")
         st.stop()
 
+if PRELOAD_MODULES:
+    preload_modules()
 check_password()
 
-def make_lighter(hex_color, alpha=0.3):
-    return mcolors.to_rgba(hex_color, alpha=alpha)
-
-COLORS_NUNS = {
-    'Gravelines': '#FFD700', 'London': '#B0C4DE', 'Gosfield': '#2ca02c',
-    'Rouen': '#1f77b4', 'Haggerston': '#ff7f0e', 'Scorton': '#d62728',
-    'Aire': '#e377c2', 'Britwell': '#eaffea', 'Plymouth': '#9467bd',
-    'Dunkirk': '#9ACD32', 'Worcester': '#17becf', 'Deceased': '#808080'
-}
+# Ciężkie importy - wykonują się dopiero po zalogowaniu (albo już czekają gotowe z preload_modules)
+import pandas as pd
+import matplotlib
+from matplotlib.backends.backend_pdf import PdfPages
+from psalmy import (
+    SharedDocumentStore, build_blocks, merge_components, paginate_components,
+    select_view, build_chart_plan, draw_pretty_sankey_final, render_plan_chart,
+    figure_to_png, save_png_within_budget, chart_content_hash, build_corpus, corpus_by_label, SankeyChartCache,
+    thumbnail_layout, render_thumbnails
+)
+from wykresy_pionowe import (
+    COLORS_NUNS, PRIORITY_ORDER, DEFAULT_MAPPINGS, parse_mapping_values,
+    cached_population_cube, draw_population_chart
+)
+from wykresy import (
+    TIMELINE_COLUMNS, TIMELINES_PER_PAGE, detect_timeline_columns, load_timeline_events,
+    layout_timelines, timeline_titles, timeline_x_limits, paginate_timelines, draw_timelines, export_timeline_pages
+)
+from figury import figure_scope, figure_stats
+from raport import write_chart_report
+from tabela import ALIGNMENT_FORMATS, export_alignment, parquet_available
+from zadania import ExportJob, RenderScheduler, STATUS_QUEUED, PRIORITY_BATCH, PRIORITY_INTERACTIVE, PRIORITY_SPECULATIVE
+from metryki import REGISTRY, PARSE_SECONDS, EXPORT_SECONDS, cache_lookup, start_exporter_from_env
 
 # ==========================================
 # 2. FUNKCJE POMOCNICZE
 # ==========================================
 
-def natural_sort_key(s):
-    return [int(t) if t.isdigit() else t.lower() for t in re.split(r"([0-9]+)", str(s))]
-
-def extract_ids_and_text(raw):
-    raw = (raw or "").strip().replace("\xa0", " ")
-    raw = re.sub(r"[ \t]+\n", "\n", raw)
-    
-    m = re.match(r"^\[([A-Za-z0-9,\s]+)\]\s*\.?\s*(.*)$", raw, flags=re.DOTALL)
-    if m:
-        ids = [i.strip() for i in m.group(1).split(",") if i.strip()]
-        txt = (m.group(2) or "").strip().lstrip(".").strip()
-        return ids, txt
-    
-    m = re.match(r"^([A-Z])\.\s*(.*)$", raw, flags=re.DOTALL)
-    if m:
-        return [m.group(1)], (m.group(2) or "").strip()
-        
-    return [], raw
-
-def split_marker(text):
-    t = (text or "").strip().lstrip(".").strip()
-    m = re.match(r"^(\d+)\.?\s+(.*)$", t, flags=re.DOTALL)
-    if m: return m.group(1), (m.group(2) or "").strip()
-    m = re.match(r"^([IVXLCDM]+)\.\s+(.*)$", t, flags=re.DOTALL)
-    if m: return m.group(1), (m.group(2) or "").strip()
-    return "", t
-
-@st.cache_data(show_spinner=False)
-def parse_docx_psalms_v2(file_bytes):
-    document = Document(io.BytesIO(file_bytes))
-    psalms_data = {}
-    
-    def psalm_from_header(text):
-        m = re.search(r"PSALM\s+(\d+)", text, flags=re.I)
-        return f"PSALM {m.group(1)}" if m else None
-
-    for table in document.tables:
-        try:
-            first_row_text = " ".join([c.text.strip() for c in table.rows[0].cells if c.text])
-            ps = psalm_from_header(first_row_text)
-        except:
-            continue
-        if not ps: continue
-
-        rows_data = []
-        for r_i, row in enumerate(table.rows[1:], start=1):
-            cells = row.cells
-            if len(cells) < 3: continue
-            
-            header_like = ("OFFICIUM" in (cells[0].text or "").upper() or "VULGATA" in (cells[1].text or "").upper())
-            if header_like: continue
-
-            row_items = {}
-            for idx, col_key in enumerate(["A", "B", "C"]):
-                raw = (cells[idx].text or "").strip()
-                ids, txt = extract_ids_and_text(raw)
-                marker, body = split_marker(txt)
-                row_items[col_key] = {
-                    "ids": ids,
-                    "marker": marker,
-                    "text": body,
-                    "raw": raw
-                }
-            rows_data.append(row_items)
-
-        if rows_data:
-            psalms_data[ps] = rows_data
-
-    return psalms_data
-
-def build_blocks(rows):
-    # Zbieramy ID w kolejności ich pierwszego wystąpienia w tabeli
-    ordered_ids = []
-    seen_ids = set()
-    for row in rows:
-        for col in ["A", "B", "C"]:
-            for uid in row[col]["ids"]:
-                if uid not in seen_ids:
-                    ordered_ids.append(uid)
-                    seen_ids.add(uid)
-
-    if not ordered_ids:
-        sorted_ids = [str(i) for i in range(1, len(rows) + 1)]
-        id_to_index = {uid: i for i, uid in enumerate(sorted_ids)}
-        blocks = {c: [] for c in ["A", "B", "C"]}
-        for i, row in enumerate(rows, start=1):
-            uid = str(i)
-            for c in ["A", "B", "C"]:
-                blocks[c].append({"ids": [uid], "marker": row[c]["marker"], "text": row[c]["text"]})
-        return sorted_ids, blocks, id_to_index
-
-    # Zachowujemy kolejność z tabeli, nie sortujemy alfabetycznie
-    sorted_ids = ordered_ids
-    id_to_index = {uid: i for i, uid in enumerate(sorted_ids)}
-
-    blocks = {c: [] for c in ["A", "B", "C"]}
-    seen = set()
-
-    for row in rows:
-        for c in ["A", "B", "C"]:
-            ids = row[c]["ids"]
-            if not ids: continue
-            txt = (row[c]["text"] or "").strip()
-            marker = (row[c]["marker"] or "").strip()
-            
-            sig = (c, tuple(ids), marker, txt)
-            if sig in seen: continue
-            seen.add(sig)
-            
-            blocks[c].append({"ids": ids, "marker": marker, "text": txt})
-
-    return sorted_ids, blocks, id_to_index
-
-def expand_ids_by_merges(target_ids, blocks):
-    target_ids = set(target_ids)
-    changed = True
-    while changed:
-        changed = False
-        for c in ["A", "B", "C"]:
-            for b in blocks[c]:
-                b_ids = set(b["ids"])
-                if b_ids & target_ids:
-                    new_set = target_ids | b_ids
-                    if len(new_set) != len(target_ids):
-                        target_ids = new_set
-                        changed = True
-    return target_ids
+@st.cache_resource
+def get_document_store():
+    return SharedDocumentStore()
+
+MAX_UPLOAD_DIGESTS = 64
+
+def upload_digest(uploaded_file):
+    # Skrót liczony raz na wgrany plik (file_id zmienia się tylko przy nowym uploadzie)
+    upload_key = getattr(uploaded_file, "file_id", None) or (uploaded_file.name, uploaded_file.size)
+    cached = st.session_state.setdefault("upload_digests", {})
+    if upload_key not in cached:
+        if len(cached) >= MAX_UPLOAD_DIGESTS:
+            cached.clear()
+        cached[upload_key] = hashlib.sha256(uploaded_file.getvalue()).hexdigest()
+    return cached[upload_key]
+
+# Ile plików korpusu parsuje się naraz (osobne procesy - parsowanie XML nie dzieli GIL)
+MAX_PARSE_WORKERS = int(os.environ.get("MAX_PARSE_WORKERS", str(os.cpu_count() or 2)))
+
+@st.cache_resource
+def get_parse_pool():
+    # Przy jednym rdzeniu procesy tylko dokładają kosztu - parsujemy wtedy w procesie aplikacji
+    if MAX_PARSE_WORKERS <= 1:
+        return None
+    # forkserver zamiast fork: proces Streamlit ma wiele wątków, których nie wolno kopiować;
+    # psalmy ładowane raz w serwerze, więc procesy robocze startują bez importów
+    context = multiprocessing.get_context("forkserver")
+    context.set_forkserver_preload(["psalmy"])
+    return ProcessPoolExecutor(max_workers=MAX_PARSE_WORKERS, mp_context=context)
+
+def load_corpus(uploads):
+    # Każdy plik to osobny dokument w magazynie (pod skrótem) - podmiana jednego pliku parsuje tylko jego
+    files = {}
+    for uploaded in uploads:
+        stem = os.path.splitext(uploaded.name)[0]
+        name, n = stem, 2
+        while name in files:
+            name, n = f"{stem} ({n})", n + 1
+        files[name] = uploaded
+    digests = {name: upload_digest(uploaded) for name, uploaded in files.items()}
+    corpus_key = tuple(digests.items())
+    if st.session_state.get("corpus_key") != corpus_key:
+        with st.spinner(f"Wczytuję korpus ({len(files)} plików)..."):
+            docs = get_document_store().get_or_parse_many(
+                {digests[name]: uploaded.getvalue() for name, uploaded in files.items()}, get_parse_pool()
+            )
+        st.session_state["corpus"] = build_corpus({name: docs[digests[name]] for name in files})
+        st.session_state["corpus_key"] = corpus_key
+    return st.session_state["corpus"]
+
+@st.cache_data(max_entries=8, show_spinner=False)
+def load_timeline_headers(digest, _data):
+    # Nagłówki wszystkich arkuszy (puste ramki) z jednego otwarcia pliku - nie przy każdym przebiegu skryptu
+    with PARSE_SECONDS.time(format="xlsx"):
+        return pd.read_excel(io.BytesIO(_data), sheet_name=None, nrows=0)
+
+@st.cache_data(max_entries=8, show_spinner=False)
+def load_timeline_layout(digest, _data, sheet, columns):
+    # Zdarzenia i układ pasków liczone raz na (plik, arkusz, wybór kolumn); _data nie jest hashowane
+    with PARSE_SECONDS.time(format="xlsx"):
+        df = pd.read_excel(io.BytesIO(_data), sheet_name=sheet)
+    events = layout_timelines(load_timeline_events(df, dict(columns)))
+    return events, timeline_titles(events), timeline_x_limits(events)
+
+# Kostki populacji zakonnic zapisywane na dysk - po restarcie aplikacji Excel nie jest czytany ponownie
+POPULATION_CUBE_DIR = os.environ.get("POPULATION_CUBE_DIR", os.path.join(tempfile.gettempdir(), "kostki_populacji"))
+
+@st.cache_data(max_entries=4, show_spinner=False)
+def load_population_cube(digests, _workbooks):
+    # Wszystkie arkusze wszystkich skoroszytów naraz; digests (nazwa, skrót) to klucz, _workbooks nie jest hashowane
+    return cached_population_cube(_workbooks, POPULATION_CUBE_DIR)
+
+@st.cache_data(max_entries=16, show_spinner=False)
+def load_sheet_preview(digest, _data, sheet):
+    return pd.read_excel(io.BytesIO(_data), sheet_name=sheet, nrows=10)
+
+# Ile gotowych wykresów (z artystami) trzyma proces - zmiana samych kolorów tylko je przemalowuje
+CHART_CACHE_SIZE = int(os.environ.get("CHART_CACHE_SIZE", "6"))
+
+@st.cache_resource
+def get_chart_cache():
+    return SankeyChartCache(max_charts=CHART_CACHE_SIZE)
+
+@st.cache_resource
+def get_render_executor():
+    # Wspólna dla procesu pula wątków do renderowania w tle (np. prefetch kolejnej strony)
+    return ThreadPoolExecutor(max_workers=2, thread_name_prefix="render")
+
+# Ile ciężkich renderów (eksporty, tryb filtra, pełne podglądy) może trwać naraz w całym procesie
+MAX_HEAVY_RENDERS = int(os.environ.get("MAX_HEAVY_RENDERS", "2"))
+
+@st.cache_resource
+def get_render_scheduler():
+    return RenderScheduler(max_concurrent=MAX_HEAVY_RENDERS)
+
+@st.cache_resource
+def start_metrics():
+    # Eksporter metryk (METRICS_PORT / METRICS_FILE) startuje raz na proces, a nie na sesję
+    scheduler = get_render_scheduler()
+    REGISTRY.function(
+        "filigran_render_slots", "Zajęte i oczekujące sloty renderowania.",
+        lambda: {(state,): n for state, n in scheduler.stats().items()},
+        labelnames=("state",)
+    )
+    return start_exporter_from_env()
+
+@contextlib.contextmanager
+def heavy_render_slot(kind, priority):
+    # Slot z kolejki procesu; w czasie czekania sesja widzi swoją pozycję w kolejce
+    placeholder = st.empty()
+
+    def on_wait(position):
+        placeholder.info(f"⏳ Serwer jest zajęty innymi wykresami - pozycja w kolejce: {position}")
+
+    with get_render_scheduler().slot(kind, priority, on_wait=on_wait):
+        placeholder.empty()
+        yield
+
+@st.fragment(run_every=1.0)
+def poll_export_job(job):
+    # Odświeżany co sekundę fragment postępu; po zakończeniu przeładowuje całą stronę
+    if not job.running:
+        st.rerun()
+    st.progress(job.progress)
+    if job.status == STATUS_QUEUED:
+        st.text(f"⏳ Eksport czeka na wolne moce serwera - pozycja w kolejce: {job.queue_position}")
+    else:
+        st.text(f"Generuję {job.done + 1}/{job.total}: {job.current_label}")
+    if st.button("⏹️ Anuluj eksport"):
+        job.cancel()
+
+@st.fragment(run_every=1.0)
+def poll_document_parse(parse):
+    # Dokument otwiera się w tle i pojawia się naraz (cała lista psalmów); koniec wczytywania przeładowuje stronę
+    if parse.done:
+        st.rerun()
+    st.info("⏳ Wczytuję dokument w tle. Etykiety i wygląd można ustawiać już teraz.")
+
+def show_export_job(job):
+    if job.running:
+        poll_export_job(job)
+    elif job.finished:
+        st.success(f"Gotowe! Wygenerowano {job.total} plików ({job.meta['legend_count']} z legendą).")
+        if job.reused:
+            st.caption(f"♻️ {job.reused} z {job.total} wykresów bez zmian - skopiowane z poprzedniego archiwum.")
+        if job.notes:
+            st.warning(f"Wykresy przekraczające budżet {job.meta['budget_megapixels']} MPix:\n\n" + "\n".join(f"- {line}" for line in job.notes))
+        st.download_button("📦 Pobierz archiwum ZIP", data=job.archive(), file_name=job.archive_name, mime="application/zip", on_click="ignore")
+    else:
+        reason = f": {job.error}" if job.error else ""
+        st.warning(f"Eksport {job.status}{reason} ({job.done}/{job.total} wykresów gotowych).")
+        if st.button("▶️ Wznów eksport"):
+            job.start()
+            st.rerun()
 
 # ==========================================
-# 3. SILNIK GRAFICZNY (FINALNY)
+# MINIATURY PSALMÓW
 # ==========================================
-def draw_pretty_sankey_final(
-    title,
-    sorted_ids,
-    blocks,
-    id_to_index,
-    colors,
-    labels,
-    show_links=True,
-    link_color="#BFC5D2",
-    link_alpha=0.3,
-    font_size=10,
-    wrap_chars=40,
-    compact=False,
-    show_stripe=True,
-    ribbon_width_scale=0.4,
-    show_verse_nums=True,
-    show_ids=True,
-    show_row_ids_left=True,    
-    show_zebra=True,
-    badge_text_colors=("#FFFFFF", "#FFFFFF", "#FFFFFF"),
-    show_header=True
-):
-    def wrap_text_content(text):
-        lines = []
-        for para in (text or "").split("\n"):
-            para = para.strip()
-            if not para: continue
-            lines.extend(textwrap.wrap(para, width=wrap_chars) or [""])
-        return "\n".join(lines) if lines else "—"
-    
-    # Parametry układu
-    LINE_HEIGHT = 0.16  
-    MIN_ROW_H = 1.2     
-    PADDING = 0.8       
-    GAP = 0.15 if compact else 0.22
-    
-    # 1. Obliczanie wysokości
-    slot_heights = {}
-    wrapped_cache = {}
-    
-    for uid in sorted_ids:
-        max_lines = 1
-        for c in ["A", "B", "C"]:
-            for b in blocks[c]:
-                if uid in b["ids"]:
-                    wrapped = wrap_text_content(b.get("text", ""))
-                    key = (c, tuple(b["ids"]))
-                    wrapped_cache[key] = wrapped
-                    num_lines = len(wrapped.split("\n"))
-                    lines_per_id = num_lines / max(1, len(b["ids"]))
-                    if lines_per_id > max_lines:
-                        max_lines = lines_per_id
-        
-        slot_heights[uid] = max(MIN_ROW_H, (max_lines * LINE_HEIGHT * font_size / 10) + PADDING)
-    
-    # 2. Pozycje Y
-    y_positions = {} 
-    current_y = 0
-    for uid in sorted_ids:
-        h = slot_heights[uid]
-        y_top = current_y
-        y_bottom = current_y - h
-        y_positions[uid] = (y_top, y_bottom)
-        current_y = y_bottom - GAP
-    
-    total_height = abs(current_y)
-    
-    id_usage_map = {c: {} for c in ["A", "B", "C"]}
-    for c in ["A", "B", "C"]:
-        for idx, b in enumerate(blocks[c]):
-            for uid in b["ids"]:
-                if uid not in id_usage_map[c]:
-                    id_usage_map[c][uid] = []
-                id_usage_map[c][uid].append(idx)
-    
-    # 3. Rysowanie
-    fig_h = max(6, total_height * 1.1)
-    fig, ax = plt.subplots(figsize=(18, fig_h))
-    ax.set_facecolor("white")
-
-    col_x = {"A": 0.0, "B": 1.55, "C": 3.10}
-    col_w = 1.30
-    stripe_w = 0.14 
-    
-    # Ustalanie marginesów na podstawie show_row_ids_left
-    x_min = -0.45 if show_row_ids_left else -0.10
-    x_max = 4.50
-
-    # Tło i ID wierszy (lewa strona)
-    for i, uid in enumerate(sorted_ids):
-        y_top, y_bottom = y_positions[uid]
-        h = y_top - y_bottom
-        y_center = (y_top + y_bottom) / 2
-        
-        if show_zebra and i % 2 == 0:
-            ax.add_patch(mpatches.Rectangle(
-                (x_min, y_bottom - 0.02), x_max - x_min, h + 0.04,
-                facecolor=mcolors.to_rgba("#111827", 0.03), edgecolor=None, zorder=0
-            ))
-        
-        # Oznaczenia wierszy (duże litery K, M...) tylko jeśli włączone
-        if show_row_ids_left:
-            ax.text(-0.15, y_center, uid,
-                    ha="right", va="center", fontsize=12, fontweight="bold", color="#111827")
-
-    # Nagłówki (opcjonalne)
-    if show_header:
-        center_x = col_x["B"] + col_w / 2
-        ax.text(center_x, 0.8, title, ha="center", va="center", fontsize=18, fontweight="bold", color="#111827")
-        for c, lab in zip(["A", "B", "C"], labels):
-            ax.text(col_x[c] + col_w / 2, 0.35, lab, ha="center", va="center", fontsize=12, fontweight="bold", color="#111827")
-
-    anchors = {c: {} for c in ["A", "B", "C"]}
-
-    def draw_card(c, block_idx, ids, marker, text):
-        indices = [id_to_index[i] for i in ids if i in id_to_index]
-        if not indices: return
-
-        valid_ids = [i for i in ids if i in y_positions]
-        if not valid_ids: return
-        
-        # Slicing Logic
-        first_id = valid_ids[0]
-        usage_list_top = id_usage_map[c].get(first_id, [])
-        y_global_top, y_global_bottom_top = y_positions[first_id]
-        
-        if len(usage_list_top) > 1:
-            usage_list_top.sort()
-            my_rank = usage_list_top.index(block_idx)
-            count = len(usage_list_top)
-            seg_h = (y_global_top - y_global_bottom_top) / count
-            card_y_top = y_global_top - (my_rank * seg_h)
-        else:
-            card_y_top = y_global_top
-
-        last_id = valid_ids[-1]
-        usage_list_bot = id_usage_map[c].get(last_id, [])
-        y_global_top_bot, y_global_bottom_bot = y_positions[last_id]
-        
-        if len(usage_list_bot) > 1:
-            usage_list_bot.sort()
-            my_rank = usage_list_bot.index(block_idx)
-            count = len(usage_list_bot)
-            seg_h = (y_global_top_bot - y_global_bottom_bot) / count
-            card_y_bottom = y_global_top_bot - ((my_rank + 1) * seg_h)
-        else:
-            card_y_bottom = y_global_bottom_bot
-
-        VISUAL_GAP = 0.06
-        draw_y_top = card_y_top - VISUAL_GAP
-        draw_y_bottom = card_y_bottom + VISUAL_GAP
-        h = draw_y_top - draw_y_bottom
-        
-        if h < 0.2:
-            mid = (draw_y_top + draw_y_bottom) / 2
-            h = 0.2
-            draw_y_top = mid + 0.1
-            draw_y_bottom = mid - 0.1
-
-        base = colors[["A", "B", "C"].index(c)]
-        badge_txt_color = badge_text_colors[["A", "B", "C"].index(c)]
-        x = col_x[c]
-
-        # Kształty
-        ax.add_patch(mpatches.FancyBboxPatch(
-            (x + 0.02, draw_y_bottom - 0.02), col_w, h,
-            boxstyle="round,pad=0.03,rounding_size=0.12",
-            linewidth=0, facecolor=(0, 0, 0, 0.08), zorder=2
-        ))
-        card_shape = mpatches.FancyBboxPatch(
-            (x, draw_y_bottom), col_w, h,
-            boxstyle="round,pad=0.03,rounding_size=0.12",
-            linewidth=0, facecolor="white", zorder=3
+THUMBNAIL_COLUMNS = 5
+THUMBNAIL_CHUNK = 10            # psalmów na jedną partię renderowania (i jedno zadanie w puli procesów)
+THUMBNAIL_CACHE_SIZE = 4000
+THUMBNAIL_PENDING = "pending"
+
+@st.cache_resource
+def get_thumbnail_cache():
+    # Miniatury wspólne dla procesu: (dokument, psalm, kolory) -> PNG, THUMBNAIL_PENDING albo wyjątek
+    return {"entries": collections.OrderedDict(), "lock": threading.Lock()}
+
+def render_thumbnail_batch(keys, psalms_dict, thumb_style, cache, scheduler, pool):
+    # W tle: partie po THUMBNAIL_CHUNK psalmów, przy wielu rdzeniach równolegle w puli procesów;
+    # każda gotowa partia od razu trafia do pamięci podręcznej (siatka uzupełnia się na bieżąco)
+    chunks = [keys[i:i + THUMBNAIL_CHUNK] for i in range(0, len(keys), THUMBNAIL_CHUNK)]
+    try:
+        with scheduler.slot("miniatury", PRIORITY_BATCH):
+            if pool is None:
+                done = ((chunk, render_thumbnails([thumbnail_layout(psalms_dict[key[1]]) for key in chunk], *thumb_style)) for chunk in chunks)
+            else:
+                futures = {
+                    pool.submit(render_thumbnails, [thumbnail_layout(psalms_dict[key[1]]) for key in chunk], *thumb_style): chunk
+                    for chunk in chunks
+                }
+                done = ((futures[future], future.result()) for future in as_completed(futures))
+            for chunk, images in done:
+                with cache["lock"]:
+                    for key, png in zip(chunk, images):
+                        cache["entries"][key] = png
+    except Exception as e:
+        with cache["lock"]:
+            for key in keys:
+                if cache["entries"].get(key) is THUMBNAIL_PENDING:
+                    cache["entries"][key] = e
+
+def request_thumbnails(document_key, psalms_dict, names, thumb_style):
+    """{psalm: PNG | THUMBNAIL_PENDING | wyjątek}; brakujące miniatury zleca jednym zadaniem w tle."""
+    cache = get_thumbnail_cache()
+    images = {}
+    missing = []
+    with cache["lock"]:
+        entries = cache["entries"]
+        for name in names:
+            key = (document_key, name, thumb_style)
+            cache_lookup("thumbnails", key in entries)
+            if key not in entries:
+                entries[key] = THUMBNAIL_PENDING
+                missing.append(key)
+            entries.move_to_end(key)
+            images[name] = entries[key]
+        # Najstarsze gotowe miniatury wypadają; zlecone zostają do końca zadania
+        for key in [k for k, v in entries.items() if v is not THUMBNAIL_PENDING][:max(0, len(entries) - THUMBNAIL_CACHE_SIZE)]:
+            del entries[key]
+    if missing:
+        get_render_executor().submit(
+            render_thumbnail_batch, missing, psalms_dict, thumb_style, cache, get_render_scheduler(), get_parse_pool()
         )
-        ax.add_patch(card_shape)
-
-        # Pasek
-        text_margin_left = 0.08
-        if show_stripe:
-            stripe = mpatches.Rectangle(
-                (x - 0.05, draw_y_bottom - 0.05), stripe_w + 0.05, h + 0.1,
-                facecolor=base, zorder=4
-            )
-            stripe.set_clip_path(card_shape)
-            ax.add_patch(stripe)
-            content_start_x = x + stripe_w + text_margin_left
-        else:
-            content_start_x = x + text_margin_left
-
-        id_label = ", ".join(ids)
-        
-        # Oblicz środek karty w pionie
-        card_center_y = (draw_y_top + draw_y_bottom) / 2
-        
-        # --- MARKER NA KOLOROWYM PASKU (wyśrodkowany) ---
-        if show_stripe and show_verse_nums and marker:
-            # Środek paska - lekko przesunięty w lewo od środka geometrycznego
-            stripe_center_x = x + stripe_w * 0.4
-            ax.text(
-                stripe_center_x, card_center_y, marker,
-                ha="center", va="center", fontsize=10, fontweight="bold", color=badge_txt_color,
-                zorder=5, rotation=0
-            )
-
-        # Ramka
-        ax.add_patch(mpatches.FancyBboxPatch(
-            (x, draw_y_bottom), col_w, h,
-            boxstyle="round,pad=0.03,rounding_size=0.12",
-            linewidth=1, edgecolor="#E5E7EB", facecolor="none", zorder=6
-        ))
-
-        # --- ID I TEKST ---
-        key = (c, tuple(ids))
-        body = wrapped_cache.get(key, wrap_text_content(text))
-        
-        if show_ids:
-            # ID wyświetlane nad wyśrodkowanym tekstem
-            # ID w lewym górnym rogu
-            ax.text(
-                content_start_x, draw_y_top - 0.08, id_label,
-                ha='left', va='top', 
-                fontsize=9, fontweight='bold', color=base,
-                zorder=5, fontfamily="DejaVu Serif"
-            )
-            # Tekst wyśrodkowany w pionie (przesunięty lekko w dół przez ID)
-            ax.text(
-                content_start_x, card_center_y, body,
-                ha='left', va='center', fontsize=font_size, color="#0B1220", 
-                zorder=5, fontfamily="DejaVu Serif", linespacing=1.35, clip_on=True
-            )
-        else:
-            # ID niewyświetlane - tekst wyśrodkowany w pionie
-            ax.text(
-                content_start_x, card_center_y, body,
-                ha='left', va='center', fontsize=font_size, color="#0B1220", 
-                zorder=5, fontfamily="DejaVu Serif", linespacing=1.35, clip_on=True
-            )
-
-        # Kotwice
-        block_ids_sorted = sorted([i for i in ids if i in id_to_index], key=lambda x: id_to_index[x])
-        if block_ids_sorted:
-            segment_height = h / len(block_ids_sorted)
-            for idx, uid in enumerate(block_ids_sorted):
-                seg_y_center = draw_y_top - (idx * segment_height) - (segment_height / 2)
-                
-                if uid not in anchors[c]: anchors[c][uid] = []
-                anchors[c][uid].append({
-                    "left": (x, seg_y_center), 
-                    "right": (x + col_w, seg_y_center), 
-                    "height": segment_height
-                })
-
-    for c in ["A", "B", "C"]:
-        for idx, b in enumerate(blocks[c]):
-            draw_card(c, idx, b["ids"], b.get("marker", ""), b.get("text", ""))
-
-    def draw_ribbon_sigmoid(n_src, n_dst, color, alpha):
-        x_src, y_src = n_src['right']
-        x_dst, y_dst = n_dst['left']
-        h_src = n_src.get('height', 0.5)
-        h_dst = n_dst.get('height', 0.5)
-        ribbon_h = min(h_src, h_dst) * ribbon_width_scale
-        x = np.linspace(x_src, x_dst, 150)
-        sigmoid = 1 / (1 + np.exp(-12 * (x - (x_src + x_dst) / 2) / (x_dst - x_src)))
-        y = y_src + (y_dst - y_src) * sigmoid
-        ax.fill_between(x, y - ribbon_h/2, y + ribbon_h/2, color=color, alpha=alpha, zorder=1, edgecolor=None)
-
-    if show_links:
-        for uid in sorted_ids:
-            if uid in anchors["A"] and uid in anchors["B"]:
-                for start in anchors["A"][uid]:
-                    for end in anchors["B"][uid]: draw_ribbon_sigmoid(start, end, link_color, link_alpha)
-            if uid in anchors["B"] and uid in anchors["C"]:
-                for start in anchors["B"][uid]:
-                    for end in anchors["C"][uid]: draw_ribbon_sigmoid(start, end, link_color, link_alpha)
-
-    ax.set_xlim(x_min, x_max)
-    ax.set_ylim(current_y - 0.5, 1.1)
-    ax.axis("off")
-    fig.tight_layout()
-    return fig
+    return images
+
+def open_psalm_preview(name):
+    # Kliknięcie miniatury: pełny podgląd wybranego psalmu
+    st.session_state["psalm_mode"] = "Pojedynczy Podgląd"
+    st.session_state["psalm_single"] = name
+
+def thumbnail_grid(names, images):
+    cols = st.columns(THUMBNAIL_COLUMNS)
+    for i, name in enumerate(names):
+        with cols[i % THUMBNAIL_COLUMNS]:
+            image = images.get(name)
+            if isinstance(image, bytes):
+                st.image(image, width="stretch")
+            elif isinstance(image, Exception):
+                st.caption(f"⚠️ {image}")
+            else:
+                st.caption("⏳ renderuję…")
+            st.button(name, key=f"thumb_open_{i}", on_click=open_psalm_preview, args=(name,), width="stretch")
+
+@st.fragment(run_every=1.0)
+def poll_thumbnails(document_key, psalms_dict, names, thumb_style):
+    # Siatka odświeżana co sekundę, dopóki są miniatury w drodze; potem zwykłe przeładowanie strony
+    images = request_thumbnails(document_key, psalms_dict, names, thumb_style)
+    if not any(image is THUMBNAIL_PENDING for image in images.values()):
+        st.rerun()
+    ready = sum(isinstance(image, bytes) for image in images.values())
+    st.progress(ready / max(1, len(names)), text=f"Miniatury: {ready}/{len(names)}")
+    thumbnail_grid(names, images)
 
 # ==========================================
 # ZAKŁADKI GŁÓWNE
 # ==========================================
+start_metrics()
 st.title("🗃️ Przybornik Badacza Źródeł")
-tab1, tab2 = st.tabs(["📊 Losy Zakonnic", "📜 Porównywarka Psalmów i inne figle"])
+tab1, tab2, tab3 = st.tabs(["📊 Losy Zakonnic", "📜 Porównywarka Psalmów i inne figle", "🧭 Osie czasu"])
 
 # ==========================================
 # ZMIENNE GLOBALNE DLA SIDEBARA
 # ==========================================
 # Wartości domyślne dla Zakonnic (zainicjalizowane tutaj, wypełnione w sidebar)
 mappings = {}
-defaults = {
-    'Gravelines': 'yes, y, yesg, g, yellow, yesy', 'London': 'yesn, london',
-    'Gosfield': 'yesz, gosfield', 'Scorton': 'yesc, s, scorton', 'Rouen': 'yesr',
-    'Haggerston': 'yesh', 'Aire': 'yesa', 'Britwell': 'yesb', 'Plymouth': 'yesp',
-    'Dunkirk': 'yesd', 'Worcester': 'yesw'
-}
 active_colors_selection = {}
 
 # Wartości domyślne dla Psalmów
@@ -494,6 +353,7 @@ show_markers = True
 show_ids = True
 show_row_ids_left = True
 show_zebra = True
+show_diff = False
 link_color = "#2253BD"
 link_opacity = 0.18
 ribbon_scale = 0.88
@@ -501,6 +361,13 @@ font_size = 10
 chars_per_line = 46
 compact = False
 EXPORT_DPI = 450
+REPORT_DPI = 200                # raport Word: obraz na szerokość strony A4 nie potrzebuje więcej
+PREVIEW_DPI = 200
+PREVIEW_CACHE_SIZE = 8
+export_megapixels = 120
+budget_strategy = "Obniż DPI"
+# Czcionki w PDF osadzane jako TrueType (tekst zaznaczalny, każda czcionka raz na dokument)
+matplotlib.rcParams["pdf.fonttype"] = 42
 
 # ==========================================
 # SIDEBAR - USTAWIENIA ZAKONNIC
@@ -518,8 +385,8 @@ with st.sidebar:
         active_colors_selection[location] = is_active
         if is_active:
             st.markdown(f"&nbsp;&nbsp;&nbsp;&nbsp;<span style='color:{color_hex}'>■</span> Wartości:", unsafe_allow_html=True)
-            val = st.text_input(f"Wartości dla {location}", value=defaults.get(location,''), key=f"inp_{location}", label_visibility="collapsed")
-            mappings[location] = [v.strip().lower() for v in val.split(',') if v.strip()]
+            val = st.text_input(f"Wartości dla {location}", value=DEFAULT_MAPPINGS.get(location,''), key=f"inp_{location}", label_visibility="collapsed")
+            mappings[location] = parse_mapping_values(val)
         else:
             mappings[location] = []
     
@@ -554,6 +421,7 @@ with st.sidebar:
     show_ids = st.checkbox("Pokaż ID wierszy (A, B...)", value=True, help="Wyświetla litery A, B w lewym górnym rogu kafelka.")
     show_row_ids_left = st.checkbox("Pokaż ID Wierszy (poza wykresem - Lewa)", value=True, help="Wyświetla duże litery identyfikacyjne (np. K, M) po lewej stronie całego wykresu.")
     show_zebra = st.checkbox("Pokaż Tło Wierszy (Zebra)", value=True, help="Wyświetla naprzemienne szare tło dla wierszy.")
+    show_diff = st.checkbox("Podświetl różnice słów", value=False, help="Porównuje słowa źródeł chronologicznie (1571 → 1592 → 1611): zielone - dodane względem poprzedniego wydania, żółte - zmienione, czerwone - usunięte w następnym.")
     
     st.subheader("Szczegóły Techniczne")
     link_color = st.color_picker("Kolor Wstęg", "#2253BD") 
@@ -563,6 +431,17 @@ with st.sidebar:
     chars_per_line = st.slider("Znaków w linii (Szerokość)", 20, 100, 46)
     compact = st.checkbox("Tryb Kompaktowy (Mniejsze odstępy)", value=False)
 
+    st.subheader("Eksport PNG")
+    export_megapixels = st.slider("Budżet pikseli na obraz (MPix)", 20, 400, 120, step=10, help=f"Maksymalny rozmiar pojedynczego rastra przy {EXPORT_DPI} DPI. Chroni pamięć kontenera przy bardzo długich psalmach.")
+    budget_strategy = st.radio("Gdy wykres przekracza budżet:", ["Obniż DPI", "Podziel na strony"], help="Podział następuje na granicach wierszy.")
+
+    fig_stats = figure_stats()
+    rss_info = f", pamięć procesu: {fig_stats['rss_bytes'] / 2**20:.0f} MB" if fig_stats["rss_bytes"] else ""
+    st.caption(f"Otwarte wykresy w procesie: {fig_stats['live']}/{fig_stats['max_live']} (szczyt {fig_stats['peak']}){rss_info}")
+    chart_cache_stats = get_chart_cache()
+    if chart_cache_stats.hits:
+        st.caption(f"Wykresy przemalowane bez ponownego układu: {chart_cache_stats.hits}/{chart_cache_stats.hits + chart_cache_stats.misses}")
+
 # ==========================================
 # TAB 1: ZAKONNICE (ROZBUDOWANA WERSJA)
 # ==========================================
@@ -570,32 +449,38 @@ with tab1:
     st.header("Generator Wykresów Losów Zakonnic")
     st.markdown("""
     Aplikacja pozwala wgrać plik Excel, wybrać arkusz, skonfigurować wygląd i wygenerować wykres.
+    Kilka arkuszy lub skoroszytów (klasztorów) można porównać na jednym wykresie.
     """)
 
     # --- Główna część ---
-    uploaded_file_nuns = st.file_uploader("Wybierz plik Excel (.xlsx)", type=['xlsx'], key="upl_nuns", label_visibility="visible")
+    uploaded_files_nuns = st.file_uploader(
+        "Wybierz pliki Excel (.xlsx)", type=['xlsx'], key="upl_nuns", label_visibility="visible", accept_multiple_files=True
+    )
 
-    if uploaded_file_nuns:
+    if uploaded_files_nuns:
         try:
-            xls = pd.ExcelFile(uploaded_file_nuns)
-            sheet_names = xls.sheet_names
+            uploads_nuns = {uploaded.name: uploaded for uploaded in uploaded_files_nuns}
+            nuns_digests = {name: upload_digest(uploaded) for name, uploaded in uploads_nuns.items()}
+            workbooks_nuns = {name: uploaded.getvalue() for name, uploaded in uploads_nuns.items()}
+            with st.spinner("Zliczam wszystkie arkusze..."):
+                cube = load_population_cube(tuple(nuns_digests.items()), workbooks_nuns)
             
             st.markdown("---")
             col1, col2 = st.columns([1, 2])
             
             with col1:
                 st.subheader("2. Wybór danych")
+                selected_workbook = cube.workbooks[0]
+                if len(cube.workbooks) > 1:
+                    selected_workbook = st.selectbox("Wybierz skoroszyt:", cube.workbooks, key="workbook_nuns")
+                sheet_names = [sheet for workbook, sheet in cube.present_sheets() if workbook == selected_workbook]
                 selected_sheet = st.selectbox("Wybierz arkusz z danymi:", sheet_names, key="sheet_nuns")
             
-            df = pd.read_excel(uploaded_file_nuns, sheet_name=selected_sheet)
-            
-            # Inteligentne wykrywanie kolumn danych
-            data_columns = df.columns.tolist()
-            start_idx = next((i for i, c in enumerate(data_columns) if "IMPRISONMENT" in str(c).upper()), 0)
-            data_columns = data_columns[start_idx:]
+            # Kolumny etapów (od IMPRISONMENT) - z kostki, bez czytania arkusza
+            data_columns = cube.sheet_stages(selected_workbook, selected_sheet)
             
             with st.expander(f"Podgląd danych: {selected_sheet}"):
-                st.dataframe(df.head(10))
+                st.dataframe(load_sheet_preview(nuns_digests[selected_workbook], workbooks_nuns[selected_workbook], selected_sheet))
             
             st.markdown("---")
             st.subheader("3. Personalizacja wykresu")
@@ -633,8 +518,7 @@ with tab1:
                 custom_labels = {}
                 cols = st.columns(3)
                 idx = 0
-                priority_order = ['Gravelines', 'London', 'Gosfield', 'Scorton', 'Rouen', 'Haggerston', 'Aire', 'Britwell', 'Plymouth', 'Dunkirk', 'Worcester']
-                visible_keys = [k for k in priority_order if active_colors_selection.get(k, False)] + ['Uncertain', 'Deceased']
+                visible_keys = [k for k in PRIORITY_ORDER if active_colors_selection.get(k, False)] + ['Uncertain', 'Deceased']
                 
                 for key in visible_keys:
                     with cols[idx % 3]:
@@ -651,112 +535,60 @@ with tab1:
             # Przycisk generowania
             if st.button("Generuj wykres", type="primary"):
                 
-                # Przetwarzanie danych
-                segments_data = []
-                
-                for col_name in selected_columns:
-                    series = df[col_name].astype(str).str.strip().str.lower()
-                    uncertain = series[series.isin(['x'])].count()
-                    deceased = series[series.isin(['z'])].count()
-                    
-                    # Określenie domyślnej kategorii dla kolumny
-                    default_cat = 'Gravelines'
-                    if "LONDON" in str(col_name).upper(): default_cat = 'London'
-                    elif "GOSFIELD" in str(col_name).upper(): default_cat = 'Gosfield'
-                    
-                    counts = {}
-                    for loc, vals in mappings.items():
-                        spec_vals = [v for v in vals if v not in ['yes', 'y']]
-                        counts[loc] = series[series.isin(spec_vals)].count()
-                    
-                    gen_count = series[series.isin(['yes', 'y'])].count()
-                    counts[default_cat] = counts.get(default_cat, 0) + gen_count
-                    
-                    bar_segments = []
-                    for loc in priority_order:
-                        if active_colors_selection.get(loc) and counts.get(loc, 0) > 0:
-                            bar_segments.append((counts[loc], COLORS_NUNS[loc], loc))
-                    
-                    if uncertain > 0:
-                        base = COLORS_NUNS.get(default_cat, COLORS_NUNS['Gravelines'])
-                        bar_segments.append((uncertain, make_lighter(base), "Uncertain"))
-                    if deceased > 0:
-                        bar_segments.append((deceased, COLORS_NUNS['Deceased'], "Deceased"))
-                        
-                    segments_data.append((str(col_name), bar_segments))
+                # Przetwarzanie danych - wycinek kostki z bieżącym mapowaniem skrótów
+                segments_data = cube.segments(selected_workbook, selected_sheet, mappings, active_colors_selection, stages=selected_columns)
                 
                 # Rysowanie wykresu
                 if segments_data:
-                    fig, ax = plt.subplots(figsize=(16, 9))
-                    y_labels = []
-                    
-                    for i, (lbl, segs) in enumerate(segments_data):
-                        y_labels.append(lbl)
-                        left = 0
-                        for val, col, key in segs:
-                            if val > 0:
-                                hatch = '////' if key == "Uncertain" else None
-                                ax.barh(i, val, left=left, color=col, edgecolor='black', height=0.6, hatch=hatch)
-                                
-                                # Kolor tekstu
-                                txt_col = 'white' if col in [COLORS_NUNS['Deceased'], COLORS_NUNS['Scorton'], COLORS_NUNS['Rouen'], COLORS_NUNS['Plymouth'], COLORS_NUNS['Worcester']] else 'black'
-                                
-                                if show_values and val >= 0.8:
-                                    center_x = left + val / 2
-                                    ax.text(center_x, i, str(int(val)), ha='center', va='center', fontsize=10, fontweight='bold', color=txt_col)
-                                
-                                left += val
-                        
-                        if show_total:
-                            total = sum([v for v,_,_ in segs])
-                            ax.text(left + 0.5, i, f"Total: {total}", ha='left', va='center', fontsize=11, fontweight='bold')
-                    
-                    ax.set_yticks(range(len(y_labels)))
-                    ax.set_yticklabels(y_labels, fontsize=10)
-                    ax.invert_yaxis()
-                    ax.set_xlabel("Liczba zakonnic", fontsize=12)
-                    ax.set_title(chart_title, fontsize=16, pad=20)
-                    
-                    # Legenda
-                    if show_legend:
-                        def get_label(key):
-                            user_lbl = custom_labels.get(key, "")
-                            if user_lbl.strip(): return user_lbl
-                            if key == 'Uncertain': return 'Uncertain (x)'
-                            if key == 'Deceased': return 'Deceased (z)'
-                            return f'Alive ({key})'
-                        
-                        patches_list = []
-                        active_locs = [loc for loc in priority_order if mappings.get(loc) and active_colors_selection.get(loc)]
-                        for loc in active_locs:
-                            patches_list.append(mpatches.Patch(facecolor=COLORS_NUNS[loc], edgecolor='black', label=get_label(loc)))
-                        
-                        patches_list.append(mpatches.Patch(facecolor='lightgray', hatch='////', edgecolor='black', label=get_label('Uncertain')))
-                        patches_list.append(mpatches.Patch(facecolor=COLORS_NUNS['Deceased'], edgecolor='black', label=get_label('Deceased')))
-                        
-                        ax.legend(handles=patches_list, loc=legend_loc, title="Legenda")
-                    
-                    ax.spines['right'].set_visible(False)
-                    ax.spines['top'].set_visible(False)
-                    ax.grid(axis='x', linestyle='--', alpha=0.5)
-                    plt.tight_layout()
-                    
-                    # Wyświetlenie
-                    st.pyplot(fig)
+                    with figure_scope():
+                        fig = draw_population_chart(
+                            segments_data, chart_title, mappings, active_colors_selection,
+                            show_values=show_values, show_total=show_total, show_legend=show_legend,
+                            legend_loc=legend_loc, custom_labels=custom_labels
+                        )
                     
-                    # Pobieranie
-                    img_buf = io.BytesIO()
-                    fig.savefig(img_buf, format='png', dpi=300, bbox_inches='tight')
-                    img_buf.seek(0)
+                        # Wyświetlenie
+                        st.pyplot(fig)
                     
-                    st.download_button(
-                        label="💾 Pobierz wykres (PNG)",
-                        data=img_buf,
-                        file_name=f"wykres_{selected_sheet}.png",
-                        mime="image/png"
-                    )
+                        # Pobieranie
+                        img_buf = io.BytesIO()
+                        fig.savefig(img_buf, format='png', dpi=300, bbox_inches='tight')
+                        img_buf.seek(0)
                     
-                    plt.close(fig)
+                        st.download_button(
+                            label="💾 Pobierz wykres (PNG)",
+                            data=img_buf,
+                            file_name=f"wykres_{selected_sheet}.png",
+                            mime="image/png"
+                        )
+
+            # --- Porównanie arkuszy (klasztorów) na jednym etapie ---
+            if len(cube.present_sheets()) > 1:
+                st.markdown("---")
+                st.subheader("4. Porównanie arkuszy")
+                st.caption("Jeden pasek na arkusz wszystkich wgranych plików - liczone z gotowych zliczeń, bez ponownego czytania Excela.")
+                compare_stage = st.selectbox("Etap do porównania:", cube.stages, key="compare_stage_nuns")
+                st.dataframe(cube.totals_table(mappings, compare_stage))
+
+                if st.button("Generuj wykres porównawczy", key="btn_compare_nuns"):
+                    compare_data = cube.compare_segments(compare_stage, mappings, active_colors_selection)
+                    with figure_scope():
+                        fig = draw_population_chart(
+                            compare_data, f"Population Status: {compare_stage}", mappings, active_colors_selection,
+                            show_values=show_values, show_total=show_total, show_legend=show_legend,
+                            legend_loc=legend_loc, custom_labels=custom_labels
+                        )
+                        st.pyplot(fig)
+
+                        img_buf = io.BytesIO()
+                        fig.savefig(img_buf, format='png', dpi=300, bbox_inches='tight')
+                        img_buf.seek(0)
+                        st.download_button(
+                            label="💾 Pobierz porównanie (PNG)",
+                            data=img_buf,
+                            file_name="porownanie_arkuszy.png",
+                            mime="image/png"
+                        )
                     
         except Exception as e:
             st.error(f"Wystąpił błąd podczas przetwarzania pliku: {e}")
@@ -774,39 +606,91 @@ with tab2:
     """)
 
     # --- Upload i Przetwarzanie ---
-    uploaded_docx = st.file_uploader("Wgraj plik Word (.docx)", type=['docx'], key="upl_docx_psalms_new")
+    corpus_mode = st.toggle("Tryb korpusu (wiele plików .docx)", key="corpus_mode", help="Każdy plik to osobne wydanie; psalmy z różnych plików są rozróżniane nazwą pliku.")
+    if corpus_mode:
+        uploaded_docx = st.file_uploader("Wgraj pliki Word (.docx)", type=['docx'], accept_multiple_files=True, key="upl_docx_corpus")
+    else:
+        uploaded_docx = st.file_uploader("Wgraj plik Word (.docx)", type=['docx'], key="upl_docx_psalms_new")
 
     if uploaded_docx:
-        st.info("Przetwarzam plik...")
         try:
-            psalms_dict = parse_docx_psalms_v2(uploaded_docx.getvalue())
-            if not psalms_dict:
+            docx_parse = None
+            if corpus_mode:
+                corpus = load_corpus(uploaded_docx)
+                psalms_dict = corpus_by_label(corpus)
+                document_key = st.session_state["corpus_key"]
+                st.caption(f"Korpus: {len(uploaded_docx)} plików, {len(corpus)} psalmów.")
+            else:
+                docx_digest = upload_digest(uploaded_docx)
+                document_key = docx_digest
+                psalms_dict = st.session_state.get("psalms_doc") if st.session_state.get("psalms_doc_digest") == docx_digest else None
+            if psalms_dict is None:
+                # Wczytanie i skan nagłówków tabel w tle; wiersze psalmu parsowane dopiero przy pierwszym użyciu
+                psalms_dict, docx_parse = get_document_store().get_or_start_parse(docx_digest, uploaded_docx.getvalue())
+                if docx_parse is None:
+                    st.session_state["psalms_doc"] = psalms_dict
+                    st.session_state["psalms_doc_digest"] = docx_digest
+                elif docx_parse.error is not None:
+                    raise docx_parse.error
+                else:
+                    psalms_dict = docx_parse.snapshot()
+                    poll_document_parse(docx_parse)
+            if not psalms_dict and docx_parse is None:
                 st.warning("Nie znaleziono danych w pliku.")
             else:
-                st.success(f"Znaleziono psalmów: {len(psalms_dict)}")
+                if docx_parse is None:
+                    st.success(f"Znaleziono psalmów: {len(psalms_dict)}")
                 
                 # --- HELPER PRZYGOTOWANIA DANYCH ---
                 def prepare_view(selected_psalm, selected_ids=None, filter_id=None):
                     rows = psalms_dict[selected_psalm]
-                    sorted_ids, blocks, id_to_index = build_blocks(rows)
-
                     if filter_id:
                         target = filter_id.strip()
-                        if target:
-                            expanded = expand_ids_by_merges({target}, blocks)
-                            view_ids = [i for i in sorted_ids if i in expanded]
-                            blocks_view = {c: [b for b in blocks[c] if set(b["ids"]) & expanded] for c in ["A", "B", "C"]}
-                        else:
-                            view_ids, blocks_view = sorted_ids, blocks
-                    elif selected_ids:
-                        expanded = expand_ids_by_merges(set(selected_ids), blocks)
-                        view_ids = [i for i in sorted_ids if i in expanded]
-                        blocks_view = {c: [b for b in blocks[c] if set(b["ids"]) & expanded] for c in ["A", "B", "C"]}
-                    else:
-                        view_ids, blocks_view = sorted_ids, blocks
+                        return select_view(rows, [target] if target else None)
+                    return select_view(rows, selected_ids)
+
+                def psalm_select(label, key):
+                    # Do końca wczytywania w tle lista jest pusta; pusty selectbox zapamiętałby pod kluczem None
+                    if not psalms_dict:
+                        st.caption("Psalmy pojawią się tutaj, gdy tylko zostaną wczytane.")
+                        return None
+                    return st.selectbox(label, list(psalms_dict.keys()), key=key)
+
+                # Parametry wyglądu wspólne dla wszystkich trybów
+                chart_style = dict(
+                    colors=(col_src1, col_src2, col_src3),
+                    link_color=link_color,
+                    link_alpha=link_opacity,
+                    ribbon_width_scale=ribbon_scale,
+                    font_size=font_size,
+                    wrap_chars=chars_per_line,
+                    compact=compact,
+                    show_links=show_links,
+                    show_stripe=show_stripe,
+                    show_verse_nums=show_markers,
+                    show_ids=show_ids,
+                    show_row_ids_left=show_row_ids_left,
+                    show_zebra=show_zebra,
+                    show_diff=show_diff,
+                    badge_text_colors=(col_txt1, col_txt2, col_txt3)
+                )
 
-                    id_to_index_view = {uid: i for i, uid in enumerate(view_ids)}
-                    return view_ids, blocks_view, id_to_index_view
+                def export_png_pages(fig):
+                    return save_png_within_budget(fig, EXPORT_DPI, export_megapixels * 1_000_000, split_pages=budget_strategy == "Podziel na strony")
+
+                def png_download_button(fig, file_stem):
+                    pages, used_dpi, applied = export_png_pages(fig)
+                    if applied == "dpi":
+                        st.info(f"Wykres przekracza budżet {export_megapixels} MPix - obniżono rozdzielczość eksportu do {used_dpi} DPI.")
+                    if len(pages) == 1:
+                        st.download_button("Pobierz PNG", data=pages[0], file_name=f"{file_stem}.png", mime="image/png")
+                        return
+                    st.info(f"Wykres przekracza budżet {export_megapixels} MPix - podzielono go na {len(pages)} stron(y) przy granicach wierszy.")
+                    pages_zip = io.BytesIO()
+                    with zipfile.ZipFile(pages_zip, "w", zipfile.ZIP_DEFLATED) as zf:
+                        for page_no, page in enumerate(pages, start=1):
+                            zf.writestr(f"{file_stem}_str{page_no}.png", page)
+                    st.download_button("Pobierz PNG (strony w ZIP)", data=pages_zip.getvalue(), file_name=f"{file_stem}_strony.zip", mime="application/zip")
 
                 # --- 3 TRYBY GENEROWANIA ---
                 if filter_input:
@@ -817,45 +701,49 @@ with tab2:
                     col_label_3 = "Bellarmine 1611"
                     custom_title_override = ""
 
-                    # Szukamy we wszystkich psalmach
-                    for p_name in psalms_dict.keys():
-                        view_ids, blocks_view, id_to_index_view = prepare_view(p_name, filter_id=filter_input)
-                        if view_ids:
-                            st.markdown(f"### {p_name} (Filtr: {filter_input})")
-                            final_title = custom_title_override if custom_title_override else f"{p_name} (Filtr: {filter_input})"
-                            fig = draw_pretty_sankey_final(
-                                title=final_title,
-                                sorted_ids=view_ids,
-                                blocks=blocks_view,
-                                id_to_index=id_to_index_view,
-                                colors=[col_src1, col_src2, col_src3],
-                                labels=(col_label_1, col_label_2, col_label_3),
-                                link_color=link_color,
-                                link_alpha=link_opacity,
-                                ribbon_width_scale=ribbon_scale,
-                                font_size=font_size,
-                                wrap_chars=chars_per_line,
-                                compact=compact,
-                                show_links=show_links,
-                                show_stripe=show_stripe,
-                                show_verse_nums=show_markers,
-                                show_ids=show_ids,
-                                show_row_ids_left=show_row_ids_left,
-                                show_zebra=show_zebra,
-                                badge_text_colors=(col_txt1, col_txt2, col_txt3)
-                            )
-                            st.pyplot(fig)
-                            plt.close(fig)
+                    # Szukamy we wszystkich psalmach (jedna figura używana ponownie)
+                    with heavy_render_slot("filtr", PRIORITY_INTERACTIVE), figure_scope():
+                        filter_fig = None
+                        for p_name in psalms_dict.keys():
+                            view_ids, blocks_view, id_to_index_view = prepare_view(p_name, filter_id=filter_input)
+                            if view_ids:
+                                st.markdown(f"### {p_name} (Filtr: {filter_input})")
+                                final_title = custom_title_override if custom_title_override else f"{p_name} (Filtr: {filter_input})"
+                                filter_fig = draw_pretty_sankey_final(
+                                    title=final_title,
+                                    sorted_ids=view_ids,
+                                    blocks=blocks_view,
+                                    id_to_index=id_to_index_view,
+                                    colors=[col_src1, col_src2, col_src3],
+                                    labels=(col_label_1, col_label_2, col_label_3),
+                                    link_color=link_color,
+                                    link_alpha=link_opacity,
+                                    ribbon_width_scale=ribbon_scale,
+                                    font_size=font_size,
+                                    wrap_chars=chars_per_line,
+                                    compact=compact,
+                                    show_links=show_links,
+                                    show_stripe=show_stripe,
+                                    show_verse_nums=show_markers,
+                                    show_ids=show_ids,
+                                    show_row_ids_left=show_row_ids_left,
+                                    show_zebra=show_zebra,
+                                    show_diff=show_diff,
+                                    badge_text_colors=(col_txt1, col_txt2, col_txt3),
+                                    fig=filter_fig
+                                )
+                                st.pyplot(filter_fig)
                 else:
                     st.markdown("### Wybierz tryb generowania")
                     mode = st.radio(
                         "Tryb:", 
-                        ["Pojedynczy Podgląd", "Wybrane wiersze - Podgląd", "Eksport do ZIP"], 
-                        horizontal=True
+                        ["Pojedynczy Podgląd", "Przegląd miniatur", "Wybrane wiersze - Podgląd", "Eksport do ZIP", "Eksport do PDF", "Eksport do Word", "Tabela danych"], 
+                        horizontal=True,
+                        key="psalm_mode"
                     )
 
                     if mode == "Pojedynczy Podgląd":
-                        selected_psalm = st.selectbox("Wybierz Psalm:", list(psalms_dict.keys()))
+                        selected_psalm = psalm_select("Wybierz Psalm:", "psalm_single")
                         
                         with st.expander("📝 Etykiety i Teksty", expanded=False):
                             custom_title_override = st.text_input("Nadpisz Tytuł", value="", key="t_single")
@@ -864,41 +752,124 @@ with tab2:
                             col_label_2 = c2.text_input("Kolumna 2", "Vulgata 1592", key="l2_single")
                             col_label_3 = c3.text_input("Kolumna 3", "Bellarmine 1611", key="l3_single")
 
-                        if selected_psalm:
-                            view_ids, blocks_view, id_to_index_view = prepare_view(selected_psalm)
-                            final_title = custom_title_override if custom_title_override else selected_psalm
-                            
-                            fig = draw_pretty_sankey_final(
-                                title=final_title,
-                                sorted_ids=view_ids,
-                                blocks=blocks_view,
-                                id_to_index=id_to_index_view,
-                                colors=[col_src1, col_src2, col_src3],
-                                labels=(col_label_1, col_label_2, col_label_3),
-                                link_color=link_color,
-                                link_alpha=link_opacity,
-                                ribbon_width_scale=ribbon_scale,
-                                font_size=font_size,
-                                wrap_chars=chars_per_line,
-                                compact=compact,
-                                show_links=show_links,
-                                show_stripe=show_stripe,
-                                show_verse_nums=show_markers,
-                                show_ids=show_ids,
-                                show_row_ids_left=show_row_ids_left,
-                                show_zebra=show_zebra,
-                                badge_text_colors=(col_txt1, col_txt2, col_txt3)
-                            )
-                            st.pyplot(fig)
-                            img_buf = io.BytesIO()
-                            fig.savefig(img_buf, format='png', dpi=EXPORT_DPI, bbox_inches='tight')
-                            img_buf.seek(0)
-                            st.download_button("Pobierz PNG", data=img_buf, file_name=f"{selected_psalm}.png", mime="image/png")
+                        rows_per_page = st.slider("Wierszy na stronę podglądu", 2, 60, 12, key="rows_per_page_single", help="Długie psalmy są dzielone na strony na granicach scaleń; rysowana jest tylko widoczna strona.")
+                        prefetch_adjacent = st.checkbox("Renderuj sąsiednie psalmy w tle", value=False, key="prefetch_adjacent_single", help="Poprzedni i następny psalm są przygotowywane w tle z bieżącym wyglądem, więc przejście do nich jest natychmiastowe. Zużywa wolne moce serwera.")
+
+                        def psalm_pages(psalm):
+                            sorted_ids, blocks, _ = build_blocks(psalms_dict[psalm])
+                            return paginate_components(merge_components(sorted_ids, blocks), rows_per_page)
+
+                        pages = psalm_pages(selected_psalm) if selected_psalm else []
+                        if selected_psalm and not pages:
+                            st.warning("Ten psalm nie zawiera wierszy danych.")
+                        if pages:
+                            page_no = 1
+                            if len(pages) > 1:
+                                page_no = st.number_input(f"Strona (z {len(pages)})", min_value=1, max_value=len(pages), value=1, step=1, key=f"page_single_{selected_psalm}")
+                            base_title = custom_title_override if custom_title_override else selected_psalm
+                            labels = (col_label_1, col_label_2, col_label_3)
+
+                            def page_title(psalm, page_list, n):
+                                title = custom_title_override if custom_title_override else psalm
+                                return title if len(page_list) == 1 else f"{title} (str. {n}/{len(page_list)})"
+
+                            scheduler = get_render_scheduler()
+                            chart_cache = get_chart_cache()
+
+                            def render_page_png(psalm, page_ids, title, priority):
+                                # Woła się też z wątku prefetch, więc bez st.* - tylko slot w kolejce procesu
+                                with scheduler.slot("podgląd", priority), figure_scope():
+                                    view_ids, blocks_view, id_to_index_view = prepare_view(psalm, selected_ids=page_ids)
+                                    build = functools.partial(
+                                        draw_pretty_sankey_final,
+                                        title=title,
+                                        sorted_ids=view_ids,
+                                        blocks=blocks_view,
+                                        id_to_index=id_to_index_view,
+                                        labels=labels
+                                    )
+                                    return chart_cache.png((document_key, psalm, tuple(view_ids), title, labels), chart_style, build, PREVIEW_DPI)
+
+                            # Sesyjna pamięć podręczna gotowych stron (PNG albo Future z renderowania w tle)
+                            preview_cache = st.session_state.setdefault("preview_cache", collections.OrderedDict())
+                            # Nowy dokument (nawet z tymi samymi nazwami psalmów i ID) - stare strony do wyrzucenia
+                            if st.session_state.get("preview_cache_document") != document_key:
+                                for entry in preview_cache.values():
+                                    if hasattr(entry, "cancel"):
+                                        entry.cancel()
+                                preview_cache.clear()
+                                st.session_state["preview_cache_document"] = document_key
+                            style_key = (labels, tuple(sorted(chart_style.items())))
+
+                            # Zmiana wyglądu unieważnia zaległe renderowania w tle - nie zajmują już kolejki
+                            for key, entry in list(preview_cache.items()):
+                                if key[-1] != style_key and hasattr(entry, "cancel") and not entry.done():
+                                    entry.cancel()
+                                    del preview_cache[key]
+
+                            def page_entry(psalm, page_list, n, background=False, priority=PRIORITY_INTERACTIVE):
+                                title = page_title(psalm, page_list, n)
+                                key = (document_key, psalm, tuple(page_list[n - 1]), title, style_key)
+                                cache_lookup("preview", key in preview_cache)
+                                if key not in preview_cache:
+                                    if background:
+                                        preview_cache[key] = get_render_executor().submit(render_page_png, psalm, page_list[n - 1], title, priority)
+                                    else:
+                                        preview_cache[key] = render_page_png(psalm, page_list[n - 1], title, priority)
+                                preview_cache.move_to_end(key)
+                                while len(preview_cache) > PREVIEW_CACHE_SIZE:
+                                    _, evicted = preview_cache.popitem(last=False)
+                                    if hasattr(evicted, "cancel"):
+                                        evicted.cancel()
+                                return key
+
+                            current_key = page_entry(selected_psalm, pages, page_no)
+                            entry = preview_cache[current_key]
+                            if hasattr(entry, "result"):
+                                entry = preview_cache[current_key] = entry.result()
+                            st.image(entry, width="stretch")
+
+                            # Renderowanie w tle rusza dopiero po wysłaniu obrazu - nie opóźnia bieżącej strony.
+                            # Następna strona - zanim użytkownik ją wybierze; spekulacyjnie, ustępuje renderom na żądanie
+                            if page_no < len(pages):
+                                page_entry(selected_psalm, pages, page_no + 1, background=True, priority=PRIORITY_SPECULATIVE)
+                            # Sąsiednie psalmy (najpierw następny) - z najniższym priorytetem w kolejce procesu
+                            if prefetch_adjacent:
+                                names = list(psalms_dict.keys())
+                                pos = names.index(selected_psalm)
+                                for neighbour in names[pos + 1:pos + 2] + names[max(0, pos - 1):pos]:
+                                    neighbour_pages = psalm_pages(neighbour)
+                                    if neighbour_pages:
+                                        page_entry(neighbour, neighbour_pages, 1, background=True, priority=PRIORITY_SPECULATIVE)
+                            preview_cache.move_to_end(current_key)
+
+                            # Eksport w pełnej rozdzielczości dopiero na żądanie - nie opóźnia podglądu
+                            if st.button("Przygotuj PNG całego psalmu", key="prepare_png_single"):
+                                with heavy_render_slot("podgląd", PRIORITY_INTERACTIVE), figure_scope():
+                                    view_ids, blocks_view, id_to_index_view = prepare_view(selected_psalm)
+                                    fig = draw_pretty_sankey_final(
+                                        title=base_title,
+                                        sorted_ids=view_ids,
+                                        blocks=blocks_view,
+                                        id_to_index=id_to_index_view,
+                                        labels=labels,
+                                        **chart_style
+                                    )
+                                    png_download_button(fig, selected_psalm)
+
+                    elif mode == "Przegląd miniatur":
+                        st.caption("Uproszczone miniatury wszystkich psalmów (karty i wstęgi, bez tekstu); scalone karty mają ciemną ramkę. Kliknij nazwę, aby otworzyć pełny podgląd.")
+                        thumb_names = list(psalms_dict.keys())
+                        thumb_style = ((col_src1, col_src2, col_src3), link_color, link_opacity)
+                        thumb_images = request_thumbnails(document_key, psalms_dict, thumb_names, thumb_style)
+                        if any(image is THUMBNAIL_PENDING for image in thumb_images.values()):
+                            poll_thumbnails(document_key, psalms_dict, thumb_names, thumb_style)
+                        else:
+                            thumbnail_grid(thumb_names, thumb_images)
 
                     elif mode == "Wybrane wiersze - Podgląd":
-                        selected_psalm_view = st.selectbox("Wybierz psalm:", list(psalms_dict.keys()))
-                        rows = psalms_dict[selected_psalm_view]
-                        sorted_ids_all, _, _ = build_blocks(rows)
+                        selected_psalm_view = psalm_select("Wybierz psalm:", "psalm_custom")
+                        sorted_ids_all = build_blocks(psalms_dict[selected_psalm_view])[0] if selected_psalm_view else []
                         selected_ids = st.multiselect("Wybierz wiersze do wyświetlenia:", sorted_ids_all, default=[])
                         
                         with st.expander("📝 Etykiety i Teksty", expanded=False):
@@ -909,43 +880,68 @@ with tab2:
                             col_label_3 = c3.text_input("Kolumna 3", "Bellarmine 1611", key="l3_custom")
 
                         if selected_psalm_view:
-                            view_ids, blocks_view, id_to_index_view = prepare_view(selected_psalm_view, selected_ids=selected_ids)
-                            suffix = f" (ID: {', '.join(selected_ids)})" if selected_ids else ""
-                            final_title = custom_title_override if custom_title_override else f"{selected_psalm_view}{suffix}"
+                            with heavy_render_slot("podgląd", PRIORITY_INTERACTIVE), figure_scope():
+                                view_ids, blocks_view, id_to_index_view = prepare_view(selected_psalm_view, selected_ids=selected_ids)
+                                suffix = f" (ID: {', '.join(selected_ids)})" if selected_ids else ""
+                                final_title = custom_title_override if custom_title_override else f"{selected_psalm_view}{suffix}"
                             
-                            fig = draw_pretty_sankey_final(
-                                title=final_title,
-                                sorted_ids=view_ids,
-                                blocks=blocks_view,
-                                id_to_index=id_to_index_view,
-                                colors=[col_src1, col_src2, col_src3],
-                                labels=(col_label_1, col_label_2, col_label_3),
-                                link_color=link_color,
-                                link_alpha=link_opacity,
-                                ribbon_width_scale=ribbon_scale,
-                                font_size=font_size,
-                                wrap_chars=chars_per_line,
-                                compact=compact,
-                                show_links=show_links,
-                                show_stripe=show_stripe,
-                                show_verse_nums=show_markers,
-                                show_ids=show_ids,
-                                show_row_ids_left=show_row_ids_left,
-                                show_zebra=show_zebra,
-                                badge_text_colors=(col_txt1, col_txt2, col_txt3)
-                            )
-                            st.pyplot(fig)
-                            
-                            img_buf = io.BytesIO()
-                            fig.savefig(img_buf, format='png', dpi=EXPORT_DPI, bbox_inches='tight')
-                            img_buf.seek(0)
-                            st.download_button("Pobierz PNG", data=img_buf, file_name=f"{selected_psalm_view}_custom.png", mime="image/png")
-                            
-                            plt.close(fig)
+                                view_labels = (col_label_1, col_label_2, col_label_3)
+                                build = functools.partial(
+                                    draw_pretty_sankey_final,
+                                    title=final_title,
+                                    sorted_ids=view_ids,
+                                    blocks=blocks_view,
+                                    id_to_index=id_to_index_view,
+                                    labels=view_labels
+                                )
+                                view_key = (document_key, selected_psalm_view, tuple(view_ids), final_title, view_labels)
+                                with get_chart_cache().chart(view_key, chart_style, build) as fig:
+                                    st.pyplot(fig)
+                                    png_download_button(fig, f"{selected_psalm_view}_custom")
+
+                    elif mode == "Tabela danych":
+                        st.markdown("### Eksport tabeli dopasowania (CSV / Parquet)")
+                        st.caption("Każda komórka każdego psalmu: psalm, wiersz, kolumna, ID, marker, tekst i grupa scalonych ID. "
+                                   "Plik jest zapisywany partiami, bez budowania całej tabeli w pamięci.")
+                        if docx_parse is not None:
+                            st.caption("Eksport będzie dostępny po wczytaniu całego dokumentu.")
+                        else:
+                            table_formats = ["parquet", "csv"] if parquet_available() else ["csv"]
+                            table_format = st.radio("Format", table_formats, horizontal=True, key="table_format",
+                                                    format_func=lambda f: {"parquet": "Parquet", "csv": "CSV"}[f])
+                            if not parquet_available():
+                                st.caption("Parquet wymaga pakietu pyarrow - dostępny jest CSV.")
+                            if st.button("Generuj tabelę"):
+                                status_text = st.empty()
+                                # W korpusie klucz (plik, psalm) wypełnia kolumnę document
+                                table_source = corpus.items() if corpus_mode else psalms_dict.items()
+                                with tempfile.NamedTemporaryFile(suffix=f".{table_format}") as table_file:
+                                    total_rows = export_alignment(
+                                        table_source, table_file, table_format,
+                                        document="" if corpus_mode else uploaded_docx.name,
+                                        on_batch=lambda n: status_text.text(f"Zapisano {n} wierszy...")
+                                    )
+                                    table_file.seek(0)
+                                    table_bytes = table_file.read()
+                                status_text.text("")
+                                st.success(f"Gotowe! Tabela ma {total_rows} wierszy.")
+                                st.download_button(f"📥 Pobierz tabelę ({table_format.upper()})", data=table_bytes,
+                                                   file_name=f"psalmy_tabela.{table_format}", mime=ALIGNMENT_FORMATS[table_format])
 
                     else:
-                        st.markdown("### Eksport wykresów do archiwum ZIP")
-                        selected_psalms_zip = st.multiselect("Wybierz psalmy do eksportu:", list(psalms_dict.keys()), default=list(psalms_dict.keys()))
+                        export_pdf = mode == "Eksport do PDF"
+                        export_docx = mode == "Eksport do Word"
+                        if export_pdf:
+                            st.markdown("### Eksport wykresów do wielostronicowego PDF")
+                        elif export_docx:
+                            st.markdown("### Eksport wykresów do raportu Word (.docx)")
+                        else:
+                            st.markdown("### Eksport wykresów do archiwum ZIP")
+                        if docx_parse is not None:
+                            st.caption("Wybór psalmów i eksport będą dostępne po wczytaniu całego dokumentu.")
+                            selected_psalms_zip = list(psalms_dict.keys())
+                        else:
+                            selected_psalms_zip = st.multiselect("Wybierz psalmy do eksportu:", list(psalms_dict.keys()), default=list(psalms_dict.keys()))
                         
                         with st.expander("📝 Etykiety i tytuły", expanded=False):
                             custom_title_override = st.text_input("Nadpisz tytuł (zostaw puste dla domyślnego)", value="", key="t_zip")
@@ -962,29 +958,13 @@ with tab2:
                             legend_mode = st.radio(
                                 "Tryb legendy:",
                                 ["Wszystkie z legendą", "Tylko pierwszy wykres każdego psalmu", "Wybierz ręcznie"],
-                                key="legend_mode_zip"
+                                # W raporcie Word wykresy psalmu stoją jeden pod drugim - domyślnie legenda tylko na pierwszym
+                                index=1 if export_docx else 0,
+                                key="legend_mode_docx" if export_docx else "legend_mode_zip"
                             )
                             
                             # Wygeneruj listę wszystkich wykresów do wyboru
-                            all_charts_info = []
-                            for p_name in selected_psalms_zip:
-                                rows = psalms_dict[p_name]
-                                sorted_ids_temp, blocks_temp, _ = build_blocks(rows)
-                                processed_temp = set()
-                                chart_idx = 0
-                                for uid in sorted_ids_temp:
-                                    if uid not in processed_temp:
-                                        target_set = expand_ids_by_merges([uid], blocks_temp)
-                                        for v_id in target_set:
-                                            processed_temp.add(v_id)
-                                        ids_str = "-".join(sorted(target_set, key=lambda x: sorted_ids_temp.index(x) if x in sorted_ids_temp else 999))
-                                        all_charts_info.append({
-                                            "psalm": p_name,
-                                            "ids": ids_str,
-                                            "label": f"{p_name} ({ids_str})",
-                                            "is_first": chart_idx == 0
-                                        })
-                                        chart_idx += 1
+                            all_charts_info = build_chart_plan(psalms_dict, selected_psalms_zip)
                             
                             # Określ które wykresy mają legendę
                             charts_with_legend = set()
@@ -1004,75 +984,200 @@ with tab2:
                                     )
                                     charts_with_legend = set(selected_legend_charts)
 
-                        if st.button("Generuj archiwum ZIP"):
+                        export_labels = (col_label_1, col_label_2, col_label_3)
+                        export_title = custom_title_override
+
+                        def render_export_chart(chart, fig=None):
+                            return render_plan_chart(psalms_dict, chart, export_title, export_labels, chart_style, charts_with_legend, fig=fig)
+
+                        total_files = len(all_charts_info)
+                        charts_with_legend_count = sum(1 for c in all_charts_info if c["label"] in charts_with_legend)
+
+                        if mode == "Eksport do ZIP":
+                            previous_zip = st.file_uploader(
+                                "Poprzednie archiwum ZIP (opcjonalnie)", type=["zip"], key="upl_prev_zip",
+                                help="Wykresy, które się nie zmieniły od tamtego eksportu, zostaną z niego skopiowane zamiast rysowane od nowa."
+                            )
+                            # Eksport działa w tle jako zadanie sesji - zmiana widżetów go nie przerywa
+                            job = st.session_state.get("export_job")
+                            if st.button("Generuj archiwum ZIP", disabled=docx_parse is not None or (job is not None and job.running)):
+                                # Migawka parametrów: zadanie nie widzi późniejszych zmian w panelu
+                                plan_args = dict(
+                                    title_override=export_title, labels=export_labels,
+                                    style=dict(chart_style), charts_with_legend=frozenset(charts_with_legend)
+                                )
+                                export_args = dict(
+                                    dpi=EXPORT_DPI, max_pixels=export_megapixels * 1_000_000,
+                                    split_pages=budget_strategy == "Podziel na strony"
+                                )
+                                job = ExportJob(
+                                    all_charts_info,
+                                    functools.partial(render_plan_chart, psalms_dict, **plan_args),
+                                    functools.partial(save_png_within_budget, **export_args),
+                                    meta={"legend_count": charts_with_legend_count, "budget_megapixels": export_megapixels},
+                                    scheduler=get_render_scheduler(),
+                                    chart_hash=functools.partial(chart_content_hash, psalms_dict, **plan_args, export=export_args),
+                                    previous_archive=previous_zip.getvalue() if previous_zip else None
+                                )
+                                st.session_state["export_job"] = job
+                                job.start()
+
+                            if job is not None:
+                                show_export_job(job)
+
+                        if export_pdf and st.button("Generuj dokument PDF", disabled=docx_parse is not None):
                             progress_bar = st.progress(0)
                             status_text = st.empty()
-                            zip_buffer = io.BytesIO()
                             
-                            # Najpierw policz wszystkie pliki do wygenerowania
-                            total_files = len(all_charts_info)
-                            
-                            with zipfile.ZipFile(zip_buffer, "a", zipfile.ZIP_DEFLATED, False) as zf:
-                                current_file = 0
-                                
-                                for p_name in selected_psalms_zip:
-                                    rows = psalms_dict[p_name]
-                                    sorted_ids, blocks, _ = build_blocks(rows)
-                                    processed_ids = set()
-                                    
-                                    for uid in sorted_ids:
-                                        if uid in processed_ids:
-                                            continue
-                                            
-                                        view_ids, blocks_view, id_to_index_view = prepare_view(p_name, selected_ids=[uid])
-                                        for v_id in view_ids:
-                                            processed_ids.add(v_id)
-                                            
-                                        ids_str = "-".join(view_ids)
-                                        file_name = f"{p_name}_{ids_str}.png"
-                                        chart_title = custom_title_override if custom_title_override else f"{p_name} (ID: {', '.join(view_ids)})"
-                                        
-                                        # Sprawdź czy ten wykres ma mieć legendę
-                                        chart_label = f"{p_name} ({ids_str})"
-                                        has_legend = chart_label in charts_with_legend
-                                        
-                                        current_file += 1
-                                        progress_bar.progress(current_file / total_files)
-                                        legend_info = "z legendą" if has_legend else "bez legendy"
-                                        status_text.text(f"Generuję {current_file}/{total_files}: {file_name} ({legend_info})")
-                                        
-                                        fig = draw_pretty_sankey_final(
-                                            title=chart_title,
-                                            sorted_ids=view_ids,
-                                            blocks=blocks_view,
-                                            id_to_index=id_to_index_view,
-                                            colors=[col_src1, col_src2, col_src3],
-                                            labels=(col_label_1, col_label_2, col_label_3),
-                                            link_color=link_color,
-                                            link_alpha=link_opacity,
-                                            ribbon_width_scale=ribbon_scale,
-                                            font_size=font_size,
-                                            wrap_chars=chars_per_line,
-                                            compact=compact,
-                                            show_links=show_links,
-                                            show_stripe=show_stripe,
-                                            show_verse_nums=show_markers,
-                                            show_ids=show_ids,
-                                            show_row_ids_left=show_row_ids_left,
-                                            show_zebra=show_zebra,
-                                            badge_text_colors=(col_txt1, col_txt2, col_txt3),
-                                            show_header=has_legend
-                                        )
-                                        
-                                        img_buffer = io.BytesIO()
-                                        fig.savefig(img_buffer, format="png", dpi=EXPORT_DPI, bbox_inches='tight')
-                                        plt.close(fig)
-                                        zf.writestr(file_name, img_buffer.getvalue())
+                            # Strony trafiają na dysk od razu po narysowaniu; w pamięci jest tylko jedna figura
+                            with heavy_render_slot("pdf", PRIORITY_BATCH), tempfile.NamedTemporaryFile(suffix=".pdf") as pdf_file:
+                                with PdfPages(pdf_file) as pdf, figure_scope(), EXPORT_SECONDS.time(chart="psalm", format="pdf"):
+                                    export_fig = None
+                                    for current_page, chart in enumerate(all_charts_info, start=1):
+                                        progress_bar.progress(current_page / total_files)
+                                        status_text.text(f"Generuję stronę {current_page}/{total_files}: {chart['label']}")
+                                        export_fig = render_export_chart(chart, fig=export_fig)
+                                        pdf.savefig(export_fig, bbox_inches='tight')
+                                pdf_file.seek(0)
+                                pdf_bytes = pdf_file.read()
                             
                             status_text.text("")
-                            charts_with_legend_count = sum(1 for c in all_charts_info if c["label"] in charts_with_legend)
-                            st.success(f"Gotowe! Wygenerowano {total_files} plików ({charts_with_legend_count} z legendą).")
-                            st.download_button("📦 Pobierz archiwum ZIP", data=zip_buffer.getvalue(), file_name="psalmy_wykresy.zip", mime="application/zip")
+                            st.success(f"Gotowe! Wygenerowano {total_files} stron ({charts_with_legend_count} z legendą).")
+                            st.download_button("📄 Pobierz dokument PDF", data=pdf_bytes, file_name="psalmy_wykresy.pdf", mime="application/pdf")
+
+                        if export_docx and st.button("Generuj raport Word", disabled=docx_parse is not None):
+                            progress_bar = st.progress(0)
+                            status_text = st.empty()
+
+                            def report_progress(i, chart):
+                                progress_bar.progress((i + 1) / total_files)
+                                status_text.text(f"Generuję wykres {i + 1}/{total_files}: {chart['label']}")
+
+                            # Obrazy trafiają do pliku od razu po wyrenderowaniu; wysokie wykresy dzielone na strony przy granicach wierszy
+                            with heavy_render_slot("docx", PRIORITY_BATCH), figure_scope(), tempfile.NamedTemporaryFile(suffix=".docx") as report_file:
+                                images_added, images_stored = write_chart_report(
+                                    all_charts_info, render_export_chart,
+                                    functools.partial(save_png_within_budget, dpi=REPORT_DPI, max_pixels=export_megapixels * 1_000_000, split_pages=True),
+                                    report_file, on_progress=report_progress
+                                )
+                                report_file.seek(0)
+                                report_bytes = report_file.read()
+
+                            status_text.text("")
+                            duplicates = images_added - images_stored
+                            st.success(f"Gotowe! Raport ma {images_added} obrazów ({charts_with_legend_count} wykresów z legendą)"
+                                       + (f", {duplicates} powtórzonych zapisano raz." if duplicates else "."))
+                            st.download_button("📝 Pobierz raport Word", data=report_bytes, file_name="psalmy_raport.docx",
+                                               mime="application/vnd.openxmlformats-officedocument.wordprocessingml.document")
+        except Exception as e:
+            st.error(f"Błąd: {e}")
+
+
+# ==========================================
+# TAB 3: OSIE CZASU
+# ==========================================
+TIMELINE_ROLE_LABELS = {"timeline": "Osoba (oś)", "place": "Miejsce", "start": "Początek", "end": "Koniec"}
+
+with tab3:
+    st.header("Osie Czasu Zakonnic")
+    st.markdown("""
+    Wgraj plik Excel z pobytami: jeden wiersz = osoba, miejsce, rok początku i końca (np. `1807/1808`).
+    Wiele osi rysuje się jedna pod drugą na wspólnej skali lat.
+    """)
+
+    uploaded_timelines = st.file_uploader("Wybierz plik Excel (.xlsx)", type=['xlsx'], key="upl_timelines")
+
+    if uploaded_timelines:
+        try:
+            timelines_data = uploaded_timelines.getvalue()
+            timelines_digest = upload_digest(uploaded_timelines)
+            timeline_headers = load_timeline_headers(timelines_digest, timelines_data)
+            timeline_sheet = st.selectbox("Wybierz arkusz z danymi:", list(timeline_headers), key="sheet_timelines")
+
+            header = timeline_headers[timeline_sheet]
+            detected = detect_timeline_columns(header)
+            header_columns = header.columns.tolist()
+            with st.expander("Kolumny", expanded=len(detected) < len(TIMELINE_COLUMNS)):
+                role_cols = st.columns(len(TIMELINE_COLUMNS))
+                timeline_columns = {}
+                for col, role in zip(role_cols, TIMELINE_COLUMNS):
+                    with col:
+                        default = header_columns.index(detected[role]) if role in detected else None
+                        timeline_columns[role] = st.selectbox(TIMELINE_ROLE_LABELS[role], header_columns, index=default, key=f"timeline_col_{role}")
+
+            if any(value is None for value in timeline_columns.values()):
+                st.info("Wskaż kolumny osoby, miejsca, początku i końca.")
+            else:
+                events, titles, x_limits = load_timeline_layout(
+                    timelines_digest, timelines_data, timeline_sheet, tuple(timeline_columns.items())
+                )
+                c1, c2 = st.columns(2)
+                with c1:
+                    timelines_title = st.text_input("Tytuł", value=f"Timelines: {timeline_sheet}", key="timelines_title")
+                    per_page = st.slider("Osi na stronę", 5, 60, TIMELINES_PER_PAGE, key="timelines_per_page")
+                with c2:
+                    timeline_labels = st.checkbox("Nazwy miejsc na paskach", value=True, key="timelines_labels")
+                    timeline_legend = st.checkbox("Legenda miejsc", value=True, key="timelines_legend")
 
+                pages = paginate_timelines(events, per_page)
+                st.caption(f"{events['group'].nunique()} osi, {len(events)} pobytów, {len(pages)} stron.")
+                if not pages:
+                    st.warning("Brak pobytów z rozpoznanym rokiem początku.")
+                else:
+                    page_no = st.number_input("Strona", 1, len(pages), 1, key="timelines_page") if len(pages) > 1 else 1
+
+                    def render_timeline_page(page_index, fig=None):
+                        title = f"{timelines_title} ({page_index + 1}/{len(pages)})" if len(pages) > 1 else timelines_title
+                        return draw_timelines(pages[page_index], title, x_limits, fig=fig, titles=titles,
+                                              show_labels=timeline_labels, show_legend=timeline_legend)
+
+                    # Sesyjna pamięć gotowych stron - przebiegi wywołane w innych zakładkach nie rysują osi od nowa
+                    timeline_cache = st.session_state.setdefault("timeline_preview_cache", collections.OrderedDict())
+                    timeline_key = (timelines_digest, timeline_sheet, tuple(timeline_columns.items()), per_page, page_no,
+                                    timelines_title, timeline_labels, timeline_legend)
+                    cache_lookup("timeline_preview", timeline_key in timeline_cache)
+                    if timeline_key not in timeline_cache:
+                        # Slot renderowania tylko przy chybieniu
+                        with heavy_render_slot("osie", PRIORITY_INTERACTIVE), figure_scope():
+                            timeline_cache[timeline_key] = figure_to_png(render_timeline_page(page_no - 1), PREVIEW_DPI)
+                    timeline_cache.move_to_end(timeline_key)
+                    while len(timeline_cache) > PREVIEW_CACHE_SIZE:
+                        timeline_cache.popitem(last=False)
+                    st.image(timeline_cache[timeline_key])
+
+                    st.markdown("##### Eksport wszystkich stron")
+                    timeline_format = st.radio("Format", ["ZIP (PNG)", "PDF"], horizontal=True, key="timelines_format")
+                    if st.button("Generuj eksport osi czasu"):
+                        progress_bar = st.progress(0)
+                        with heavy_render_slot("osie", PRIORITY_BATCH), figure_scope(), \
+                                EXPORT_SECONDS.time(chart="timeline", format="pdf" if timeline_format == "PDF" else "zip"):
+                            # Jedna figura przerysowywana strona po stronie
+                            export_fig = None
+                            if timeline_format == "PDF":
+                                with tempfile.NamedTemporaryFile(suffix=".pdf") as pdf_file:
+                                    with PdfPages(pdf_file) as pdf:
+                                        for i in range(len(pages)):
+                                            export_fig = render_timeline_page(i, fig=export_fig)
+                                            pdf.savefig(export_fig)
+                                            progress_bar.progress((i + 1) / len(pages))
+                                    pdf_file.seek(0)
+                                    export_bytes = pdf_file.read()
+                                export_name, export_mime = "osie_czasu.pdf", "application/pdf"
+                            else:
+                                images = export_timeline_pages(
+                                    events, per_page, PREVIEW_DPI, timelines_title,
+                                    progress=lambda done, total: progress_bar.progress(done / total),
+                                    show_labels=timeline_labels, show_legend=timeline_legend, laid_out=True
+                                )
+                                export_buf = io.BytesIO()
+                                with zipfile.ZipFile(export_buf, "w", zipfile.ZIP_STORED) as zf:
+                                    for i, png in enumerate(images, start=1):
+                                        zf.writestr(f"osie_czasu_{i:03d}.png", png)
+                                export_bytes = export_buf.getvalue()
+                                export_name, export_mime = "osie_czasu.zip", "application/zip"
+                        st.success(f"Gotowe! Wygenerowano {len(pages)} stron.")
+                        st.download_button("📦 Pobierz eksport", data=export_bytes, file_name=export_name, mime=export_mime)
         except Exception as e:
-            st.error(f"Błąd: {e}")
\ No newline at end of file
+            st.error(f"Wystąpił błąd podczas przetwarzania pliku: {e}")
+    else:
+        st.info("Proszę wgrać plik Excel z pobytami, aby rozpocząć.")
@@ -0,0 +1,207 @@
+import contextlib
+import gc
+import os
+import threading
+import time
+import weakref
+
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+from metryki import REGISTRY, rss_bytes
+
+# ==========================================
+# CYKL ŻYCIA FIGUR MATPLOTLIB
+# ==========================================
+# Wszystkie figury aplikacji, API i skryptów powstają tutaj. Menedżer:
+#  - zwalnia figury na końcu bloku figure_scope() (także przy wyjątku),
+#  - ogranicza liczbę żywych figur w procesie (nadmiarowe żądanie czeka na zwolnienie),
+#  - raportuje liczniki i zużycie pamięci procesu.
+
+MAX_LIVE_FIGURES = int(os.environ.get("MAX_LIVE_FIGURES", "16"))
+FIGURE_WAIT_TIMEOUT = 60.0
+
+
+class FigureLimitError(RuntimeError):
+    pass
+
+
+class FigureManager:
+    def __init__(self, max_live=MAX_LIVE_FIGURES, wait_timeout=FIGURE_WAIT_TIMEOUT):
+        self.max_live = max(1, max_live)
+        self.wait_timeout = wait_timeout
+        self._live = weakref.WeakSet()
+        self._cond = threading.Condition()
+        self._local = threading.local()
+        self.created = 0
+        self.released = 0
+        self.peak = 0
+
+    @property
+    def live(self):
+        with self._cond:
+            return len(self._live)
+
+    def _scopes(self):
+        scopes = getattr(self._local, "scopes", None)
+        if scopes is None:
+            scopes = self._local.scopes = []
+        return scopes
+
+    def new(self, figsize):
+        with self._cond:
+            deadline = time.monotonic() + self.wait_timeout
+            collected = False
+            while len(self._live) >= self.max_live:
+                if not collected:
+                    # Figury bez referencji, ale jeszcze nie zebrane (cykle) - sprzątamy raz przed czekaniem
+                    self._cond.release()
+                    try:
+                        gc.collect()
+                    finally:
+                        self._cond.acquire()
+                    collected = True
+                    continue
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise FigureLimitError(f"Za dużo otwartych wykresów ({len(self._live)}/{self.max_live}) - spróbuj ponownie za chwilę.")
+                self._cond.wait(min(remaining, 0.5))
+                collected = False
+            # Figura bez pyplot - własne płótno Agg, brak globalnego rejestru figur
+            fig = Figure(figsize=figsize)
+            FigureCanvasAgg(fig)
+            self._live.add(fig)
+            self.created += 1
+            self.peak = max(self.peak, len(self._live))
+        scopes = self._scopes()
+        if scopes:
+            scopes[-1].append(fig)
+        return fig
+
+    def reuse(self, fig, figsize):
+        # W pętlach wsadowych czyścimy i przewymiarowujemy tę samą figurę zamiast tworzyć nową
+        if fig is None or fig not in self._live:
+            return self.new(figsize)
+        fig.clear()
+        fig.set_size_inches(*figsize)
+        return fig
+
+    def release(self, fig):
+        if fig is None:
+            return
+        with self._cond:
+            if fig not in self._live:
+                return
+            self._live.discard(fig)
+            self.released += 1
+            self._cond.notify_all()
+        # Usunięcie artystów zwalnia większość pamięci nawet, gdy ktoś trzyma jeszcze referencję
+        fig.clear()
+
+    def keep(self, fig):
+        # Figura przechowywana dłużej niż blok (np. w pamięci podręcznej) - scope() jej nie zwolni
+        for created in self._scopes():
+            if fig in created:
+                created.remove(fig)
+
+    @contextlib.contextmanager
+    def scope(self):
+        """Zwalnia wszystkie figury utworzone w tym wątku wewnątrz bloku."""
+        created = []
+        scopes = self._scopes()
+        scopes.append(created)
+        try:
+            yield created
+        finally:
+            scopes.pop()
+            for fig in created:
+                self.release(fig)
+
+    def stats(self):
+        with self._cond:
+            return {
+                "live": len(self._live),
+                "max_live": self.max_live,
+                "created": self.created,
+                "released": self.released,
+                "peak": self.peak,
+                "rss_bytes": rss_bytes(),
+            }
+
+
+figures = FigureManager()
+
+new_figure = figures.new
+reuse_figure = figures.reuse
+release_figure = figures.release
+keep_figure = figures.keep
+figure_scope = figures.scope
+figure_stats = figures.stats
+
+REGISTRY.function("filigran_figures_live", "Otwarte figury matplotlib w procesie.", lambda: figures.live)
+REGISTRY.function("filigran_figures_peak", "Najwięcej figur otwartych naraz.", lambda: figures.peak)
+REGISTRY.function("filigran_figures_created_total", "Utworzone figury matplotlib.", lambda: figures.created, kind="counter")
+
+
+def leak_check(render, iterations=200, warmup=20, tolerance_mb=40.0):
+    """Wywołuje render() wiele razy i sprawdza, że pamięć procesu i liczba figur nie rosną.
+
+    Zwraca (ok, raport). Pamięć mierzona po rozgrzewce (czcionki, cache), żeby
+    jednorazowe alokacje nie udawały wycieku.
+    """
+    for _ in range(warmup):
+        with figure_scope():
+            render()
+    gc.collect()
+    baseline = rss_bytes()
+    samples = []
+    for i in range(iterations):
+        with figure_scope():
+            render()
+        if (i + 1) % max(1, iterations // 10) == 0:
+            gc.collect()
+            samples.append(rss_bytes())
+    stats = figure_stats()
+    report = {"baseline_rss": baseline, "samples_rss": samples, **stats}
+    ok = stats["live"] == 0
+    if baseline is not None and samples:
+        ok = ok and (max(samples) - baseline) / 2**20 <= tolerance_mb
+    return ok, report
+
+
+if __name__ == "__main__":
+    # Samokontrola: wiele renderów psalmu i wykresu populacji, pamięć ma być płaska.
+    # Uruchomiony jako skrypt moduł to __main__, a renderery korzystają z modułu "figury" -
+    # dlatego sprawdzamy przez import, żeby liczniki dotyczyły tego samego menedżera.
+    import sys
+    import figury
+    from psalmy import select_view, draw_pretty_sankey_final, figure_to_png
+    from wykresy_pionowe import draw_population_chart, COLORS_NUNS, DEFAULT_MAPPINGS, parse_mapping_values
+
+    def cell(uid, text):
+        return {"ids": [uid], "marker": str(ord(uid) - 64), "text": text, "raw": f"[{uid}] {text}"}
+
+    rows = [
+        {"A": cell(uid, f"Beatus vir qui non abiit in consilio impiorum {uid}"),
+         "B": cell(uid, f"Et in via peccatorum non stetit {uid}"),
+         "C": cell(uid, f"Et in cathedra pestilentiae non sedit {uid}")}
+        for uid in "ABCDEFGHIJKL"
+    ]
+    view_ids, blocks, id_to_index = select_view(rows)
+    active = {loc: True for loc in DEFAULT_MAPPINGS}
+    mappings = {loc: parse_mapping_values(v) for loc, v in DEFAULT_MAPPINGS.items()}
+    segments = [(f"Etap {i}", [(10 + i, COLORS_NUNS["Gravelines"], "Gravelines"), (i, COLORS_NUNS["Deceased"], "Deceased")]) for i in range(8)]
+
+    def render():
+        fig = draw_pretty_sankey_final("Psalm", view_ids, blocks, id_to_index, colors=("#a6cee3", "#6BB72B", "#1f78b4"), labels=("A", "B", "C"))
+        figure_to_png(fig, 72)
+        fig = draw_population_chart(segments, "Populacja", mappings, active)
+        figure_to_png(fig, 72)
+
+    ok, report = figury.leak_check(render, iterations=int(sys.argv[1]) if len(sys.argv) > 1 else 200)
+    mb = [round(s / 2**20, 1) for s in report["samples_rss"] if s is not None]
+    base = report["baseline_rss"]
+    print(f"RSS po rozgrzewce: {round(base / 2**20, 1) if base else '?'} MB, próbki: {mb}")
+    print(f"Figury: utworzone {report['created']}, zwolnione {report['released']}, żywe {report['live']}, szczyt {report['peak']}")
+    print("OK - pamięć płaska" if ok else "BŁĄD - wyciek figur lub pamięci")
+    sys.exit(0 if ok else 1)
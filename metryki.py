@@ -0,0 +1,401 @@
+import argparse
+import bisect
+import contextlib
+import math
+import os
+import re
+import sys
+import threading
+import time
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# ==========================================
+# METRYKI OPERACYJNE (format tekstowy Prometheus)
+# ==========================================
+# Liczniki i histogramy czasów parsowania, renderowania, zapisu i eksportu oraz trafień
+# w pamięci podręczne. Udostępnianie (z app.py i api_wykresow.py, zmienne środowiskowe):
+#   METRICS_PORT=9108      -> http://127.0.0.1:9108/metrics (METRICS_HOST zmienia adres)
+#   METRICS_FILE=/tmp/m.prom -> zrzut do pliku co METRICS_INTERVAL sekund (domyślnie 15)
+# Moduł używa tylko biblioteki standardowej, więc można go importować wszędzie.
+#
+# Podgląd z wiersza poleceń (zastępczy "scraper"):
+#   python metryki.py --scrape http://127.0.0.1:9108/metrics [--interval 5]
+#   python metryki.py                # samokontrola: serwer, render, odczyt i sprawdzenie serii
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+METRICS_INTERVAL = 15.0
+
+
+def _format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for _, v in pairs)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name}: oczekiwane etykiety {self.labelnames}, podano {tuple(labels)}")
+        return tuple(str(labels[n]) for n in self.labelnames)
+
+    def header(self):
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name, help_text, labelnames=()):
+        super().__init__(name, help_text, labelnames)
+        self._values = {}
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    def samples(self):
+        with self._lock:
+            items = sorted(self._values.items())
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(v)}" for key, v in items]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}    # etykiety -> [liczniki kubełków..., suma, liczba]
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+            series[index] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        """Mierzy czas bloku (także zakończonego wyjątkiem)."""
+        self._key(labels)
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - t0, **labels)
+
+    def count(self, **labels):
+        with self._lock:
+            series = self._series.get(self._key(labels))
+            return series[-1] if series else 0
+
+    def samples(self):
+        with self._lock:
+            items = sorted((key, list(series)) for key, series in self._series.items())
+        lines = []
+        for key, series in items:
+            cumulative = 0
+            for bound, n in zip(self.buckets + (math.inf,), series):
+                cumulative += n
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, [('le', _format_value(bound))])} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {_format_value(series[-2])}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {series[-1]}")
+        return lines
+
+
+class FunctionMetric(_Metric):
+    """Wartość odczytywana przy eksporcie: fn() -> liczba albo {krotka etykiet: liczba}."""
+
+    def __init__(self, name, help_text, fn, labelnames=(), kind="gauge"):
+        super().__init__(name, help_text, labelnames)
+        self.kind = kind
+        self.fn = fn
+
+    def samples(self):
+        try:
+            value = self.fn()
+        except Exception:
+            return []
+        if value is None:
+            return []
+        if not isinstance(value, dict):
+            value = {(): value}
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(v)}"
+                for key, v in sorted(value.items()) if v is not None]
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _register(self, metric):
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                # Ponowny import modułu (np. przeładowanie skryptu) - zostaje pierwsza rejestracja
+                return existing
+            self._metrics[metric.name] = metric
+            return metric
+
+    def counter(self, name, help_text, labelnames=()):
+        return self._register(Counter(name, help_text, labelnames))
+
+    def histogram(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, help_text, labelnames, buckets))
+
+    def function(self, name, help_text, fn, labelnames=(), kind="gauge"):
+        # Funkcję można podmienić (np. nowy obiekt kolejki po restarcie aplikacji)
+        metric = self._register(FunctionMetric(name, help_text, fn, labelnames, kind))
+        metric.fn = fn
+        return metric
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            samples = metric.samples()
+            if samples:
+                lines.extend(metric.header())
+                lines.extend(samples)
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+PARSE_SECONDS = REGISTRY.histogram(
+    "filigran_parse_seconds", "Czas parsowania plików wejściowych.", ("format",))
+RENDER_SECONDS = REGISTRY.histogram(
+    "filigran_render_seconds", "Czas budowania wykresu (układ i rysowanie artystów, bez rastra).", ("chart", "stage"))
+SAVEFIG_SECONDS = REGISTRY.histogram(
+    "filigran_savefig_seconds", "Czas rasteryzacji i zapisu figury.", ("format", "dpi"))
+EXPORT_SECONDS = REGISTRY.histogram(
+    "filigran_export_seconds", "Czas całego eksportu wsadowego.", ("chart", "format"))
+ZIP_SECONDS = REGISTRY.histogram(
+    "filigran_zip_seconds", "Czas składania archiwum ZIP.")
+QUEUE_WAIT_SECONDS = REGISTRY.histogram(
+    "filigran_render_queue_wait_seconds", "Czas oczekiwania na slot ciężkiego renderu.", ("kind",))
+RENDERS = REGISTRY.counter(
+    "filigran_renders_total", "Liczba narysowanych wykresów.", ("chart",))
+CACHE_REQUESTS = REGISTRY.counter(
+    "filigran_cache_requests_total", "Zapytania do pamięci podręcznych.", ("cache", "result"))
+
+
+def cache_lookup(cache, hit):
+    CACHE_REQUESTS.inc(cache=cache, result="hit" if hit else "miss")
+
+
+def rss_bytes():
+    """Bieżąca pamięć rezydentna procesu (None, gdy system jej nie udostępnia)."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+REGISTRY.function("filigran_process_rss_bytes", "Pamięć rezydentna procesu.", rss_bytes)
+REGISTRY.function("filigran_process_threads", "Liczba wątków procesu.", threading.active_count)
+
+
+# --- Udostępnianie ---
+def _handler(registry):
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0].rstrip("/") not in ("/metrics", ""):
+                self.send_error(404)
+                return
+            body = registry.render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
+
+
+def start_http_server(port, host="127.0.0.1", registry=REGISTRY):
+    """Serwer /metrics w wątku w tle; zwraca serwer (port=0 - wolny port, server.server_port)."""
+    server = ThreadingHTTPServer((host, port), _handler(registry))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    return server
+
+
+def dump_to_file(path, registry=REGISTRY):
+    # Zapis przez plik tymczasowy i rename - czytelnik nigdy nie widzi połowy pliku
+    tmp = f"{path}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(registry.render())
+    os.replace(tmp, path)
+
+
+def start_file_dump(path, interval=METRICS_INTERVAL, registry=REGISTRY):
+    stop = threading.Event()
+
+    def run():
+        while True:
+            try:
+                dump_to_file(path, registry)
+            except OSError:
+                pass
+            if stop.wait(interval):
+                return
+
+    threading.Thread(target=run, name="metrics-dump", daemon=True).start()
+    return stop
+
+
+_exporter_lock = threading.Lock()
+_exporter = None
+
+
+def start_exporter_from_env():
+    """Włącza udostępnianie wg METRICS_PORT / METRICS_FILE; wołane wielokrotnie startuje raz."""
+    global _exporter
+    with _exporter_lock:
+        if _exporter is None:
+            _exporter = {}
+            port = os.environ.get("METRICS_PORT")
+            if port:
+                _exporter["server"] = start_http_server(int(port), os.environ.get("METRICS_HOST", "127.0.0.1"))
+            path = os.environ.get("METRICS_FILE")
+            if path:
+                _exporter["dump"] = start_file_dump(path, float(os.environ.get("METRICS_INTERVAL", METRICS_INTERVAL)))
+        return _exporter
+
+
+# --- Zastępczy scraper ---
+_SAMPLE_RE = re.compile(r'^([a-zA-Z_:][a-zA-Z0-9_:]*)(?:\{(.*)\})?\s+(\S+)$')
+_LABEL_RE = re.compile(r'([a-zA-Z_][a-zA-Z0-9_]*)="((?:[^"\\]|\\.)*)"')
+
+
+def parse_metrics(text):
+    """Tekst w formacie Prometheus -> {(nazwa, krotka (etykieta, wartość)): liczba}."""
+    samples = {}
+    for line in text.splitlines():
+        if not line or line.startswith("#"):
+            continue
+        match = _SAMPLE_RE.match(line)
+        if not match:
+            raise ValueError(f"Niepoprawna linia metryk: {line!r}")
+        name, labels, value = match.groups()
+        labels = tuple(sorted(_LABEL_RE.findall(labels or "")))
+        samples[(name, labels)] = float(value.replace("+Inf", "inf"))
+    return samples
+
+
+def scrape(source):
+    """Odczyt metryk z adresu http(s) albo z pliku zrzutu."""
+    if source.startswith(("http://", "https://")):
+        with urllib.request.urlopen(source, timeout=10) as response:
+            return parse_metrics(response.read().decode("utf-8"))
+    with open(source, encoding="utf-8") as f:
+        return parse_metrics(f.read())
+
+
+def summarize(samples):
+    # Krótki raport: liczniki, średnie z histogramów, wartości bieżące
+    lines = []
+    for (name, labels), value in sorted(samples.items()):
+        label_text = ",".join(f"{k}={v}" for k, v in labels)
+        if name.endswith("_count"):
+            total = samples.get((name[:-6] + "_sum", labels), 0.0)
+            mean = total / value if value else 0.0
+            lines.append(f"{name[:-6]}[{label_text}]: n={int(value)}, średnio {mean * 1000:.1f} ms")
+        elif not name.endswith(("_bucket", "_sum")):
+            lines.append(f"{name}[{label_text}]: {_format_value(value)}")
+    return lines
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Metryki aplikacji: odczyt (scraper) albo samokontrola.")
+    parser.add_argument("--scrape", help="adres /metrics albo plik zrzutu")
+    parser.add_argument("--interval", type=float, default=0, help="odczyt co N sekund (0 - raz)")
+    args = parser.parse_args()
+
+    if args.scrape:
+        while True:
+            print(f"--- {time.strftime('%H:%M:%S')} {args.scrape}")
+            print("\n".join(summarize(scrape(args.scrape))))
+            if not args.interval:
+                break
+            time.sleep(args.interval)
+        sys.exit(0)
+
+    # Samokontrola: renderujemy psalm przez zainstrumentowane funkcje, odczytujemy przez HTTP i z pliku.
+    # Jak w figury.py - import modułu po nazwie, żeby liczniki były tymi, których używa psalmy.
+    import tempfile
+    import metryki
+    from figury import figure_scope
+    from psalmy import select_view, draw_pretty_sankey_final, figure_to_png, SankeyChartCache
+
+    def cell(uid, text):
+        return {"ids": [uid], "marker": str(ord(uid) - 64), "text": text, "raw": f"[{uid}] {text}"}
+
+    rows = [{c: cell(uid, f"Beatus vir qui non abiit {uid}") for c in "ABC"} for uid in "ABCDEF"]
+    view = select_view(rows)
+    cache = SankeyChartCache()
+    style = {"colors": ("#a6cee3", "#6BB72B", "#1f78b4")}
+    for colors in (style["colors"], ("#000000", "#111111", "#222222")):
+        with figure_scope():
+            cache.png("samokontrola", dict(style, colors=colors),
+                      lambda **s: draw_pretty_sankey_final("Psalm", *view, labels=("A", "B", "C"), **s), 72)
+    with figure_scope():
+        figure_to_png(draw_pretty_sankey_final("Psalm", *view, labels=("A", "B", "C"), **style), 72)
+
+    server = metryki.start_http_server(0)
+    samples = scrape(f"http://127.0.0.1:{server.server_port}/metrics")
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "metryki.prom")
+        metryki.dump_to_file(path)
+        from_file = scrape(path)
+    server.shutdown()
+
+    expected = [
+        ("filigran_render_seconds_count", (("chart", "psalm"), ("stage", "layout"))),
+        ("filigran_render_seconds_count", (("chart", "psalm"), ("stage", "draw"))),
+        ("filigran_savefig_seconds_count", (("dpi", "72"), ("format", "png"))),
+        ("filigran_cache_requests_total", (("cache", "charts"), ("result", "hit"))),
+        ("filigran_cache_requests_total", (("cache", "charts"), ("result", "miss"))),
+        ("filigran_figures_live", ()),
+        ("filigran_process_rss_bytes", ()),
+    ]
+    missing = [name for name, labels in expected if (name, labels) not in samples]
+    print("\n".join(summarize(samples)))
+    ok = not missing and set(from_file) == set(samples) and samples[expected[0]] == 2
+    print("OK - metryki kompletne" if ok else f"BŁĄD - brak serii: {missing}")
+    sys.exit(0 if ok else 1)
@@ -0,0 +1,316 @@
+import argparse
+import io
+import json
+import os
+import random
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+import streamlit as st
+import streamlit.logger
+from docx import Document
+from streamlit.testing.v1 import AppTest
+
+from metryki import rss_bytes
+
+# ==========================================
+# TEST OBCIĄŻENIOWY APLIKACJI (wiele sesji naraz)
+# ==========================================
+# Uruchomienie: python obciazenie.py [--sessions 1,2,4,8] [--iterations 3] [--json wynik.json]
+#
+# Każda symulowana sesja to osobny AppTest (bez przeglądarki) w osobnym wątku, w jednym procesie -
+# tak jak sesje jednego kontenera dzielą pamięć podręczną, magazyn dokumentów i kolejkę renderowania.
+# Sesja: logowanie przez check_password, wgranie syntetycznego .docx i .xlsx, wykres zakonnic,
+# przełączanie psalmów, zmiana suwaków i eksport PDF. Dla każdej liczby sesji raport podaje
+# percentyle czasu interakcji, przepustowość i szczytową pamięć procesu.
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "app.py")
+UPLOADS_STATE_KEY = "_obciazenie_uploads"
+RSS_SAMPLE_INTERVAL = 0.2
+
+WORDS = (
+    "dominus deus meus in te speravi salvum me fac ex omnibus persequentibus me "
+    "et libera me nequando rapiat ut leo animam meam dum non est qui redimat"
+).split()
+
+
+# --- Pliki syntetyczne ---
+def make_docx(seed, n_psalms=6, rows=8):
+    """Dokument w formacie porównywarki: tabela na psalm, nagłówek, wiersze [ID] z częścią scaleń."""
+    rng = random.Random(seed)
+
+    def sentence(n):
+        return " ".join(rng.choice(WORDS) for _ in range(n))
+
+    doc = Document()
+    for p in range(1, n_psalms + 1):
+        table = doc.add_table(rows=0, cols=3)
+        table.add_row().cells[0].text = f"PSALM {p}"
+        header = table.add_row().cells
+        for cell, label in zip(header, ("OFFICIUM 1571", "VULGATA 1592", "BELLARMINE 1611")):
+            cell.text = label
+        ids = [chr(65 + i) for i in range(rows)]
+        i = 0
+        while i < len(ids):
+            cells = table.add_row().cells
+            if i + 1 < len(ids) and rng.random() < 0.3:
+                # Scalenie: kolumna A łączy dwa wiersze B/C
+                merged = f"[{ids[i]},{ids[i + 1]}] {i + 1}. {sentence(rng.randint(10, 30))}"
+                cells[0].text = merged
+                cells[1].text = f"[{ids[i]}] {i + 1}. {sentence(rng.randint(5, 20))}"
+                cells[2].text = f"[{ids[i]}] {i + 1}. {sentence(rng.randint(5, 20))}"
+                cells = table.add_row().cells
+                cells[0].text = merged
+                cells[1].text = f"[{ids[i + 1]}] {i + 2}. {sentence(rng.randint(5, 20))}"
+                cells[2].text = f"[{ids[i + 1]}] {i + 2}. {sentence(rng.randint(5, 20))}"
+                i += 2
+            else:
+                for k in range(3):
+                    cells[k].text = f"[{ids[i]}] {i + 1}. {sentence(rng.randint(5, 25))}"
+                i += 1
+    buf = io.BytesIO()
+    doc.save(buf)
+    return buf.getvalue()
+
+
+def make_xlsx(seed, n_nuns=30):
+    """Skoroszyt zakonnic: arkusz na klasztor, kolumny etapów od IMPRISONMENT."""
+    rng = random.Random(seed)
+    columns = ["NAME", "IMPRISONMENT 1793-1795", "LONDON 1795", "GOSFIELD 1796", "MOVE 1814"]
+    values = ["yes", "y", "x", "z", "yesn", "yesz", "yesc", ""]
+    buf = io.BytesIO()
+    with pd.ExcelWriter(buf) as writer:
+        for sheet in ("GRAVELINES", "ROUEN"):
+            df = pd.DataFrame({c: [rng.choice(values) for _ in range(n_nuns)] for c in columns})
+            df.to_excel(writer, sheet_name=sheet, index=False)
+    return buf.getvalue()
+
+
+# --- Wgrywanie plików w AppTest ---
+class SyntheticUpload(io.BytesIO):
+    """Zastępnik UploadedFile: bajty + name, size, file_id, type."""
+
+    def __init__(self, name, data):
+        super().__init__(data)
+        self.name = name
+        self.size = len(data)
+        self.file_id = f"{name}-{hash(data)}"
+        self.type = ""
+
+
+_upload_lock = threading.Lock()
+_original_file_uploader = None
+
+
+def install_upload_injection():
+    """AppTest nie symuluje wgrywania plików - st.file_uploader zwraca pliki z session_state sesji.
+
+    Słownik {klucz_widżetu: (nazwa, bajty) lub lista takich par} leży pod UPLOADS_STATE_KEY.
+    """
+    global _original_file_uploader
+    with _upload_lock:
+        if _original_file_uploader is not None:
+            return
+        _original_file_uploader = st.file_uploader
+
+        def file_uploader(label, *args, key=None, **kwargs):
+            _original_file_uploader(label, *args, key=key, **kwargs)
+            upload = st.session_state.get(UPLOADS_STATE_KEY, {}).get(key)
+            if upload is None:
+                return [] if kwargs.get("accept_multiple_files") else None
+            if isinstance(upload, list):
+                return [SyntheticUpload(name, data) for name, data in upload]
+            return SyntheticUpload(*upload)
+
+        st.file_uploader = file_uploader
+
+
+# --- Jedna symulowana sesja ---
+class LoadSession:
+    def __init__(self, session_id, docx, xlsx, iterations=3, password=None, timeout=600, seed=0):
+        self.session_id = session_id
+        self.docx = docx
+        self.xlsx = xlsx
+        self.iterations = iterations
+        self.password = password if password is not None else os.environ.get("APP_PASSWORD", "b12345")
+        self.timeout = timeout
+        self.rng = random.Random(seed)
+        self.timings = []       # (interakcja, sekundy, ok)
+        self.errors = []
+        self.at = None
+
+    def _problems(self):
+        at = self.at
+        return [str(e.value) for e in at.exception] + [str(e.value) for e in at.error]
+
+    def step(self, name, action):
+        t0 = time.perf_counter()
+        try:
+            action()
+            problems = self._problems()
+        except Exception as e:
+            problems = [f"{type(e).__name__}: {e}"]
+        self.timings.append((name, time.perf_counter() - t0, not problems))
+        self.errors.extend(f"{name}: {p}" for p in problems)
+        return not problems
+
+    def _widget(self, kind, label):
+        for widget in getattr(self.at, kind):
+            if widget.label == label or (widget.label or "").startswith(label):
+                return widget
+        raise LookupError(f"Brak widżetu {kind}: {label!r}")
+
+    def _wait_for_document(self, limit=120):
+        # Dokument wczytuje się w tle - sesja odświeża stronę jak fragment co sekundę
+        for _ in range(limit):
+            if not any("Wczytuję dokument" in str(i.value) for i in self.at.info):
+                return
+            time.sleep(0.5)
+            self.at.run()
+        raise TimeoutError("dokument nie wczytał się w czasie")
+
+    def _login(self):
+        self.at.text_input[0].input(self.password)
+        self.at.button[0].click()
+        self.at.run()
+        if not self.at.session_state["authenticated"]:
+            raise RuntimeError("logowanie nieudane")
+
+    def _set(self, widget, value):
+        widget.set_value(value)
+        self.at.run()
+
+    def run(self):
+        install_upload_injection()
+        self.at = at = AppTest.from_file(APP_PATH, default_timeout=self.timeout)
+        at.session_state[UPLOADS_STATE_KEY] = {
+            "upl_docx_psalms_new": (f"psalmy_{self.session_id}.docx", self.docx),
+            "upl_nuns": [(f"zakonnice_{self.session_id}.xlsx", self.xlsx)],
+        }
+        if not self.step("start", at.run) or not self.step("login", self._login):
+            return self
+        if not self.step("wczytanie_docx", self._wait_for_document):
+            return self
+
+        self.step("wykres_zakonnic", lambda: (self._widget("button", "Generuj wykres").click(), at.run()))
+        psalms = at.selectbox(key="psalm_single").options
+        for _ in range(self.iterations):
+            self.step("zmiana_psalmu", lambda: self._set(at.selectbox(key="psalm_single"), self.rng.choice(psalms)))
+            self.step("suwak_wierszy", lambda: self._set(at.slider(key="rows_per_page_single"), self.rng.randint(4, 20)))
+            self.step("suwak_czcionki", lambda: self._set(self._widget("slider", "Rozmiar Czcionki"), self.rng.randint(8, 12)))
+
+        self.step("tryb_pdf", lambda: self._set(at.radio(key="psalm_mode"), "Eksport do PDF"))
+        self.step("eksport_pdf", lambda: (self._widget("button", "Generuj dokument PDF").click(), at.run()))
+        return self
+
+
+# --- Poziomy obciążenia ---
+class RssMonitor:
+    """Wątek próbkujący pamięć procesu; peak po stop()."""
+
+    def __init__(self, interval=RSS_SAMPLE_INTERVAL):
+        self.interval = interval
+        self.peak = rss_bytes() or 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, rss_bytes() or 0)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, rss_bytes() or 0)
+
+
+def percentiles(values, qs=(50, 90, 99)):
+    if not values:
+        return {f"p{q}": None for q in qs}
+    return {f"p{q}": float(np.percentile(values, q)) for q in qs}
+
+
+def run_level(n_sessions, documents, workbooks, iterations=3, ramp=0.5, timeout=600, seed=0):
+    """n_sessions sesji naraz (start co `ramp` s); zwraca słownik z wynikami poziomu."""
+    sessions = [
+        LoadSession(i, documents[i % len(documents)], workbooks[i % len(workbooks)],
+                    iterations=iterations, timeout=timeout, seed=seed + i)
+        for i in range(n_sessions)
+    ]
+    threads = [threading.Thread(target=s.run, name=f"sesja-{s.session_id}", daemon=True) for s in sessions]
+    t0 = time.perf_counter()
+    with RssMonitor() as monitor:
+        for thread in threads:
+            thread.start()
+            time.sleep(ramp)
+        for thread in threads:
+            thread.join()
+    wall = time.perf_counter() - t0
+
+    timings = [t for s in sessions for t in s.timings]
+    by_step = {}
+    for name, seconds, _ in timings:
+        by_step.setdefault(name, []).append(seconds)
+    return {
+        "sessions": n_sessions,
+        "interactions": len(timings),
+        "errors": sum(1 for _, _, ok in timings if not ok),
+        "error_samples": [e for s in sessions for e in s.errors][:5],
+        "wall_seconds": wall,
+        "throughput_per_s": len(timings) / wall if wall else 0.0,
+        "latency": {**percentiles([t for _, t, _ in timings]), "max": max((t for _, t, _ in timings), default=None)},
+        "by_interaction": {name: {**percentiles(values), "n": len(values)} for name, values in by_step.items()},
+        "peak_rss_mb": monitor.peak / 2**20,
+    }
+
+
+def _fmt(seconds):
+    return "-" if seconds is None else f"{seconds:.2f}"
+
+
+def print_report(results):
+    print(f"{'sesje':>5} {'interakcje':>10} {'błędy':>6} {'przepust./s':>11} {'p50 s':>7} {'p90 s':>7} {'p99 s':>7} {'max s':>7} {'szczyt RSS':>11}")
+    for r in results:
+        lat = r["latency"]
+        print(f"{r['sessions']:>5} {r['interactions']:>10} {r['errors']:>6} {r['throughput_per_s']:>11.2f} "
+              f"{_fmt(lat['p50']):>7} {_fmt(lat['p90']):>7} {_fmt(lat['p99']):>7} {_fmt(lat['max']):>7} {r['peak_rss_mb']:>8.0f} MB")
+    for r in results:
+        print(f"\n{r['sessions']} sesji - czasy interakcji (p50 / p90 / p99 s):")
+        for name, s in r["by_interaction"].items():
+            print(f"  {name:<16} {_fmt(s['p50']):>6} / {_fmt(s['p90']):>6} / {_fmt(s['p99']):>6}  (n={s['n']})")
+        for sample in r["error_samples"]:
+            print(f"  ! {sample}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Test obciążeniowy app.py: wiele równoległych sesji AppTest.")
+    parser.add_argument("--sessions", default="1,2,4", help="liczby sesji kolejnych poziomów, np. 1,2,4,8")
+    parser.add_argument("--iterations", type=int, default=3, help="powtórzeń zmiany psalmu i suwaków na sesję")
+    parser.add_argument("--documents", type=int, default=4, help="ile różnych plików .docx/.xlsx krąży między sesjami")
+    parser.add_argument("--psalms", type=int, default=6, help="psalmów w syntetycznym dokumencie")
+    parser.add_argument("--rows", type=int, default=8, help="wierszy (ID) w psalmie")
+    parser.add_argument("--ramp", type=float, default=0.5, help="odstęp startu kolejnych sesji (s)")
+    parser.add_argument("--timeout", type=float, default=600, help="limit czasu pojedynczego przebiegu skryptu (s)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="zapisz wyniki do pliku JSON")
+    args = parser.parse_args()
+    # Ostrzeżenia o braku kontekstu z wątków w tle zasłaniałyby raport
+    streamlit.logger.set_log_level("error")
+
+    documents = [make_docx(args.seed + i, args.psalms, args.rows) for i in range(args.documents)]
+    workbooks = [make_xlsx(args.seed + i) for i in range(args.documents)]
+    results = []
+    for n in [int(x) for x in args.sessions.split(",") if x.strip()]:
+        print(f"Poziom: {n} sesji...", flush=True)
+        results.append(run_level(n, documents, workbooks, args.iterations, args.ramp, args.timeout, args.seed))
+    print()
+    print_report(results)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
@@ -0,0 +1,1372 @@
+import io
+import re
+import types
+import threading
+import time
+import collections
+import collections.abc
+import contextlib
+import difflib
+import functools
+import hashlib
+import json
+import numpy as np
+import matplotlib
+import matplotlib.colors as mcolors
+import matplotlib.patches as mpatches
+from matplotlib.collections import PolyCollection
+from docx import Document
+from matplotlib.transforms import Bbox
+from matplotlib import font_manager, ft2font
+from matplotlib.font_manager import FontProperties
+from figury import reuse_figure, keep_figure, release_figure
+from metryki import REGISTRY, PARSE_SECONDS, RENDER_SECONDS, SAVEFIG_SECONDS, RENDERS, cache_lookup
+
+# ==========================================
+# SILNIK PSALMÓW (bez Streamlit)
+# ==========================================
+# Parsowanie tabel Worda, budowa bloków i rysowanie wykresów porównawczych.
+# Używane przez app.py i przez api_wykresow.py.
+
+# Enumy LoadFlags/Kerning są od matplotlib 3.10; starsze wersje (obraz z Pythonem 3.9) mają stałe modułu
+if hasattr(ft2font, "LoadFlags"):
+    _NO_HINTING = ft2font.LoadFlags.NO_HINTING
+    _KERNING_DEFAULT = ft2font.Kerning.DEFAULT
+else:
+    _NO_HINTING = ft2font.LOAD_NO_HINTING
+    _KERNING_DEFAULT = ft2font.KERNING_DEFAULT
+
+# ==========================================
+# 1. PARSOWANIE DOKUMENTU
+# ==========================================
+
+def natural_sort_key(s):
+    return [int(t) if t.isdigit() else t.lower() for t in re.split(r"([0-9]+)", str(s))]
+
+def extract_ids_and_text(raw):
+    raw = (raw or "").strip().replace("\xa0", " ")
+    raw = re.sub(r"[ \t]+\n", "\n", raw)
+    
+    m = re.match(r"^\[([A-Za-z0-9,\s]+)\]\s*\.?\s*(.*)$", raw, flags=re.DOTALL)
+    if m:
+        ids = [i.strip() for i in m.group(1).split(",") if i.strip()]
+        txt = (m.group(2) or "").strip().lstrip(".").strip()
+        return ids, txt
+    
+    m = re.match(r"^([A-Z])\.\s*(.*)$", raw, flags=re.DOTALL)
+    if m:
+        return [m.group(1)], (m.group(2) or "").strip()
+        
+    return [], raw
+
+def split_marker(text):
+    t = (text or "").strip().lstrip(".").strip()
+    m = re.match(r"^(\d+)\.?\s+(.*)$", t, flags=re.DOTALL)
+    if m: return m.group(1), (m.group(2) or "").strip()
+    m = re.match(r"^([IVXLCDM]+)\.\s+(.*)$", t, flags=re.DOTALL)
+    if m: return m.group(1), (m.group(2) or "").strip()
+    return "", t
+
+def psalm_from_header(text):
+    m = re.search(r"PSALM\s+(\d+)", text, flags=re.I)
+    return f"PSALM {m.group(1)}" if m else None
+
+def table_psalm(table):
+    # Szybki odczyt: tylko pierwszy wiersz tabeli
+    try:
+        first_row_text = " ".join([c.text.strip() for c in table.rows[0].cells if c.text])
+        return psalm_from_header(first_row_text)
+    except:
+        return None
+
+def is_data_row(cells):
+    # Wiersz z trzema kolumnami, który nie jest nagłówkiem źródeł (OFFICIUM / VULGATA)
+    if len(cells) < 3: return False
+    return not ("OFFICIUM" in (cells[0].text or "").upper() or "VULGATA" in (cells[1].text or "").upper())
+
+def table_has_rows(table):
+    # Czy parse_table_rows da choć jeden wiersz - bez parsowania treści
+    return any(is_data_row(row.cells) for row in table.rows[1:])
+
+def parse_table_rows(table):
+    rows_data = []
+    for r_i, row in enumerate(table.rows[1:], start=1):
+        cells = row.cells
+        if not is_data_row(cells): continue
+
+        row_items = {}
+        for idx, col_key in enumerate(["A", "B", "C"]):
+            raw = (cells[idx].text or "").strip()
+            ids, txt = extract_ids_and_text(raw)
+            marker, body = split_marker(txt)
+            row_items[col_key] = {
+                "ids": ids,
+                "marker": marker,
+                "text": body,
+                "raw": raw
+            }
+        rows_data.append(row_items)
+    return rows_data
+
+def iter_docx_psalms(file_bytes):
+    # Psalmy oddawane tabela po tabeli: (nazwa, wiersze) - odbiorca może z nich korzystać od razu
+    document = Document(io.BytesIO(file_bytes))
+    for table in document.tables:
+        ps = table_psalm(table)
+        if not ps: continue
+        rows_data = parse_table_rows(table)
+        if rows_data:
+            yield ps, rows_data
+
+def parse_docx_psalms_v2(file_bytes):
+    # Ta sama nazwa psalmu w kolejnej tabeli nadpisuje wcześniejszą
+    with PARSE_SECONDS.time(format="docx"):
+        return dict(iter_docx_psalms(file_bytes))
+
+class LazyDocument(collections.abc.Mapping):
+    """Dokument czytany leniwie: psalm -> wiersze (niemutowalne).
+
+    Przy otwarciu czytane są tylko nagłówki tabel (indeks psalm -> tabele); wiersze
+    psalmu są parsowane przy pierwszym użyciu i zapamiętywane. Obiekt może być
+    współdzielony przez wiele sesji.
+    """
+
+    def __init__(self, file_bytes):
+        t0 = time.perf_counter()
+        self._document = Document(io.BytesIO(file_bytes))
+        self._tables = collections.OrderedDict()
+        for table in self._document.tables:
+            ps = table_psalm(table)
+            # Jak parse_docx_psalms_v2: tabele bez wierszy danych (np. tytuł i nagłówek źródeł) pomijamy,
+            # więc psalm bez żadnej niepustej tabeli nie trafia do indeksu
+            if ps and table_has_rows(table):
+                self._tables.setdefault(ps, []).append(table)
+        PARSE_SECONDS.observe(time.perf_counter() - t0, format="docx_scan")
+        self._rows = {}
+        self._lock = threading.Lock()
+
+    def __getitem__(self, psalm):
+        rows = self._rows.get(psalm)
+        if rows is not None:
+            return rows
+        if psalm not in self._tables:
+            raise KeyError(psalm)
+        with self._lock:
+            rows = self._rows.get(psalm)
+            if rows is None:
+                # Jak w parse_docx_psalms_v2: wygrywa ostatnia niepusta tabela psalmu
+                with PARSE_SECONDS.time(format="docx_table"):
+                    rows_data = parse_table_rows(self._tables[psalm][-1])
+                rows = self._rows[psalm] = freeze(rows_data)
+                if len(self._rows) == len(self._tables):
+                    # Wszystko sparsowane - drzewo XML dokumentu nie jest już potrzebne
+                    self._tables = collections.OrderedDict((ps, None) for ps in self._tables)
+                    self._document = None
+        return rows
+
+    def __contains__(self, psalm):
+        return psalm in self._tables
+
+    def __iter__(self):
+        return iter(list(self._tables))
+
+    def __len__(self):
+        return len(self._tables)
+
+    @property
+    def materialized(self):
+        return len(self._rows)
+
+def freeze(obj):
+    # Niemutowalna kopia struktury: dict -> mappingproxy, list -> tuple
+    if isinstance(obj, dict):
+        return types.MappingProxyType({k: freeze(v) for k, v in obj.items()})
+    if isinstance(obj, (list, tuple)):
+        return tuple(freeze(v) for v in obj)
+    return obj
+
+class DocumentParse:
+    """Otwieranie dokumentu w wątku w tle.
+
+    Wczytanie XML i skan nagłówków tabel nie blokują interfejsu; do tego czasu
+    snapshot() zwraca pusty dokument. Po zakończeniu on_done(digest, dokument)
+    dostaje gotowy LazyDocument.
+    """
+
+    EMPTY = types.MappingProxyType({})
+
+    def __init__(self, digest, file_bytes, on_done=None):
+        self.digest = digest
+        self.error = None
+        self._file_bytes = file_bytes
+        self._on_done = on_done
+        self._document = None
+        self._finished = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="docx-parse", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    @property
+    def done(self):
+        return self._finished.is_set()
+
+    def snapshot(self):
+        return self._document if self._document is not None else self.EMPTY
+
+    def wait(self, timeout=None):
+        return self._finished.wait(timeout)
+
+    def _run(self):
+        try:
+            self._document = LazyDocument(self._file_bytes)
+            if self._on_done is not None:
+                self._on_done(self.digest, self._document)
+        except Exception as e:
+            self.error = e
+        finally:
+            self._file_bytes = None
+            self._finished.set()
+
+class SharedDocumentStore:
+    """Sparsowane dokumenty współdzielone przez wszystkie sesje procesu.
+
+    Każdy dokument jest przechowywany raz, jako obiekt niemutowalny, pod skrótem
+    zawartości pliku. Sesje trzymają tylko referencję - bez kopiowania i bez pickle.
+    Dokument to LazyDocument (wiersze parsowane przy pierwszym użyciu psalmu) albo,
+    dla plików parsowanych w puli procesów, zamrożony słownik.
+    """
+
+    def __init__(self, max_documents=16):
+        self.max_documents = max_documents
+        self._documents = collections.OrderedDict()
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def get(self, digest):
+        with self._lock:
+            doc = self._documents.get(digest)
+            if doc is not None:
+                self._documents.move_to_end(digest)
+            return doc
+
+    def get_or_parse(self, digest, file_bytes):
+        doc = self.get(digest)
+        cache_lookup("documents", doc is not None)
+        if doc is not None:
+            return doc
+        return self._add(digest, LazyDocument(file_bytes))
+
+    def get_or_parse_many(self, files, executor=None):
+        """Dokumenty dla {skrót: bajty}; brakujące parsowane równolegle w executor (np. pula procesów).
+
+        Dokumenty już obecne w magazynie nie są parsowane ponownie.
+        """
+        docs = {}
+        futures = {}
+        for digest, file_bytes in files.items():
+            doc = self.get(digest)
+            if doc is not None:
+                cache_lookup("documents", True)
+                docs[digest] = doc
+            elif digest not in futures and executor is not None:
+                cache_lookup("documents", False)
+                futures[digest] = executor.submit(parse_docx_psalms_v2, file_bytes)
+            elif digest not in futures:
+                docs[digest] = self.get_or_parse(digest, file_bytes)
+        for digest, future in futures.items():
+            docs[digest] = self._add(digest, freeze(future.result()))
+        return docs
+
+    def get_or_start_parse(self, digest, file_bytes):
+        """Zwraca (dokument, None), gdy jest gotowy, albo (None, DocumentParse) w trakcie parsowania.
+
+        Sesje, które wgrały ten sam plik, dzielą jedno parsowanie w tle.
+        """
+        with self._lock:
+            doc = self._documents.get(digest)
+            cache_lookup("documents", doc is not None)
+            if doc is not None:
+                self._documents.move_to_end(digest)
+                return doc, None
+            parse = self._pending.get(digest)
+            if parse is None:
+                # Nieudane parsowanie zostaje w _pending, żeby każda sesja zobaczyła ten sam błąd
+                parse = self._pending[digest] = DocumentParse(digest, file_bytes, on_done=self._parsed).start()
+            return None, parse
+
+    def _parsed(self, digest, doc):
+        self._add(digest, doc)
+        with self._lock:
+            self._pending.pop(digest, None)
+
+    def _add(self, digest, doc):
+        with self._lock:
+            # Inna sesja mogła sparsować ten sam plik w międzyczasie - zostaje pierwsza kopia
+            doc = self._documents.setdefault(digest, doc)
+            self._documents.move_to_end(digest)
+            while len(self._documents) > self.max_documents:
+                self._documents.popitem(last=False)
+        return doc
+
+def build_corpus(documents):
+    """Korpus z wielu dokumentów {nazwa: dokument} -> {(nazwa, psalm): wiersze}.
+
+    Ten sam psalm z różnych wydań stoi obok siebie, w kolejności dokumentów.
+    """
+    order = {name: i for i, name in enumerate(documents)}
+    entries = [((name, ps), rows) for name, doc in documents.items() for ps, rows in doc.items()]
+    entries.sort(key=lambda e: (natural_sort_key(e[0][1]), order[e[0][0]]))
+    return types.MappingProxyType(dict(entries))
+
+def corpus_label(document, psalm):
+    return f"{psalm} ({document})"
+
+def corpus_by_label(corpus):
+    # Widok z nazwami tekstowymi dla interfejsu, tytułów i nazw plików eksportu
+    return types.MappingProxyType({corpus_label(name, ps): rows for (name, ps), rows in corpus.items()})
+
+# ==========================================
+# 2. BLOKI I WIDOKI
+# ==========================================
+
+def build_blocks(rows):
+    # Zbieramy ID w kolejności ich pierwszego wystąpienia w tabeli
+    ordered_ids = []
+    seen_ids = set()
+    for row in rows:
+        for col in ["A", "B", "C"]:
+            for uid in row[col]["ids"]:
+                if uid not in seen_ids:
+                    ordered_ids.append(uid)
+                    seen_ids.add(uid)
+
+    if not ordered_ids:
+        sorted_ids = [str(i) for i in range(1, len(rows) + 1)]
+        id_to_index = {uid: i for i, uid in enumerate(sorted_ids)}
+        blocks = {c: [] for c in ["A", "B", "C"]}
+        for i, row in enumerate(rows, start=1):
+            uid = str(i)
+            for c in ["A", "B", "C"]:
+                blocks[c].append({"ids": [uid], "marker": row[c]["marker"], "text": row[c]["text"]})
+        return sorted_ids, blocks, id_to_index
+
+    # Zachowujemy kolejność z tabeli, nie sortujemy alfabetycznie
+    sorted_ids = ordered_ids
+    id_to_index = {uid: i for i, uid in enumerate(sorted_ids)}
+
+    blocks = {c: [] for c in ["A", "B", "C"]}
+    seen = set()
+
+    for row in rows:
+        for c in ["A", "B", "C"]:
+            ids = row[c]["ids"]
+            if not ids: continue
+            txt = (row[c]["text"] or "").strip()
+            marker = (row[c]["marker"] or "").strip()
+            
+            sig = (c, tuple(ids), marker, txt)
+            if sig in seen: continue
+            seen.add(sig)
+            
+            blocks[c].append({"ids": ids, "marker": marker, "text": txt})
+
+    return sorted_ids, blocks, id_to_index
+
+def expand_ids_by_merges(target_ids, blocks):
+    target_ids = set(target_ids)
+    changed = True
+    while changed:
+        changed = False
+        for c in ["A", "B", "C"]:
+            for b in blocks[c]:
+                b_ids = set(b["ids"])
+                if b_ids & target_ids:
+                    new_set = target_ids | b_ids
+                    if len(new_set) != len(target_ids):
+                        target_ids = new_set
+                        changed = True
+    return target_ids
+
+def merge_components(sorted_ids, blocks):
+    # Grupy ID połączone scaleniami (jak w expand_ids_by_merges), w kolejności z tabeli
+    components = []
+    processed = set()
+    for uid in sorted_ids:
+        if uid in processed:
+            continue
+        target_set = expand_ids_by_merges([uid], blocks)
+        processed |= target_set
+        components.append([i for i in sorted_ids if i in target_set])
+    return components
+
+def paginate_components(components, rows_per_page):
+    # Strony po ~rows_per_page wierszy; grupa scalonych ID nigdy nie jest dzielona
+    pages = []
+    current = []
+    for comp_ids in components:
+        if current and len(current) + len(comp_ids) > rows_per_page:
+            pages.append(current)
+            current = []
+        current.extend(comp_ids)
+    if current:
+        pages.append(current)
+    return pages
+
+def select_view(rows, selected_ids=None):
+    # Widok ograniczony do wybranych ID (rozszerzonych o scalenia); bez wyboru - cały psalm
+    sorted_ids, blocks, _ = build_blocks(rows)
+    if selected_ids:
+        expanded = expand_ids_by_merges(set(selected_ids), blocks)
+        view_ids = [i for i in sorted_ids if i in expanded]
+        blocks_view = {c: [b for b in blocks[c] if set(b["ids"]) & expanded] for c in ["A", "B", "C"]}
+    else:
+        view_ids, blocks_view = sorted_ids, blocks
+    id_to_index_view = {uid: i for i, uid in enumerate(view_ids)}
+    return view_ids, blocks_view, id_to_index_view
+
+def build_chart_plan(psalms_dict, psalm_names):
+    # Plan eksportu: jeden wykres na każdą grupę scalonych ID, w kolejności z tabeli
+    plan = []
+    for p_name in psalm_names:
+        sorted_ids, blocks, _ = build_blocks(psalms_dict[p_name])
+        for chart_idx, view_ids in enumerate(merge_components(sorted_ids, blocks)):
+            ids_str = "-".join(view_ids)
+            plan.append({
+                "psalm": p_name,
+                "view_ids": view_ids,
+                "ids": ids_str,
+                "label": f"{p_name} ({ids_str})",
+                "is_first": chart_idx == 0
+            })
+    return plan
+
+# ==========================================
+# 2a. RÓŻNICE SŁÓW MIĘDZY ŹRÓDŁAMI
+# ==========================================
+# Źródła czytamy chronologicznie: A (1571) -> B (1592) -> C (1611). Słowo nowe względem
+# poprzedniego wydania to "insert", zmienione - "replace", usunięte w następnym - "delete".
+DIFF_EQUAL, DIFF_INSERT, DIFF_REPLACE, DIFF_DELETE = "equal", "insert", "replace", "delete"
+DIFF_CACHE_SIZE = 8192
+# Kolory podświetleń w kartach i margines podświetlenia wokół słowa (pt)
+DIFF_COLORS = {DIFF_INSERT: "#BBF7D0", DIFF_REPLACE: "#FDE68A", DIFF_DELETE: "#FECACA"}
+DIFF_PAD_PT = 1.0
+_NON_WORD = re.compile(r"\W+")
+
+def word_key(word):
+    # Porównujemy bez wielkości liter i interpunkcji ("Domine," == "domine")
+    return _NON_WORD.sub("", word.casefold()) or word
+
+@functools.lru_cache(maxsize=DIFF_CACHE_SIZE)
+def diff_words(old_text, new_text):
+    """Dopasowanie słów dwóch tekstów. Wynik: (znaczniki słów old_text, znaczniki słów new_text).
+
+    Słowa to kolejne elementy text.split(). Pamięć LRU (kluczem są same teksty) jest wspólna dla procesu.
+    """
+    old_words, new_words = old_text.split(), new_text.split()
+    # Słowa zamienione na liczby - SequenceMatcher porównuje wtedy inty, a nie napisy
+    vocab = {}
+    old_seq = [vocab.setdefault(word_key(w), len(vocab)) for w in old_words]
+    new_seq = [vocab.setdefault(word_key(w), len(vocab)) for w in new_words]
+    old_tags = [DIFF_EQUAL] * len(old_words)
+    new_tags = [DIFF_EQUAL] * len(new_words)
+    for op, o0, o1, n0, n1 in difflib.SequenceMatcher(None, old_seq, new_seq, autojunk=False).get_opcodes():
+        if op in ("replace", "delete"):
+            old_tags[o0:o1] = [DIFF_REPLACE if op == "replace" else DIFF_DELETE] * (o1 - o0)
+        if op in ("replace", "insert"):
+            new_tags[n0:n1] = [DIFF_REPLACE if op == "replace" else DIFF_INSERT] * (n1 - n0)
+    return tuple(old_tags), tuple(new_tags)
+
+def diff_blocks(sorted_ids, blocks):
+    """Znaczniki różnic dla słów każdego bloku: {(kolumna, indeks bloku): krotka znaczników}.
+
+    Porównujemy całe grupy scalonych ID (teksty bloków kolumny sklejone w kolejności), więc
+    przesunięcie granicy scalenia między źródłami nie udaje różnicy.
+    """
+    marks = {}
+    for component in merge_components(sorted_ids, blocks):
+        ids = set(component)
+        members = {c: [i for i, b in enumerate(blocks[c]) if ids & set(b["ids"])] for c in "ABC"}
+        texts = {c: " ".join(blocks[c][i].get("text", "") for i in members[c]) for c in "ABC"}
+        tags_a, tags_b_new = diff_words(texts["A"], texts["B"])
+        tags_b_old, tags_c = diff_words(texts["B"], texts["C"])
+        # Słowo B: najpierw zmiana względem A, a gdy jej nie ma - los w C
+        tags_b = tuple(new if new != DIFF_EQUAL else old for new, old in zip(tags_b_new, tags_b_old))
+        for c, tags in (("A", tags_a), ("B", tags_b), ("C", tags_c)):
+            pos = 0
+            for i in members[c]:
+                n = len(blocks[c][i].get("text", "").split())
+                marks[(c, i)] = tags[pos:pos + n]
+                pos += n
+    return marks
+
+# ==========================================
+# TEKST: METRYKI CZCIONKI I ŁAMANIE WIERSZY
+# ==========================================
+CARD_FONT = "DejaVu Serif"
+# Znaki, dla których szerokości liczymy z góry (Latin-1 + Latin Extended-A); reszta - przy pierwszym użyciu
+PRECOMPUTED_GLYPHS = [chr(c) for c in range(32, 0x180) if not 0x7F <= c < 0xA0]
+WRAP_CACHE_SIZE = 8192
+
+_font_lock = threading.Lock()
+
+@functools.lru_cache(maxsize=None)
+def _card_font():
+    return ft2font.FT2Font(font_manager.findfont(FontProperties(family=CARD_FONT)))
+
+class GlyphMetrics:
+    """Szerokości glifów (w punktach) czcionki kart dla jednego rozmiaru.
+
+    Używamy szerokości bez hintingu - nie zależą od DPI i pokrywają się z renderem
+    Agg przy rozdzielczościach podglądu i eksportu (200-300 DPI).
+    """
+
+    def __init__(self, font_size):
+        self.font_size = font_size
+        self.advances = {}
+        self.kerning = {}
+        with _font_lock:
+            font = _card_font()
+            font.set_size(font_size, 72)
+            for ch in PRECOMPUTED_GLYPHS:
+                self.advances[ch] = self._measure_char(font, ch)
+            font.set_text("lp", 0.0, flags=_NO_HINTING)
+            lp_h = font.get_width_height()[1] / 64
+            lp_d = font.get_descent() / 64
+        # Odstęp między liniami tak, jak liczy go matplotlib dla tekstu wielowierszowego
+        self.ascent = lp_h - lp_d
+        self.lp_height = lp_h
+
+    @staticmethod
+    def _measure_char(font, ch):
+        return font.load_char(ord(ch), flags=_NO_HINTING).linearHoriAdvance / 65536
+
+    def advance(self, ch):
+        width = self.advances.get(ch)
+        if width is None:
+            with _font_lock:
+                font = _card_font()
+                font.set_size(self.font_size, 72)
+                width = self.advances[ch] = self._measure_char(font, ch)
+        return width
+
+    def word_width(self, word):
+        width = 0.0
+        prev = None
+        for ch in word:
+            width += self.advance(ch)
+            if prev is not None:
+                width += self._kern(prev, ch)
+            prev = ch
+        return width
+
+    def _kern(self, left, right):
+        pair = (left, right)
+        k = self.kerning.get(pair)
+        if k is None:
+            with _font_lock:
+                font = _card_font()
+                font.set_size(self.font_size, 72)
+                k = font.get_kerning(font.get_char_index(ord(left)), font.get_char_index(ord(right)), _KERNING_DEFAULT) / 64
+            self.kerning[pair] = k
+        return k
+
+    def line_pitch(self, linespacing):
+        return self.ascent * linespacing
+
+    def block_height(self, n_lines, linespacing):
+        return (n_lines - 1) * self.line_pitch(linespacing) + self.lp_height
+
+    def measure(self, n_chars):
+        # Szerokość "n znaków" liczona średnią szerokością małych liter łacińskich
+        lowercase = "abcdefghijklmnopqrstuvwxyz"
+        return n_chars * sum(self.advance(ch) for ch in lowercase) / len(lowercase)
+
+@functools.lru_cache(maxsize=32)
+def glyph_metrics(font_size):
+    return GlyphMetrics(font_size)
+
+# Zakres suwaka "Rozmiar Czcionki" w app.py
+WARM_FONT_SIZES = tuple(range(6, 17))
+
+def warm_font_cache(font_sizes=WARM_FONT_SIZES):
+    """Liczy metryki DejaVu i ładuje czcionki (zwykłą i pogrubioną) przed pierwszym wykresem.
+
+    Wołane w tle przy starcie aplikacji (PRELOAD_MODULES); metryki żyją w pamięci procesu.
+    Listę czcionek matplotlib (fontlist w MPLCONFIGDIR) buduje już obraz Dockera.
+    """
+    for size in font_sizes:
+        glyph_metrics(size)
+    fig = reuse_figure(None, (2, 1))
+    try:
+        for family in ("DejaVu Sans", CARD_FONT):
+            for weight in ("normal", "bold"):
+                fig.text(0.5, 0.5, "Ps 1 ąę", fontfamily=family, fontweight=weight)
+        fig.canvas.draw()
+    finally:
+        release_figure(fig)
+
+def _break_long_word(word, width_pt, metrics):
+    parts = []
+    current = ""
+    for ch in word:
+        if current and metrics.word_width(current + ch) > width_pt:
+            parts.append(current)
+            current = ch
+        else:
+            current += ch
+    if current:
+        parts.append(current)
+    return parts
+
+@functools.lru_cache(maxsize=WRAP_CACHE_SIZE)
+def wrap_text_to_width(text, width_pt, font_size):
+    """Łamie tekst tak, by żadna linia nie przekroczyła width_pt punktów. Wynik: krotka linii.
+
+    Pamięć podręczna LRU jest wspólna dla wszystkich renderów w procesie.
+    """
+    metrics = glyph_metrics(font_size)
+    space = metrics.advance(" ")
+    lines = []
+    for para in (text or "").split("\n"):
+        words = para.split()
+        if not words:
+            continue
+        current, current_w = [], 0.0
+        for word in words:
+            word_w = metrics.word_width(word)
+            if word_w > width_pt:
+                # Słowo szersze niż kolumna - dzielimy je na kawałki
+                pieces = _break_long_word(word, width_pt, metrics)
+                if current:
+                    lines.append(" ".join(current))
+                lines.extend(pieces[:-1])
+                current, current_w = [pieces[-1]], metrics.word_width(pieces[-1])
+                continue
+            needed = word_w if not current else current_w + space + word_w
+            if current and needed > width_pt:
+                lines.append(" ".join(current))
+                current, current_w = [word], word_w
+            else:
+                current.append(word)
+                current_w = needed
+        if current:
+            lines.append(" ".join(current))
+    return tuple(lines)
+
+@functools.lru_cache(maxsize=32)
+def text_line_layout(font_size, linespacing):
+    """(wysokość pierwszej linii, odstęp kolejnych linii) w punktach - tak, jak układa je matplotlib.
+
+    Mierzone raz na rozmiar na rzeczywistym rendererze; wersje matplotlib różnią się tu wzorem.
+    """
+    fig = reuse_figure(None, (2, 2))
+    try:
+        renderer = fig.canvas.get_renderer()
+        heights = [
+            fig.text(0, 0, "\n".join(["lp"] * n), fontsize=font_size, fontfamily=CARD_FONT,
+                     linespacing=linespacing).get_window_extent(renderer).height * 72 / fig.dpi
+            for n in (1, 2)
+        ]
+    finally:
+        release_figure(fig)
+    return heights[0], heights[1] - heights[0]
+
+def word_spans(text, lines, metrics):
+    """Położenie słów text.split() w liniach z wrap_text_to_width: lista (indeks słowa, nr linii, x0, x1) w punktach.
+
+    Słowo podzielone przez _break_long_word daje kilka odcinków z tym samym indeksem.
+    """
+    words = (text or "").split()
+    spans = []
+    word_idx, consumed = 0, 0
+    space = metrics.advance(" ")
+    for line_no, line in enumerate(lines):
+        x = 0.0
+        for part in line.split(" "):
+            if word_idx >= len(words):
+                return spans
+            width = metrics.word_width(part)
+            spans.append((word_idx, line_no, x, x + width))
+            x += width + space
+            consumed += len(part)
+            if consumed >= len(words[word_idx]):
+                word_idx, consumed = word_idx + 1, 0
+    return spans
+
+def _lru_cache_requests():
+    wrap, diff = wrap_text_to_width.cache_info(), diff_words.cache_info()
+    return {("wrap", "hit"): wrap.hits, ("wrap", "miss"): wrap.misses,
+            ("diff", "hit"): diff.hits, ("diff", "miss"): diff.misses}
+
+REGISTRY.function("filigran_lru_cache_requests_total", "Zapytania do pamięci LRU łamania tekstu i różnic słów.",
+                  _lru_cache_requests, ("cache", "result"), kind="counter")
+
+# ==========================================
+# 3. SILNIK GRAFICZNY (FINALNY)
+# ==========================================
+def draw_pretty_sankey_final(
+    title,
+    sorted_ids,
+    blocks,
+    id_to_index,
+    colors,
+    labels,
+    show_links=True,
+    link_color="#BFC5D2",
+    link_alpha=0.3,
+    font_size=10,
+    wrap_chars=40,
+    compact=False,
+    show_stripe=True,
+    ribbon_width_scale=0.4,
+    show_verse_nums=True,
+    show_ids=True,
+    show_row_ids_left=True,    
+    show_zebra=True,
+    badge_text_colors=("#FFFFFF", "#FFFFFF", "#FFFFFF"),
+    show_header=True,
+    show_diff=False,
+    fig=None
+):
+    t0 = time.perf_counter()
+    # Parametry układu
+    MIN_ROW_H = 1.2     
+    PADDING = 0.8       
+    GAP = 0.15 if compact else 0.22
+    LINESPACING = 1.35
+    FIG_W = 18
+
+    col_x = {"A": 0.0, "B": 1.55, "C": 3.10}
+    col_w = 1.30
+    stripe_w = 0.14 
+    text_margin_left = 0.08
+    text_margin_right = 0.06
+    
+    # Ustalanie marginesów na podstawie show_row_ids_left
+    x_min = -0.45 if show_row_ids_left else -0.10
+    x_max = 4.50
+
+    # Osie zajmują całą figurę, więc skala jest znana przed rysowaniem:
+    # poziomo FIG_W cali na zakres X, pionowo 1 jednostka = 1 cal (72 pt)
+    x_pt_per_unit = FIG_W * 72 / (x_max - x_min)
+    Y_PT_PER_UNIT = 72
+    text_left = (stripe_w if show_stripe else 0) + text_margin_left
+    metrics = glyph_metrics(font_size)
+    wrap_width_pt = min((col_w - text_left - text_margin_right) * x_pt_per_unit, metrics.measure(wrap_chars))
+
+    # 1. Łamanie tekstu - raz na blok, dokładnie wg szerokości glifów
+    wrapped_lines = {}
+    wrapped_blocks = {}
+    block_text_h = {}
+    for c in ["A", "B", "C"]:
+        for idx, b in enumerate(blocks[c]):
+            lines = wrap_text_to_width(b.get("text", ""), wrap_width_pt, font_size)
+            wrapped_lines[(c, idx)] = lines
+            wrapped_blocks[(c, idx)] = "\n".join(lines) if lines else "—"
+            block_text_h[(c, idx)] = metrics.block_height(max(1, len(lines)), LINESPACING) / Y_PT_PER_UNIT
+
+    # Wysokości slotów: blok scalony dzieli swoją wysokość tekstu między swoje ID,
+    # a kilka bloków jednej kolumny z tym samym ID dzieli jego slot (więc się sumują)
+    slot_heights = {}
+    needed = {uid: 0.0 for uid in sorted_ids}
+    for c in ["A", "B", "C"]:
+        column_need = collections.defaultdict(float)
+        for idx, b in enumerate(blocks[c]):
+            per_id = block_text_h[(c, idx)] / max(1, len(b["ids"]))
+            for uid in b["ids"]:
+                column_need[uid] += per_id
+        for uid, h in column_need.items():
+            if uid in needed and h > needed[uid]:
+                needed[uid] = h
+    for uid in sorted_ids:
+        slot_heights[uid] = max(MIN_ROW_H, needed[uid] + PADDING)
+    
+    # 2. Pozycje Y
+    y_positions = {} 
+    current_y = 0
+    for uid in sorted_ids:
+        h = slot_heights[uid]
+        y_top = current_y
+        y_bottom = current_y - h
+        y_positions[uid] = (y_top, y_bottom)
+        current_y = y_bottom - GAP
+    
+    total_height = abs(current_y)
+    
+    id_usage_map = {c: {} for c in ["A", "B", "C"]}
+    for c in ["A", "B", "C"]:
+        for idx, b in enumerate(blocks[c]):
+            for uid in b["ids"]:
+                if uid not in id_usage_map[c]:
+                    id_usage_map[c][uid] = []
+                id_usage_map[c][uid].append(idx)
+    
+    diff_marks = diff_blocks(sorted_ids, blocks) if show_diff else {}
+
+    t_layout = time.perf_counter()
+    RENDER_SECONDS.observe(t_layout - t0, chart="psalm", stage="layout")
+
+    # 3. Rysowanie (zakres Y osi: od current_y - 0.5 do 1.1)
+    fig_h = max(6, (total_height + 1.6) * Y_PT_PER_UNIT / 72)
+    fig = reuse_figure(fig, (FIG_W, fig_h))
+    ax = fig.add_axes([0, 0, 1, 1])
+    ax.set_facecolor("white")
+
+    # Tło i ID wierszy (lewa strona)
+    for i, uid in enumerate(sorted_ids):
+        y_top, y_bottom = y_positions[uid]
+        h = y_top - y_bottom
+        y_center = (y_top + y_bottom) / 2
+        
+        if show_zebra and i % 2 == 0:
+            ax.add_patch(mpatches.Rectangle(
+                (x_min, y_bottom - 0.02), x_max - x_min, h + 0.04,
+                facecolor=mcolors.to_rgba("#111827", 0.03), edgecolor=None, zorder=0
+            ))
+        
+        # Oznaczenia wierszy (duże litery K, M...) tylko jeśli włączone
+        if show_row_ids_left:
+            ax.text(-0.15, y_center, uid,
+                    ha="right", va="center", fontsize=12, fontweight="bold", color="#111827")
+
+    # Nagłówki (opcjonalne)
+    if show_header:
+        center_x = col_x["B"] + col_w / 2
+        ax.text(center_x, 0.8, title, ha="center", va="center", fontsize=18, fontweight="bold", color="#111827")
+        for c, lab in zip(["A", "B", "C"], labels):
+            ax.text(col_x[c] + col_w / 2, 0.35, lab, ha="center", va="center", fontsize=12, fontweight="bold", color="#111827")
+
+    anchors = {c: {} for c in ["A", "B", "C"]}
+    # Artyści zależni tylko od kolorów - restyle_sankey() zmienia je bez ponownego układu
+    style_artists = {"stripe": {c: [] for c in "ABC"}, "badge": {c: [] for c in "ABC"}, "ids": {c: [] for c in "ABC"}, "link": []}
+    # Podświetlenia różnic zbierane ze wszystkich kart - jedna kolekcja na rodzaj zmiany
+    diff_polys = {tag: [] for tag in DIFF_COLORS}
+
+    def add_diff_highlights(c, block_idx, text_x, text_center_y):
+        tags = diff_marks.get((c, block_idx))
+        if not tags or all(t == DIFF_EQUAL for t in tags):
+            return
+        lines = wrapped_lines[(c, block_idx)]
+        first_h, pitch = (v / Y_PT_PER_UNIT for v in text_line_layout(font_size, LINESPACING))
+        text_top = text_center_y + (first_h + (len(lines) - 1) * pitch) / 2
+        # Podświetlenie na wysokość glifów, wyśrodkowane w linii (bez interlinii)
+        line_h = min(metrics.lp_height / Y_PT_PER_UNIT, first_h)
+        inset = (first_h - line_h) / 2
+        pad = DIFF_PAD_PT / x_pt_per_unit
+        for word_idx, line_no, x0, x1 in word_spans(blocks[c][block_idx].get("text", ""), lines, metrics):
+            tag = tags[word_idx] if word_idx < len(tags) else DIFF_EQUAL
+            if tag == DIFF_EQUAL:
+                continue
+            top = text_top - line_no * pitch - inset
+            left, right = text_x + x0 / x_pt_per_unit - pad, text_x + x1 / x_pt_per_unit + pad
+            diff_polys[tag].append(((left, top - line_h), (right, top - line_h), (right, top), (left, top)))
+
+    def draw_card(c, block_idx, ids, marker):
+        indices = [id_to_index[i] for i in ids if i in id_to_index]
+        if not indices: return
+
+        valid_ids = [i for i in ids if i in y_positions]
+        if not valid_ids: return
+        
+        # Slicing Logic
+        first_id = valid_ids[0]
+        usage_list_top = id_usage_map[c].get(first_id, [])
+        y_global_top, y_global_bottom_top = y_positions[first_id]
+        
+        if len(usage_list_top) > 1:
+            usage_list_top.sort()
+            my_rank = usage_list_top.index(block_idx)
+            count = len(usage_list_top)
+            seg_h = (y_global_top - y_global_bottom_top) / count
+            card_y_top = y_global_top - (my_rank * seg_h)
+        else:
+            card_y_top = y_global_top
+
+        last_id = valid_ids[-1]
+        usage_list_bot = id_usage_map[c].get(last_id, [])
+        y_global_top_bot, y_global_bottom_bot = y_positions[last_id]
+        
+        if len(usage_list_bot) > 1:
+            usage_list_bot.sort()
+            my_rank = usage_list_bot.index(block_idx)
+            count = len(usage_list_bot)
+            seg_h = (y_global_top_bot - y_global_bottom_bot) / count
+            card_y_bottom = y_global_top_bot - ((my_rank + 1) * seg_h)
+        else:
+            card_y_bottom = y_global_bottom_bot
+
+        VISUAL_GAP = 0.06
+        draw_y_top = card_y_top - VISUAL_GAP
+        draw_y_bottom = card_y_bottom + VISUAL_GAP
+        h = draw_y_top - draw_y_bottom
+        
+        if h < 0.2:
+            mid = (draw_y_top + draw_y_bottom) / 2
+            h = 0.2
+            draw_y_top = mid + 0.1
+            draw_y_bottom = mid - 0.1
+
+        base = colors[["A", "B", "C"].index(c)]
+        badge_txt_color = badge_text_colors[["A", "B", "C"].index(c)]
+        x = col_x[c]
+
+        # Kształty
+        ax.add_patch(mpatches.FancyBboxPatch(
+            (x + 0.02, draw_y_bottom - 0.02), col_w, h,
+            boxstyle="round,pad=0.03,rounding_size=0.12",
+            linewidth=0, facecolor=(0, 0, 0, 0.08), zorder=2
+        ))
+        card_shape = mpatches.FancyBboxPatch(
+            (x, draw_y_bottom), col_w, h,
+            boxstyle="round,pad=0.03,rounding_size=0.12",
+            linewidth=0, facecolor="white", zorder=3
+        )
+        ax.add_patch(card_shape)
+
+        # Pasek
+        if show_stripe:
+            stripe = mpatches.Rectangle(
+                (x - 0.05, draw_y_bottom - 0.05), stripe_w + 0.05, h + 0.1,
+                facecolor=base, zorder=4
+            )
+            stripe.set_clip_path(card_shape)
+            ax.add_patch(stripe)
+            style_artists["stripe"][c].append(stripe)
+            content_start_x = x + stripe_w + text_margin_left
+        else:
+            content_start_x = x + text_margin_left
+
+        id_label = ", ".join(ids)
+        
+        # Oblicz środek karty w pionie
+        card_center_y = (draw_y_top + draw_y_bottom) / 2
+        
+        # --- MARKER NA KOLOROWYM PASKU (wyśrodkowany) ---
+        if show_stripe and show_verse_nums and marker:
+            # Środek paska - lekko przesunięty w lewo od środka geometrycznego
+            stripe_center_x = x + stripe_w * 0.4
+            style_artists["badge"][c].append(ax.text(
+                stripe_center_x, card_center_y, marker,
+                ha="center", va="center", fontsize=10, fontweight="bold", color=badge_txt_color,
+                zorder=5, rotation=0
+            ))
+
+        # Ramka
+        ax.add_patch(mpatches.FancyBboxPatch(
+            (x, draw_y_bottom), col_w, h,
+            boxstyle="round,pad=0.03,rounding_size=0.12",
+            linewidth=1, edgecolor="#E5E7EB", facecolor="none", zorder=6
+        ))
+
+        # --- ID I TEKST ---
+        body = wrapped_blocks[(c, block_idx)]
+        if diff_marks:
+            add_diff_highlights(c, block_idx, content_start_x, card_center_y)
+        
+        if show_ids:
+            # ID wyświetlane nad wyśrodkowanym tekstem
+            # ID w lewym górnym rogu
+            style_artists["ids"][c].append(ax.text(
+                content_start_x, draw_y_top - 0.08, id_label,
+                ha='left', va='top', 
+                fontsize=9, fontweight='bold', color=base,
+                zorder=5, fontfamily="DejaVu Serif"
+            ))
+            # Tekst wyśrodkowany w pionie (przesunięty lekko w dół przez ID)
+            ax.text(
+                content_start_x, card_center_y, body,
+                ha='left', va='center', fontsize=font_size, color="#0B1220", 
+                zorder=5, fontfamily="DejaVu Serif", linespacing=LINESPACING, clip_on=True
+            )
+        else:
+            # ID niewyświetlane - tekst wyśrodkowany w pionie
+            ax.text(
+                content_start_x, card_center_y, body,
+                ha='left', va='center', fontsize=font_size, color="#0B1220", 
+                zorder=5, fontfamily="DejaVu Serif", linespacing=LINESPACING, clip_on=True
+            )
+
+        # Kotwice
+        block_ids_sorted = sorted([i for i in ids if i in id_to_index], key=lambda x: id_to_index[x])
+        if block_ids_sorted:
+            segment_height = h / len(block_ids_sorted)
+            for idx, uid in enumerate(block_ids_sorted):
+                seg_y_center = draw_y_top - (idx * segment_height) - (segment_height / 2)
+                
+                if uid not in anchors[c]: anchors[c][uid] = []
+                anchors[c][uid].append({
+                    "left": (x, seg_y_center), 
+                    "right": (x + col_w, seg_y_center), 
+                    "height": segment_height
+                })
+
+    for c in ["A", "B", "C"]:
+        for idx, b in enumerate(blocks[c]):
+            draw_card(c, idx, b["ids"], b.get("marker", ""))
+
+    for tag, polys in diff_polys.items():
+        if polys:
+            ax.add_collection(PolyCollection(polys, facecolors=DIFF_COLORS[tag], edgecolors="none", zorder=4.5))
+
+    def draw_ribbon_sigmoid(n_src, n_dst, color, alpha):
+        x_src, y_src = n_src['right']
+        x_dst, y_dst = n_dst['left']
+        h_src = n_src.get('height', 0.5)
+        h_dst = n_dst.get('height', 0.5)
+        ribbon_h = min(h_src, h_dst) * ribbon_width_scale
+        x = np.linspace(x_src, x_dst, 150)
+        sigmoid = 1 / (1 + np.exp(-12 * (x - (x_src + x_dst) / 2) / (x_dst - x_src)))
+        y = y_src + (y_dst - y_src) * sigmoid
+        style_artists["link"].append(ax.fill_between(x, y - ribbon_h/2, y + ribbon_h/2, color=color, alpha=alpha, zorder=1, edgecolor=None))
+
+    if show_links:
+        for uid in sorted_ids:
+            if uid in anchors["A"] and uid in anchors["B"]:
+                for start in anchors["A"][uid]:
+                    for end in anchors["B"][uid]: draw_ribbon_sigmoid(start, end, link_color, link_alpha)
+            if uid in anchors["B"] and uid in anchors["C"]:
+                for start in anchors["B"][uid]:
+                    for end in anchors["C"][uid]: draw_ribbon_sigmoid(start, end, link_color, link_alpha)
+
+    ax.set_xlim(x_min, x_max)
+    ax.set_ylim(current_y - 0.5, 1.1)
+    ax.axis("off")
+
+    # Granice między wierszami (środek odstępu) - miejsca, w których wolno ciąć eksport na strony.
+    # "Czyste" granice to te, przez które nie przechodzi żadna scalona karta.
+    spanned = set()
+    for c in ["A", "B", "C"]:
+        for b in blocks[c]:
+            positions = [id_to_index[i] for i in b["ids"] if i in id_to_index]
+            if positions:
+                spanned.update(range(min(positions), max(positions)))
+    fig.row_boundaries = [y_positions[uid][1] - GAP / 2 for uid in sorted_ids[:-1]]
+    fig.clean_row_boundaries = [y for i, y in enumerate(fig.row_boundaries) if i not in spanned]
+    fig.style_artists = style_artists
+    fig.chart_style = {"colors": tuple(colors), "link_color": link_color, "link_alpha": link_alpha, "badge_text_colors": tuple(badge_text_colors)}
+    RENDER_SECONDS.observe(time.perf_counter() - t_layout, chart="psalm", stage="draw")
+    RENDERS.inc(chart="psalm")
+    return fig
+
+# Parametry, które zmieniają tylko kolory (nie układ) - wystarczy restyle_sankey()
+STYLE_ONLY_PARAMS = ("colors", "link_color", "link_alpha", "badge_text_colors")
+
+def split_chart_style(style):
+    # (parametry układu, parametry kolorów)
+    layout = {k: v for k, v in style.items() if k not in STYLE_ONLY_PARAMS}
+    return layout, {k: v for k, v in style.items() if k in STYLE_ONLY_PARAMS}
+
+def restyle_sankey(fig, colors=None, link_color=None, link_alpha=None, badge_text_colors=None):
+    """Zmienia kolory gotowego wykresu z draw_pretty_sankey_final w miejscu (bez łamania tekstu i układu)."""
+    current = fig.chart_style
+    if colors is not None and tuple(colors) != current["colors"]:
+        for c, base in zip("ABC", colors):
+            for artist in fig.style_artists["stripe"][c]:
+                artist.set_facecolor(base)
+            for artist in fig.style_artists["ids"][c]:
+                artist.set_color(base)
+        current["colors"] = tuple(colors)
+    if badge_text_colors is not None and tuple(badge_text_colors) != current["badge_text_colors"]:
+        for c, color in zip("ABC", badge_text_colors):
+            for artist in fig.style_artists["badge"][c]:
+                artist.set_color(color)
+        current["badge_text_colors"] = tuple(badge_text_colors)
+    if (link_color is not None and link_color != current["link_color"]) or (link_alpha is not None and link_alpha != current["link_alpha"]):
+        current["link_color"] = link_color if link_color is not None else current["link_color"]
+        current["link_alpha"] = link_alpha if link_alpha is not None else current["link_alpha"]
+        for artist in fig.style_artists["link"]:
+            artist.set_facecolor(current["link_color"])
+            artist.set_alpha(current["link_alpha"])
+    return fig
+
+class _CachedChart:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.fig = None
+        self.bbox = None        # obrys "tight" - kolory go nie zmieniają, więc liczony raz
+        self.evicted = False
+
+class SankeyChartCache:
+    """Gotowe wykresy (figury z artystami) dla ostatnich widoków, wspólne dla procesu.
+
+    Klucz to widok + parametry układu; zmiana samych kolorów (STYLE_ONLY_PARAMS)
+    trafia w ten sam wpis i tylko przemalowuje istniejących artystów.
+    """
+
+    def __init__(self, max_charts=6):
+        self.max_charts = max_charts
+        self._charts = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @contextlib.contextmanager
+    def _checkout(self, view_key, style, build):
+        layout, colors = split_chart_style(style)
+        key = (view_key, tuple(sorted(layout.items())))
+        evicted = []
+        with self._lock:
+            entry = self._charts.get(key)
+            if entry is None:
+                entry = self._charts[key] = _CachedChart()
+            self._charts.move_to_end(key)
+            while len(self._charts) > self.max_charts:
+                evicted.append(self._charts.popitem(last=False)[1])
+        for old in evicted:
+            with old.lock:
+                old.evicted = True
+                release_figure(old.fig)
+                old.fig = None
+
+        with entry.lock:
+            cache_lookup("charts", entry.fig is not None)
+            if entry.fig is None:
+                self.misses += 1
+                entry.fig = build(**style)
+                entry.bbox = None
+                keep_figure(entry.fig)
+            else:
+                self.hits += 1
+                restyle_sankey(entry.fig, **colors)
+            try:
+                yield entry
+            finally:
+                if entry.evicted:
+                    # Wpis usunięty w trakcie rysowania - figura nie ma już właściciela
+                    release_figure(entry.fig)
+                    entry.fig = None
+
+    @contextlib.contextmanager
+    def chart(self, view_key, style, build):
+        """Daje figurę z bieżącymi kolorami; build(**style) rysuje ją od zera przy braku w pamięci.
+
+        Figura jest zablokowana do końca bloku - rasteryzuj ją w środku, nie przechowuj.
+        """
+        with self._checkout(view_key, style, build) as entry:
+            yield entry.fig
+
+    def png(self, view_key, style, build, dpi):
+        with self._checkout(view_key, style, build) as entry:
+            if entry.bbox is None:
+                entry.bbox = entry.fig.get_tightbbox(entry.fig.canvas.get_renderer()).padded(0.1)
+            return figure_to_png(entry.fig, dpi, bbox=entry.bbox)
+
+    def clear(self):
+        with self._lock:
+            entries = list(self._charts.values())
+            self._charts.clear()
+        for entry in entries:
+            with entry.lock:
+                entry.evicted = True
+                release_figure(entry.fig)
+                entry.fig = None
+
+def render_plan_chart(psalms_dict, chart, title_override, labels, style, charts_with_legend, fig=None):
+    # Jeden wykres z planu eksportu; wszystkie parametry jawnie, więc można go wołać z wątku w tle
+    p_name = chart["psalm"]
+    view_ids, blocks_view, id_to_index_view = select_view(psalms_dict[p_name], chart["view_ids"])
+    chart_title = title_override if title_override else f"{p_name} (ID: {', '.join(view_ids)})"
+    return draw_pretty_sankey_final(
+        title=chart_title,
+        sorted_ids=view_ids,
+        blocks=blocks_view,
+        id_to_index=id_to_index_view,
+        labels=labels,
+        show_header=chart["label"] in charts_with_legend,
+        fig=fig,
+        **style
+    )
+
+# Podnieść przy zmianie wyglądu wykresów w kodzie - stare manifesty przestaną pasować
+CHART_FORMAT_VERSION = 1
+
+def chart_content_hash(psalms_dict, chart, title_override, labels, style, charts_with_legend, export):
+    """Skrót wszystkiego, od czego zależą bajty PNG wykresu z planu (te same argumenty co render_plan_chart).
+
+    export: parametry zapisu (dpi, budżet pikseli, dzielenie na strony).
+    """
+    p_name = chart["psalm"]
+    view_ids, blocks_view, _ = select_view(psalms_dict[p_name], chart["view_ids"])
+    content = {
+        "version": [CHART_FORMAT_VERSION, matplotlib.__version__],
+        "title": title_override if title_override else f"{p_name} (ID: {', '.join(view_ids)})",
+        "header": chart["label"] in charts_with_legend,
+        "labels": list(labels),
+        "view_ids": view_ids,
+        "blocks": {c: [[list(b["ids"]), b.get("marker", ""), b.get("text", "")] for b in blocks_view[c]] for c in "ABC"},
+        "style": style,
+        "export": export,
+    }
+    return hashlib.sha256(json.dumps(content, sort_keys=True, ensure_ascii=False, default=list).encode("utf-8")).hexdigest()
+
+# ==========================================
+# MINIATURY (bez tekstu)
+# ==========================================
+THUMB_WIDTH_IN = 2.0
+THUMB_ROW_IN = 0.1
+THUMB_MAX_HEIGHT_IN = 3.0
+THUMB_DPI = 100
+
+def thumbnail_layout(rows):
+    """Uproszczony układ psalmu: każdy wiersz (ID) ma tę samą wysokość, karty i wstęgi bez tekstu.
+
+    Zwraca (liczba_wierszy, karty, wstęgi) z samych krotek liczb - da się wysłać do innego procesu.
+    Karta: (kolumna 0-2, góra, dół, scalona), wstęga: (kolumna źródła, y_źródła, y_celu, wysokość).
+    Osie: wiersz i zajmuje y od -i do -(i + 1).
+    """
+    sorted_ids, blocks, id_to_index = build_blocks(rows)
+    usage = {c: collections.defaultdict(list) for c in "ABC"}
+    for c in "ABC":
+        for idx, b in enumerate(blocks[c]):
+            for uid in b["ids"]:
+                usage[c][uid].append(idx)
+
+    cards = []
+    anchors = {c: collections.defaultdict(list) for c in "ABC"}
+    for col, c in enumerate("ABC"):
+        for idx, b in enumerate(blocks[c]):
+            ids = sorted((i for i in b["ids"] if i in id_to_index), key=id_to_index.get)
+            if not ids:
+                continue
+            # Kilka kart z tym samym ID w kolumnie dzieli jego wiersz (jak w pełnym wykresie)
+            first, last = ids[0], ids[-1]
+            top_share = usage[c][first]
+            top = -id_to_index[first] - top_share.index(idx) / len(top_share)
+            bottom_share = usage[c][last]
+            bottom = -id_to_index[last] - (bottom_share.index(idx) + 1) / len(bottom_share)
+            cards.append((col, top, bottom, len(b["ids"]) > 1))
+            seg = (top - bottom) / len(ids)
+            for k, uid in enumerate(ids):
+                anchors[c][uid].append((top - (k + 0.5) * seg, seg))
+
+    links = []
+    for col, (src, dst) in enumerate((("A", "B"), ("B", "C"))):
+        for uid in sorted_ids:
+            for y_src, h_src in anchors[src].get(uid, ()):
+                for y_dst, h_dst in anchors[dst].get(uid, ()):
+                    links.append((col, y_src, y_dst, min(h_src, h_dst) * 0.8))
+    return len(sorted_ids), tuple(cards), tuple(links)
+
+_THUMB_COL_X = (0.0, 1.55, 3.10)
+_THUMB_COL_W = 1.30
+_THUMB_SIGMOID = 1 / (1 + np.exp(-12 * (np.linspace(0, 1, 16) - 0.5)))
+
+def draw_sankey_thumbnail(layout, colors, link_color="#BFC5D2", link_alpha=0.3, fig=None):
+    n_rows, cards, links = layout
+    height = min(THUMB_MAX_HEIGHT_IN, max(0.6, n_rows * THUMB_ROW_IN + 0.1))
+    fig = reuse_figure(fig, (THUMB_WIDTH_IN, height))
+    ax = fig.add_axes([0, 0, 1, 1])
+    ax.axis("off")
+
+    # Wstęgi: sigmoida z 16 punktów, wszystkie w jednej kolekcji
+    ribbons = []
+    for col, y_src, y_dst, h in links:
+        x0 = _THUMB_COL_X[col] + _THUMB_COL_W
+        x = np.linspace(x0, _THUMB_COL_X[col + 1], 16)
+        y = y_src + (y_dst - y_src) * _THUMB_SIGMOID
+        ribbons.append(np.concatenate([np.column_stack([x, y + h / 2]), np.column_stack([x[::-1], y[::-1] - h / 2])]))
+    if ribbons:
+        ax.add_collection(PolyCollection(ribbons, facecolors=link_color, alpha=link_alpha, linewidths=0, zorder=1))
+
+    # Karty: pasek w kolorze kolumny, scalone karty z ciemniejszą ramką
+    rects = []
+    face = []
+    edge = []
+    for col, top, bottom, merged in cards:
+        x0, x1 = _THUMB_COL_X[col], _THUMB_COL_X[col] + _THUMB_COL_W
+        top, bottom = top - 0.06, bottom + 0.06
+        rects.append(((x0, bottom), (x0, top), (x1, top), (x1, bottom)))
+        face.append(colors[col])
+        edge.append("#111827" if merged else "#E5E7EB")
+    if rects:
+        ax.add_collection(PolyCollection(rects, facecolors=face, edgecolors=edge, linewidths=0.6, zorder=2))
+
+    ax.set_xlim(-0.1, _THUMB_COL_X[2] + _THUMB_COL_W + 0.1)
+    ax.set_ylim(-max(n_rows, 1) - 0.1, 0.1)
+    return fig
+
+def render_thumbnails(layouts, colors, link_color="#BFC5D2", link_alpha=0.3, dpi=THUMB_DPI):
+    """PNG miniatur dla listy układów z thumbnail_layout(); jedna figura na całą partię.
+
+    Funkcja modułu - można ją wysłać do puli procesów.
+    """
+    images = []
+    fig = None
+    try:
+        for layout in layouts:
+            with RENDER_SECONDS.time(chart="thumbnail", stage="draw"):
+                fig = draw_sankey_thumbnail(layout, colors, link_color, link_alpha, fig=fig)
+            buf = io.BytesIO()
+            with SAVEFIG_SECONDS.time(format="png", dpi=dpi):
+                fig.savefig(buf, format="png", dpi=dpi)
+            images.append(buf.getvalue())
+            RENDERS.inc(chart="thumbnail")
+    finally:
+        release_figure(fig)
+    return images
+
+def figure_to_png(fig, dpi, bbox=None):
+    # bbox: gotowy obrys (w calach) zamiast liczenia "tight" przy każdym zapisie
+    buf = io.BytesIO()
+    with SAVEFIG_SECONDS.time(format="png", dpi=dpi):
+        fig.savefig(buf, format="png", dpi=dpi, bbox_inches=bbox or "tight")
+    return buf.getvalue()
+
+# ==========================================
+# 4. EKSPORT PNG
+# ==========================================
+
+def save_png_within_budget(fig, dpi, max_pixels, split_pages=False, max_page_aspect=None):
+    """Zapisuje figurę do PNG tak, by pojedynczy raster nie przekroczył max_pixels.
+
+    Zwraca (lista_png, efektywne_dpi, zastosowana_opcja), gdzie opcja to None,
+    "dpi" (obniżona rozdzielczość) albo "pages" (podział na strony przy granicach wierszy).
+    Z split_pages i max_page_aspect (wysokość / szerokość) strona nie jest też wyższa niż ta proporcja.
+    """
+    pad = 0.1
+    bbox = fig.get_tightbbox(fig.canvas.get_renderer()).padded(pad)
+
+    def render(region, page_dpi):
+        buf = io.BytesIO()
+        with SAVEFIG_SECONDS.time(format="png", dpi=page_dpi):
+            # Bez metadanych "Software" - bajty PNG zależą tylko od treści (skróty w manifeście eksportu)
+            fig.savefig(buf, format="png", dpi=page_dpi, bbox_inches=region, pad_inches=0, metadata={"Software": None})
+        return buf.getvalue()
+
+    too_tall = split_pages and max_page_aspect is not None and bbox.height > bbox.width * max_page_aspect
+    if bbox.width * bbox.height * dpi * dpi <= max_pixels and not too_tall:
+        return [render(bbox, dpi)], dpi, None
+
+    if not split_pages:
+        reduced_dpi = max(1, int((max_pixels / (bbox.width * bbox.height)) ** 0.5))
+        return [render(bbox, reduced_dpi)], reduced_dpi, "dpi"
+
+    # Cięcie w pionie: granice wierszy z danych osi -> cale figury
+    max_page_h = max_pixels / (bbox.width * dpi * dpi)
+    if max_page_aspect is not None:
+        max_page_h = min(max_page_h, bbox.width * max_page_aspect)
+    def cut_positions(attr):
+        if not fig.axes or not getattr(fig, attr, None):
+            return []
+        to_inches = fig.axes[0].transData + fig.dpi_scale_trans.inverted()
+        return [c for c in (to_inches.transform((0, y))[1] for y in getattr(fig, attr)) if bbox.y0 < c < bbox.y1]
+
+    clean_cuts = cut_positions("clean_row_boundaries")
+    row_cuts = cut_positions("row_boundaries")
+
+    pages = []
+    top = bbox.y1
+    while top > bbox.y0:
+        limit = top - max_page_h
+        if limit <= bbox.y0:
+            bottom = bbox.y0
+        else:
+            # Najpierw granica, której nie przecina żadna karta, potem dowolna granica wiersza,
+            # a gdy sam wiersz jest wyższy niż budżet strony - cięcie na sztywno
+            fitting = [c for c in clean_cuts if limit <= c < top] or [c for c in row_cuts if limit <= c < top]
+            bottom = min(fitting) if fitting else limit
+        pages.append(render(Bbox([[bbox.x0, bottom], [bbox.x1, top]]), dpi))
+        top = bottom
+    return pages, dpi, "pages"
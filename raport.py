@@ -0,0 +1,158 @@
+import hashlib
+import io
+import struct
+import zipfile
+from xml.sax.saxutils import escape
+
+from docx import Document
+from docx.shared import Mm
+
+from metryki import EXPORT_SECONDS
+
+# ==========================================
+# RAPORT WORD (.docx) Z WYKRESÓW
+# ==========================================
+# Plik .docx to archiwum ZIP - obrazy zapisujemy do word/media od razu po wyrenderowaniu,
+# a w pamięci zostaje tylko treść document.xml (akapity z odnośnikami do obrazów).
+# Szablon (style, ustawienia, rozmiar strony) bierzemy z pustego dokumentu python-docx.
+# Identyczne obrazy (ten sam SHA-1) są zapisywane raz i wstawiane wielokrotnie.
+
+REPORT_PAGE_MM = (210, 297)     # A4 pionowo
+REPORT_MARGIN_MM = 15
+EMU_PER_INCH = 914400
+
+_DOCUMENT_PART = "word/document.xml"
+_RELS_PART = "word/_rels/document.xml.rels"
+_CONTENT_TYPES_PART = "[Content_Types].xml"
+_IMAGE_REL = "http://schemas.openxmlformats.org/officeDocument/2006/relationships/image"
+
+_PAGE_BREAK = '<w:p><w:r><w:br w:type="page"/></w:r></w:p>'
+_PICTURE = (
+    '<w:p><w:pPr><w:spacing w:after="120"/><w:jc w:val="center"/></w:pPr><w:r><w:drawing>'
+    '<wp:inline distT="0" distB="0" distL="0" distR="0"><wp:extent cx="{cx}" cy="{cy}"/>'
+    '<wp:docPr id="{pic_id}" name="{name}"/>'
+    '<wp:cNvGraphicFramePr><a:graphicFrameLocks xmlns:a="http://schemas.openxmlformats.org/drawingml/2006/main" noChangeAspect="1"/></wp:cNvGraphicFramePr>'
+    '<a:graphic xmlns:a="http://schemas.openxmlformats.org/drawingml/2006/main">'
+    '<a:graphicData uri="http://schemas.openxmlformats.org/drawingml/2006/picture">'
+    '<pic:pic xmlns:pic="http://schemas.openxmlformats.org/drawingml/2006/picture">'
+    '<pic:nvPicPr><pic:cNvPr id="0" name="{name}"/><pic:cNvPicPr/></pic:nvPicPr>'
+    '<pic:blipFill><a:blip r:embed="{rel_id}"/><a:stretch><a:fillRect/></a:stretch></pic:blipFill>'
+    '<pic:spPr><a:xfrm><a:off x="0" y="0"/><a:ext cx="{cx}" cy="{cy}"/></a:xfrm><a:prstGeom prst="rect"><a:avLst/></a:prstGeom></pic:spPr>'
+    '</pic:pic></a:graphicData></a:graphic></wp:inline></w:drawing></w:r></w:p>'
+)
+
+
+def png_size(png):
+    # Szerokość i wysokość w pikselach z nagłówka IHDR
+    return struct.unpack(">II", png[16:24])
+
+
+class DocxReport:
+    """Dokument Word pisany strumieniowo do pliku binarnego out (wywołaj close() albo użyj with)."""
+
+    def __init__(self, out, page_mm=REPORT_PAGE_MM, margin_mm=REPORT_MARGIN_MM):
+        template = Document()
+        section = template.sections[0]
+        section.page_width, section.page_height = Mm(page_mm[0]), Mm(page_mm[1])
+        section.left_margin = section.right_margin = section.top_margin = section.bottom_margin = Mm(margin_mm)
+        self.usable_width = section.page_width - 2 * Mm(margin_mm)
+        # Margines bezpieczeństwa na odstęp pod akapitem - obraz na całą stronę nie przeskoczy na następną
+        self.usable_height = section.page_height - 2 * Mm(margin_mm) - Mm(5)
+        buf = io.BytesIO()
+        template.save(buf)
+        with zipfile.ZipFile(buf) as zf:
+            self._template = {name: zf.read(name) for name in zf.namelist()}
+
+        self._zip = zipfile.ZipFile(out, "w", zipfile.ZIP_DEFLATED)
+        self._media = {}            # SHA-1 obrazu -> id relacji
+        self._body = []
+        self.images_added = 0
+
+    @property
+    def page_aspect(self):
+        # Wysokość / szerokość obszaru obrazu - do cięcia wysokich wykresów na strony
+        return self.usable_height / self.usable_width
+
+    @property
+    def images_stored(self):
+        return len(self._media)
+
+    def add_image(self, png, dpi):
+        digest = hashlib.sha1(png).hexdigest()
+        rel_id = self._media.get(digest)
+        if rel_id is None:
+            rel_id = self._media[digest] = f"rIdImg{len(self._media) + 1}"
+            # PNG jest już skompresowany - zapis bez ponownej kompresji
+            self._zip.writestr(f"word/media/{rel_id}.png", png, compress_type=zipfile.ZIP_STORED)
+        self.images_added += 1
+        width_px, height_px = png_size(png)
+        cx, cy = width_px * EMU_PER_INCH / dpi, height_px * EMU_PER_INCH / dpi
+        # Obraz na szerokość strony; zbyt wysoki - zmniejszony do wysokości strony
+        scale = min(self.usable_width / cx, self.usable_height / cy)
+        self._body.append(_PICTURE.format(
+            cx=int(cx * scale), cy=int(cy * scale), pic_id=self.images_added,
+            name=f"wykres{self.images_added}.png", rel_id=rel_id
+        ))
+
+    def page_break(self):
+        if self._body:
+            self._body.append(_PAGE_BREAK)
+
+    def add_paragraph(self, text, style=None):
+        style_xml = f'<w:pPr><w:pStyle w:val="{escape(style)}"/></w:pPr>' if style else ""
+        self._body.append(f'<w:p>{style_xml}<w:r><w:t xml:space="preserve">{escape(text)}</w:t></w:r></w:p>')
+
+    def close(self):
+        if self._zip is None:
+            return
+        for name, data in self._template.items():
+            if name not in (_DOCUMENT_PART, _RELS_PART, _CONTENT_TYPES_PART):
+                self._zip.writestr(name, data)
+
+        document = self._template[_DOCUMENT_PART].decode("utf-8")
+        # Treść wstawiamy przed sectPr (ustawienia strony muszą zostać ostatnim elementem body)
+        at = document.rindex("<w:sectPr")
+        self._zip.writestr(_DOCUMENT_PART, document[:at] + "".join(self._body) + document[at:])
+
+        rels = self._template[_RELS_PART].decode("utf-8")
+        image_rels = "".join(
+            f'<Relationship Id="{rel_id}" Type="{_IMAGE_REL}" Target="media/{rel_id}.png"/>'
+            for rel_id in self._media.values()
+        )
+        self._zip.writestr(_RELS_PART, rels.replace("</Relationships>", image_rels + "</Relationships>"))
+
+        content_types = self._template[_CONTENT_TYPES_PART].decode("utf-8")
+        if 'Extension="png"' not in content_types:
+            content_types = content_types.replace(
+                "<Default ", '<Default Extension="png" ContentType="image/png"/><Default ', 1)
+        self._zip.writestr(_CONTENT_TYPES_PART, content_types)
+        self._zip.close()
+        self._zip = None
+        self._body = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def write_chart_report(plan, render_chart, export_pages, out, on_progress=None):
+    """Renderuje plan wykresów (build_chart_plan) prosto do raportu .docx w out.
+
+    render_chart(chart, fig) rysuje wykres, export_pages(fig, max_page_aspect) zwraca
+    (lista_png, dpi, opcja) jak save_png_within_budget. Każdy psalm zaczyna się od nowej strony.
+    Zwraca (liczba wstawionych obrazów, liczba zapisanych - bez duplikatów).
+    """
+    with DocxReport(out) as report, EXPORT_SECONDS.time(chart="psalm", format="docx"):
+        fig = None
+        for i, chart in enumerate(plan):
+            if on_progress:
+                on_progress(i, chart)
+            if chart["is_first"]:
+                report.page_break()
+            fig = render_chart(chart, fig=fig)
+            pages, used_dpi, _ = export_pages(fig, max_page_aspect=report.page_aspect)
+            for png in pages:
+                report.add_image(png, used_dpi)
+    return report.images_added, report.images_stored
@@ -0,0 +1,133 @@
+import argparse
+import csv
+import importlib.util
+import io
+import os
+
+from psalmy import LazyDocument, build_blocks, merge_components
+from metryki import EXPORT_SECONDS
+
+# ==========================================
+# EKSPORT TABELI DOPASOWANIA (CSV / Parquet)
+# ==========================================
+# Uruchomienie: python tabela.py plik.docx [inne.docx ...] --out tabela.parquet [--batch-rows 20000]
+#
+# Jeden wiersz wyniku = jedna komórka tabeli psalmu (psalm, wiersz, kolumna A/B/C) z jej ID,
+# markerem, tekstem i numerem grupy scalonych ID (jak jeden wykres eksportu ZIP/PDF).
+# Wiersze idą do pliku partiami po batch_rows prosto z parsera - cała tabela nigdy nie leży w pamięci.
+# Parquet wymaga pyarrow (opcjonalnie); bez niego dostępny jest CSV.
+
+ALIGNMENT_COLUMNS = ("document", "psalm", "row", "column", "ids", "component", "component_ids", "marker", "text")
+ALIGNMENT_BATCH_ROWS = 20000
+ALIGNMENT_FORMATS = {"csv": "text/csv", "parquet": "application/vnd.apache.parquet"}
+
+
+def parquet_available():
+    return importlib.util.find_spec("pyarrow") is not None
+
+
+def iter_alignment_rows(psalms, document=""):
+    """Wiersze tabeli dopasowania (krotki w kolejności ALIGNMENT_COLUMNS).
+
+    psalms to pary (psalm, wiersze) - np. iter_docx_psalms(), dict.items() dokumentu albo korpusu;
+    w korpusie kluczem jest (dokument, psalm).
+    """
+    for key, rows in psalms:
+        doc_name, psalm = key if isinstance(key, tuple) else (document, key)
+        sorted_ids, blocks, _ = build_blocks(rows)
+        component_of = {}
+        for number, component in enumerate(merge_components(sorted_ids, blocks), start=1):
+            for uid in component:
+                component_of[uid] = (number, "-".join(component))
+        has_ids = any(row[c]["ids"] for row in rows for c in ("A", "B", "C"))
+        for row_no, row in enumerate(rows, start=1):
+            for col in ("A", "B", "C"):
+                cell = row[col]
+                # Wiersze bez ID: build_blocks numeruje je kolejno, tak samo jak na wykresie
+                ids = list(cell["ids"]) if has_ids else [str(row_no)]
+                number, component_ids = component_of.get(ids[0], (None, "")) if ids else (None, "")
+                yield (doc_name, psalm, row_no, col, ",".join(ids), number, component_ids,
+                       cell["marker"] or "", cell["text"] or "")
+
+
+def iter_alignment_batches(psalms, document="", batch_rows=ALIGNMENT_BATCH_ROWS):
+    batch = []
+    for record in iter_alignment_rows(psalms, document):
+        batch.append(record)
+        if len(batch) >= batch_rows:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def write_alignment_csv(psalms, out, document="", batch_rows=ALIGNMENT_BATCH_ROWS, on_batch=None):
+    # UTF-8 z BOM - Excel otwiera wtedy polskie i łacińskie znaki poprawnie
+    text = io.TextIOWrapper(out, encoding="utf-8-sig", newline="", write_through=True)
+    try:
+        writer = csv.writer(text)
+        writer.writerow(ALIGNMENT_COLUMNS)
+        total = 0
+        for batch in iter_alignment_batches(psalms, document, batch_rows):
+            writer.writerows(batch)
+            total += len(batch)
+            if on_batch:
+                on_batch(total)
+    finally:
+        text.detach()
+    return total
+
+
+def write_alignment_parquet(psalms, out, document="", batch_rows=ALIGNMENT_BATCH_ROWS, on_batch=None):
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise RuntimeError("Eksport do Parquet wymaga pakietu pyarrow - użyj CSV albo zainstaluj pyarrow.")
+    schema = pa.schema([
+        ("document", pa.string()), ("psalm", pa.string()), ("row", pa.int32()), ("column", pa.string()),
+        ("ids", pa.string()), ("component", pa.int32()), ("component_ids", pa.string()),
+        ("marker", pa.string()), ("text", pa.string()),
+    ])
+    total = 0
+    # Jedna partia = jedna grupa wierszy pliku; słowniki kodują powtarzalne kolumny (psalm, kolumna, ID)
+    with pq.ParquetWriter(out, schema, compression="zstd", use_dictionary=True) as writer:
+        for batch in iter_alignment_batches(psalms, document, batch_rows):
+            writer.write_batch(pa.RecordBatch.from_arrays(
+                [pa.array(values, type=field.type) for values, field in zip(zip(*batch), schema)], schema=schema
+            ))
+            total += len(batch)
+            if on_batch:
+                on_batch(total)
+    return total
+
+
+def export_alignment(psalms, out, fmt="csv", document="", batch_rows=ALIGNMENT_BATCH_ROWS, on_batch=None):
+    """Zapisuje tabelę dopasowania do pliku binarnego out. Zwraca liczbę wierszy."""
+    write = {"csv": write_alignment_csv, "parquet": write_alignment_parquet}[fmt]
+    with EXPORT_SECONDS.time(chart="table", format=fmt):
+        return write(psalms, out, document, batch_rows, on_batch)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Eksport sparsowanych tabel psalmów do CSV lub Parquet.")
+    parser.add_argument("docx", nargs="+", help="pliki .docx (kilka = korpus, kolumna document)")
+    parser.add_argument("--out", required=True, help="plik wynikowy .csv albo .parquet")
+    parser.add_argument("--batch-rows", type=int, default=ALIGNMENT_BATCH_ROWS)
+    args = parser.parse_args()
+
+    fmt = "parquet" if args.out.lower().endswith(".parquet") else "csv"
+
+    def psalms():
+        # Dokumenty czytane po kolei; jak w aplikacji psalm z kilku tabel to jego ostatnia niepusta tabela,
+        # a wiersze każdego psalmu są parsowane dopiero, gdy przyjdzie jego kolej
+        for path in args.docx:
+            with open(path, "rb") as f:
+                document = LazyDocument(f.read())
+            name = os.path.basename(path)
+            for psalm in document:
+                yield (name, psalm), document[psalm]
+
+    with open(args.out, "wb") as out:
+        total = export_alignment(psalms(), out, fmt, batch_rows=args.batch_rows)
+    print(f"Zapisano {total} wierszy do {args.out} ({fmt})")
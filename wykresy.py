@@ -1,9 +1,16 @@
-import matplotlib.pyplot as plt
+import io
+import math
+import numpy as np
+import pandas as pd
 import matplotlib.patches as patches
+from matplotlib.collections import PolyCollection
+from figury import reuse_figure, figure_scope
+from metryki import RENDER_SECONDS, RENDERS, SAVEFIG_SECONDS
 
 # Konfiguracja ogólna
 COMMON_X_LIMITS = (1790, 1860)
 FIG_SIZE = (15, 3)
+MIN_VISUAL_WIDTH = 0.6       # minimalna szerokość paska w latach, żeby był widoczny
 
 # Definicja kolorów
 COLORS = {
@@ -62,45 +69,220 @@ timelines_data = [
 ]
 
 
-def parse_year(val):
-    """Zamienia daty '1807/1808' na float, resztę zostawia."""
-    if isinstance(val, (int, float)):
-        return float(val)
-    if isinstance(val, str) and '/' in val:
-        parts = val.split('/')
-        return (float(parts[0]) + float(parts[1])) / 2
-    return float(val)
+def parse_years(values):
+    """Lata z kolumny: '1807/1808' -> 1807.5, puste i niepoprawne -> NaN."""
+    text = pd.Series(values, dtype="object").astype("string").str.strip()
+    parts = text.str.extract(r"^(\d+(?:\.\d+)?)\s*(?:/\s*(\d+(?:\.\d+)?))?$")
+    first = pd.to_numeric(parts[0], errors="coerce").to_numpy(dtype=float)
+    second = pd.to_numeric(parts[1], errors="coerce").to_numpy(dtype=float)
+    return np.where(np.isnan(second), first, (first + second) / 2)
 
 
-def create_timeline(data, filename_suffix):
-    fig, ax = plt.subplots(figsize=FIG_SIZE)
+def format_year(val):
+    # 1793.0 z Excela wyświetlamy jako 1793, zapis '1807/1808' bez zmian
+    if isinstance(val, float) and val.is_integer():
+        return str(int(val))
+    return str(val).strip()
+
+
+# ==========================================
+# OSIE CZASU Z ARKUSZA (wiele osób naraz)
+# ==========================================
+# Arkusz zdarzeń: jeden wiersz = pobyt w jednym miejscu. Kolumny rozpoznawane po nazwie:
+#   oś (osoba)  - TIMELINE / NAME / NUN / OSOBA / ID (puste komórki = ta sama osoba co wyżej)
+#   miejsce     - PLACE / MIEJSCE / LOCATION
+#   początek    - START / FROM / OD
+#   koniec      - END / TO / DO (puste = rok początku)
+TIMELINE_COLUMNS = {
+    "timeline": ("TIMELINE", "NAME", "NUN", "OSOBA", "ID"),
+    "place": ("PLACE", "MIEJSCE", "LOCATION"),
+    "start": ("START", "FROM", "OD"),
+    "end": ("END", "TO", "DO"),
+}
+TIMELINES_PER_PAGE = 30
+ROW_INCHES = 0.55
+
+
+def detect_timeline_columns(df):
+    found = {}
+    for role, names in TIMELINE_COLUMNS.items():
+        for col in df.columns:
+            if str(col).strip().upper() in names:
+                found[role] = col
+                break
+    return found
+
+
+def load_timeline_events(df, columns=None):
+    """Tabela zdarzeń (timeline, place, start_raw, end_raw, start, end) z arkusza.
+
+    Wiersze jednej osi są zebrane razem, w kolejności pierwszego wystąpienia osi.
+    """
+    columns = dict(detect_timeline_columns(df), **(columns or {}))
+    missing = [role for role in TIMELINE_COLUMNS if role not in columns]
+    if missing:
+        raise ValueError(f"Nie rozpoznano kolumn: {', '.join(missing)}")
+
+    events = pd.DataFrame({
+        "timeline": df[columns["timeline"]].ffill(),
+        "place": df[columns["place"]],
+        "start_raw": df[columns["start"]],
+        "end_raw": df[columns["end"]],
+    })
+    events["start"] = parse_years(events["start_raw"])
+    events["end"] = parse_years(events["end_raw"])
+    events = events[events["place"].notna() & events["timeline"].notna() & ~np.isnan(events["start"])].copy()
+    no_end = np.isnan(events["end"])
+    events["end"] = events["end"].where(~no_end, events["start"])
+    events["end_raw"] = events["end_raw"].astype(object).where(~no_end, events["start_raw"])
+    events["timeline"] = events["timeline"].astype(str).str.strip()
+    events["place"] = events["place"].astype(str).str.strip()
+
+    codes, _ = pd.factorize(events["timeline"])
+    events["group"] = codes
+    return events.sort_values("group", kind="stable").reset_index(drop=True)
+
+
+def events_from_timelines(timelines):
+    # Wbudowane dane przykładowe (lista słowników) w formacie tabeli zdarzeń
+    records = [
+        {"timeline": t["title"], "place": place, "start_raw": start, "end_raw": end, "color_key": color_key}
+        for t in timelines for place, start, end, color_key in t["events"]
+    ]
+    events = pd.DataFrame.from_records(records)
+    events["start"] = parse_years(events["start_raw"])
+    events["end"] = parse_years(events["end_raw"])
+    events["group"] = pd.factorize(events["timeline"])[0]
+    return events
+
+
+def layout_timelines(events, x_start=COMMON_X_LIMITS[0], min_width=MIN_VISUAL_WIDTH):
+    """Wizualne położenie pasków dla wszystkich osi naraz (bez pętli po zdarzeniach).
+
+    Pasek ma szerokość max(koniec - początek, min_width) i zaczyna się w max(początek, kursor),
+    gdzie kursor to wizualny koniec poprzedniego paska tej samej osi. Rekurencję
+    k_i = max(s_i, k_(i-1)) + w_i zapisujemy jako k_i = W_i + max(x_start, max_(j<=i)(s_j - W_(j-1))),
+    gdzie W to skumulowana szerokość w obrębie osi.
+    """
+    start = events["start"].to_numpy(dtype=float)
+    width = np.maximum(events["end"].to_numpy(dtype=float) - start, min_width)
+    group = events["group"].to_numpy()
+    if not len(start):
+        return events.assign(visual_start=start, visual_width=width)
+
+    first = np.r_[True, group[1:] != group[:-1]]
+    total = np.cumsum(width)
+    # Suma szerokości przed początkiem każdej osi (przeniesiona na wszystkie jej wiersze)
+    base = np.maximum.accumulate(np.where(first, total - width, 0.0))
+    cum_width = total - base
+    slack = np.maximum(start - (cum_width - width), x_start)
+    # Maksimum narastające osobno w każdej osi: przesunięcie kolejnych osi o rozpiętość danych
+    span = slack.max() - slack.min() + 1.0
+    offset = np.cumsum(first) * span
+    cursor = np.maximum.accumulate(slack + offset) - offset
+    visual_end = cum_width + cursor
+    return events.assign(visual_start=visual_end - width, visual_width=width)
+
+
+def timeline_titles(events):
+    # Tytuł osi jak w przykładach: "MIEJSCE → MIEJSCE (początek–koniec)"
+    titles = {}
+    for name, rows in events.groupby("timeline", sort=False):
+        route = " → ".join(rows["place"].str.upper())
+        titles[name] = f"{name}: {route} ({format_year(rows['start_raw'].iloc[0])}–{format_year(rows['end_raw'].iloc[-1])})"
+    return titles
 
-    ax.set_xlim(COMMON_X_LIMITS)
-    ax.set_ylim(0, 1)
 
-    # Zmienna do śledzenia, gdzie skończył się poprzedni pasek (wizualnie)
-    current_visual_cursor = COMMON_X_LIMITS[0]
+def timeline_x_limits(events):
+    # Wspólna skala dla wszystkich osi: pełne dekady obejmujące dane
+    if events.empty:
+        return COMMON_X_LIMITS
+    lo = math.floor(min(events["start"].min(), events["visual_start"].min()) / 10) * 10
+    hi = math.ceil((events["visual_start"] + events["visual_width"]).max() / 10) * 10
+    return (lo, max(hi, lo + 10))
 
-    for i, (place, start_raw, end_raw, color_key) in enumerate(data["events"]):
-        num_start = parse_year(start_raw)
-        num_end = parse_year(end_raw)
 
-        # Obliczanie szerokości matematycznej
-        math_width = num_end - num_start
+def paginate_timelines(events, per_page=TIMELINES_PER_PAGE):
+    # Strony po per_page osi (cała oś zawsze na jednej stronie)
+    page_of_group = events["group"].to_numpy() // max(1, per_page)
+    return [events[page_of_group == p] for p in np.unique(page_of_group)]
 
-        # Ustalanie wizualnego początku
-        # Pasek zaczyna się tam, gdzie matematycznie powinien, CHYBA ŻE
-        # poprzedni pasek skończył się "dalej" (bo był sztucznie poszerzony).
-        visual_start = max(num_start, current_visual_cursor)
 
-        # Ustalanie wizualnego końca
-        # Minimalna szerokość paska to 0.6 roku, żeby był widoczny
-        visual_width = max(math_width, 0.6)
-        visual_end = visual_start + visual_width
+@RENDER_SECONDS.time(chart="timeline", stage="draw")
+def draw_timelines(events, title="", x_limits=None, fig=None, show_labels=True, show_legend=True, titles=None):
+    """Małe wielokrotności: wiele osi czasu jedna pod drugą, ze wspólną osią lat.
 
-        # Aktualizacja kursora dla następnego elementu
-        current_visual_cursor = visual_end
+    events musi mieć kolumny z layout_timelines(). Paski rysowane jako jedna kolekcja.
+    """
+    RENDERS.inc(chart="timeline")
+    x_limits = x_limits or timeline_x_limits(events)
+    titles = titles if titles is not None else timeline_titles(events)
+    names = list(dict.fromkeys(events["timeline"]))
+    row_of = {name: i for i, name in enumerate(names)}
+    n_rows = max(1, len(names))
 
+    fig = reuse_figure(fig, (FIG_SIZE[0], 1.4 + n_rows * ROW_INCHES))
+    ax = fig.add_subplot()
+
+    # Wiersz osi: pasek na wysokości [y, y + 0.55], tytuł nad nim
+    rows = events["timeline"].map(row_of).to_numpy(dtype=float)
+    y = (n_rows - 1 - rows)
+    x0 = events["visual_start"].to_numpy(dtype=float)
+    x1 = x0 + events["visual_width"].to_numpy(dtype=float)
+    verts = np.stack([
+        np.column_stack([x0, y]), np.column_stack([x0, y + 0.55]),
+        np.column_stack([x1, y + 0.55]), np.column_stack([x1, y]),
+    ], axis=1)
+    colors = [COLORS.get(key, '#cccccc') for key in events.get("color_key", events["place"])]
+    ax.add_collection(PolyCollection(verts, facecolors=colors, edgecolors='black', linewidths=0.6))
+
+    if show_labels:
+        # Nazwa miejsca tylko w paskach, w których się mieści (ok. 0.75 roku na znak przy 70 latach skali)
+        years_per_char = (x_limits[1] - x_limits[0]) / 95
+        for place, left, width, row_y in zip(events["place"], x0, x1 - x0, y):
+            if width >= years_per_char * (len(place) + 1):
+                ax.text(left + width / 2, row_y + 0.275, place, ha='center', va='center', fontsize=7, clip_on=True)
+
+    for name in names:
+        ax.text(x_limits[0], n_rows - 1 - row_of[name] + 0.6, titles.get(name, name),
+                ha='left', va='bottom', fontsize=8, color='#111827', clip_on=True)
+
+    ax.set_xlim(x_limits)
+    ax.set_ylim(-0.3, n_rows + 0.1)
+    ax.set_yticks([])
+    ax.set_xticks(range(int(x_limits[0]), int(x_limits[1]) + 1, 10))
+    ax.tick_params(axis='x', labelsize=10, labeltop=True, top=True)
+    ax.grid(axis='x', linestyle='--', alpha=0.4)
+    ax.set_axisbelow(True)
+    for side in ('left', 'right'):
+        ax.spines[side].set_visible(False)
+    if title:
+        ax.set_title(title, fontsize=14, pad=28)
+
+    if show_legend:
+        keys = list(dict.fromkeys(events.get("color_key", events["place"])))
+        handles = [patches.Patch(facecolor=COLORS.get(k, '#cccccc'), edgecolor='black', label=k) for k in keys]
+        if handles:
+            ax.legend(handles=handles, loc='upper center', bbox_to_anchor=(0.5, -0.06 * 8 / (n_rows + 8)),
+                      ncol=min(len(handles), 8), fontsize=8, frameon=False)
+
+    fig.tight_layout()
+    return fig
+
+
+def create_timeline(data, filename_suffix, fig=None):
+    # Figura z menedżera (figury.py); przekazana figura jest czyszczona i używana ponownie
+    fig = reuse_figure(fig, FIG_SIZE)
+    ax = fig.add_subplot()
+
+    ax.set_xlim(COMMON_X_LIMITS)
+    ax.set_ylim(0, 1)
+
+    # Wizualne położenie pasków (min. szerokość i przesuwanie za poprzednim paskiem) - layout_timelines
+    laid_out = layout_timelines(events_from_timelines([data]), COMMON_X_LIMITS[0])
+
+    for place, start_raw, end_raw, color_key, visual_start, visual_width in laid_out[
+            ["place", "start_raw", "end_raw", "color_key", "visual_start", "visual_width"]].itertuples(index=False):
         # Rysowanie prostokąta
         rect = patches.Rectangle((visual_start, 0), visual_width, 1,
                                  linewidth=1, edgecolor='black',
@@ -135,11 +317,59 @@ def create_timeline(data, filename_suffix):
     ax.spines['right'].set_visible(False)
     ax.spines['top'].set_visible(False)
 
-    plt.xticks(range(COMMON_X_LIMITS[0], COMMON_X_LIMITS[1] + 1, 10), fontsize=11)
-    plt.tight_layout()
-    plt.show()
+    ax.set_xticks(range(COMMON_X_LIMITS[0], COMMON_X_LIMITS[1] + 1, 10))
+    ax.tick_params(axis='x', labelsize=11)
+    fig.tight_layout()
+    fig.savefig(f"timeline_{filename_suffix}.png", dpi=150)
+    return fig
+
+
+def export_timeline_pages(events, per_page=TIMELINES_PER_PAGE, dpi=150, title="", progress=None,
+                          show_labels=True, show_legend=True, laid_out=False):
+    """Renderuje wszystkie strony małych wielokrotności; zwraca listę PNG (bytes).
+
+    Z laid_out=True events to już wynik layout_timelines() (np. z pamięci podręcznej aplikacji).
+    """
+    if not laid_out:
+        events = layout_timelines(events)
+    x_limits = timeline_x_limits(events)
+    titles = timeline_titles(events)
+    pages = paginate_timelines(events, per_page)
+    images = []
+    # Jedna figura przerysowywana strona po stronie, zwalniana po eksporcie
+    with figure_scope():
+        fig = None
+        for i, page in enumerate(pages):
+            page_title = f"{title} ({i + 1}/{len(pages)})" if title and len(pages) > 1 else title
+            fig = draw_timelines(page, page_title, x_limits, fig=fig, titles=titles,
+                                 show_labels=show_labels, show_legend=show_legend)
+            buf = io.BytesIO()
+            # Szybka kompresja PNG: przy setkach osi koszt zapisu dorównuje rysowaniu
+            with SAVEFIG_SECONDS.time(format="png", dpi=dpi):
+                fig.savefig(buf, format="png", dpi=dpi, pil_kwargs={"compress_level": 1})
+            images.append(buf.getvalue())
+            if progress:
+                progress(i + 1, len(pages))
+    return images
+
+
+if __name__ == "__main__":
+    import sys
+    import time
 
+    if len(sys.argv) > 1:
+        # python wykresy.py plik.xlsx [arkusz] - wszystkie osie z arkusza, strony timelines_<n>.png
+        t0 = time.perf_counter()
+        sheet = sys.argv[2] if len(sys.argv) > 2 else 0
+        events = load_timeline_events(pd.read_excel(sys.argv[1], sheet_name=sheet))
+        images = export_timeline_pages(events, title="Timelines")
+        for i, png in enumerate(images):
+            with open(f"timelines_{i + 1}.png", "wb") as f:
+                f.write(png)
+        print(f"{events['group'].nunique()} osi, {len(events)} zdarzeń, {len(images)} stron w {time.perf_counter() - t0:.1f} s")
+        sys.exit(0)
 
-# Generowanie wykresów
-for i, timeline in enumerate(timelines_data):
-    create_timeline(timeline, i + 1)
\ No newline at end of file
+    # Generowanie wykresów (jedna figura dla wszystkich osi czasu)
+    fig = None
+    for i, timeline in enumerate(timelines_data):
+        fig = create_timeline(timeline, i + 1, fig=fig)
\ No newline at end of file
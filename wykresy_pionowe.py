@@ -1,7 +1,14 @@
-import matplotlib.pyplot as plt
+import hashlib
+import io
+import os
+import threading
+
+import numpy as np
 import pandas as pd
 import matplotlib.colors as mcolors
 import matplotlib.patches as mpatches
+from figury import reuse_figure
+from metryki import PARSE_SECONDS, RENDER_SECONDS, RENDERS
 
 # ==========================================
 # 1. KONFIGURACJA KOLORÓW
@@ -32,6 +39,309 @@ def add_value_label(ax, value, left, width, y_pos, text_color='black'):
                     fontsize=10, fontweight='bold', color=text_color)
 
 
+# Pełna paleta i kolejność lokalizacji używane przez aplikację (app.py) i API
+COLORS_NUNS = {
+    'Gravelines': '#FFD700', 'London': '#B0C4DE', 'Gosfield': '#2ca02c',
+    'Rouen': '#1f77b4', 'Haggerston': '#ff7f0e', 'Scorton': '#d62728',
+    'Aire': '#e377c2', 'Britwell': '#eaffea', 'Plymouth': '#9467bd',
+    'Dunkirk': '#9ACD32', 'Worcester': '#17becf', 'Deceased': '#808080'
+}
+
+PRIORITY_ORDER = ['Gravelines', 'London', 'Gosfield', 'Scorton', 'Rouen', 'Haggerston', 'Aire', 'Britwell', 'Plymouth', 'Dunkirk', 'Worcester']
+
+# Domyślne skróty z Excela dla każdej lokalizacji (oddzielone przecinkami)
+DEFAULT_MAPPINGS = {
+    'Gravelines': 'yes, y, yesg, g, yellow, yesy', 'London': 'yesn, london',
+    'Gosfield': 'yesz, gosfield', 'Scorton': 'yesc, s, scorton', 'Rouen': 'yesr',
+    'Haggerston': 'yesh', 'Aire': 'yesa', 'Britwell': 'yesb', 'Plymouth': 'yesp',
+    'Dunkirk': 'yesd', 'Worcester': 'yesw'
+}
+
+
+def parse_mapping_values(text):
+    return [v.strip().lower() for v in text.split(',') if v.strip()]
+
+
+# ==========================================
+# KOSTKA POPULACJI (WSZYSTKIE ARKUSZE NARAZ)
+# ==========================================
+# Każdy skoroszyt czytany raz (wszystkie arkusze); dla każdej kolumny etapu zliczamy znormalizowane
+# wartości komórek. Wynik to gęsta tablica skoroszyt × arkusz × etap × kod. Mapowanie skrótów na
+# kategorie (lokalizacje, Uncertain, Deceased) to mnożenie przez macierz kod × kategoria, więc
+# zmiana mapowania w panelu nie wymaga ponownego czytania Excela. Kostkę zapisujemy na dysk (.npz).
+
+STATUS_CATEGORIES = tuple(PRIORITY_ORDER) + ('Uncertain', 'Deceased')
+CATEGORY_INDEX = {cat: i for i, cat in enumerate(STATUS_CATEGORIES)}
+GENERIC_CODES = ('yes', 'y')        # "żyje" bez lokalizacji - trafia do domyślnej kategorii etapu
+FIXED_CODES = {'x': 'Uncertain', 'z': 'Deceased'}
+POPULATION_CUBE_VERSION = 1
+DARK_SEGMENT_COLORS = {COLORS_NUNS[k] for k in ('Deceased', 'Scorton', 'Rouen', 'Plymouth', 'Worcester')}
+
+
+def stage_columns(df):
+    # Kolumny etapów zaczynają się od IMPRISONMENT (bez niej - wszystkie kolumny)
+    columns = df.columns.tolist()
+    start_idx = next((i for i, c in enumerate(columns) if "IMPRISONMENT" in str(c).upper()), 0)
+    return columns[start_idx:]
+
+
+def stage_default_category(stage):
+    name = str(stage).upper()
+    if "LONDON" in name:
+        return 'London'
+    if "GOSFIELD" in name:
+        return 'Gosfield'
+    return 'Gravelines'
+
+
+def category_counts(counts, codes, stages, mappings):
+    """Liczności kodów (..., etap, kod) -> liczności kategorii (..., etap, kategoria) wg STATUS_CATEGORIES.
+
+    Kod przypisany kilku lokalizacjom liczy się w każdej z nich (jak dotąd na wykresie).
+    """
+    code_index = {code: i for i, code in enumerate(codes)}
+    lookup = np.zeros((len(codes), len(STATUS_CATEGORIES)), dtype=np.int64)
+    for loc, values in mappings.items():
+        if loc not in CATEGORY_INDEX:
+            continue
+        for value in values:
+            if value not in GENERIC_CODES and value in code_index:
+                lookup[code_index[value], CATEGORY_INDEX[loc]] = 1
+    for value, cat in FIXED_CODES.items():
+        if value in code_index:
+            lookup[code_index[value], CATEGORY_INDEX[cat]] = 1
+
+    result = counts @ lookup
+    generic = [code_index[v] for v in GENERIC_CODES if v in code_index]
+    if generic:
+        defaults = np.zeros((len(stages), len(STATUS_CATEGORIES)), dtype=np.int64)
+        defaults[np.arange(len(stages)), [CATEGORY_INDEX[stage_default_category(st)] for st in stages]] = 1
+        result += counts[..., generic].sum(axis=-1)[..., None] * defaults
+    return result
+
+
+def stage_segments(row, default_cat, active_locations):
+    """Segmenty jednego paska (liczba, kolor, klucz) z wektora liczności kategorii."""
+    bar_segments = [
+        (int(row[CATEGORY_INDEX[loc]]), COLORS_NUNS[loc], loc)
+        for loc in PRIORITY_ORDER if active_locations.get(loc) and row[CATEGORY_INDEX[loc]] > 0
+    ]
+    uncertain, deceased = row[CATEGORY_INDEX['Uncertain']], row[CATEGORY_INDEX['Deceased']]
+    if uncertain > 0:
+        base = COLORS_NUNS.get(default_cat, COLORS_NUNS['Gravelines'])
+        bar_segments.append((int(uncertain), make_lighter(base), "Uncertain"))
+    if deceased > 0:
+        bar_segments.append((int(deceased), COLORS_NUNS['Deceased'], "Deceased"))
+    return bar_segments
+
+
+class PopulationCube:
+    """Liczności kodów: counts[skoroszyt, arkusz, etap, kod]; order[w, s, etap] = pozycja kolumny w arkuszu (-1 - brak)."""
+
+    def __init__(self, workbooks, sheets, stages, codes, counts, order):
+        self.workbooks, self.sheets, self.stages, self.codes = workbooks, sheets, stages, codes
+        self.counts = counts
+        self.order = order
+
+    @classmethod
+    def from_frames(cls, frames, columns=None):
+        # frames: {skoroszyt: {arkusz: DataFrame}}; columns - te same kolumny etapów dla każdego arkusza
+        sheets, stages, codes, cells = {}, {}, {}, []
+        for w, sheet_frames in enumerate(frames.values()):
+            for sheet, df in sheet_frames.items():
+                s = sheets.setdefault(str(sheet), len(sheets))
+                for position, col in enumerate(stage_columns(df) if columns is None else columns):
+                    t = stages.setdefault(str(col), len(stages))
+                    value_counts = df[col].astype(str).str.strip().str.lower().value_counts()
+                    for code in value_counts.index:
+                        codes.setdefault(code, len(codes))
+                    cells.append((w, s, t, position, value_counts))
+
+        counts = np.zeros((len(frames), len(sheets), len(stages), len(codes)), dtype=np.int32)
+        order = np.full(counts.shape[:3], -1, dtype=np.int32)
+        for w, s, t, position, value_counts in cells:
+            counts[w, s, t, [codes[c] for c in value_counts.index]] = value_counts.to_numpy()
+            order[w, s, t] = position
+        return cls(tuple(str(w) for w in frames), tuple(sheets), tuple(stages), tuple(codes), counts, order)
+
+    def categories(self, mappings):
+        return category_counts(self.counts, self.codes, self.stages, mappings)
+
+    def sheet_stages(self, workbook, sheet):
+        # Etapy arkusza w kolejności kolumn w Excelu
+        order = self.order[self.workbooks.index(workbook), self.sheets.index(sheet)]
+        return [self.stages[t] for t in np.argsort(order) if order[t] >= 0]
+
+    def present_sheets(self):
+        # Pary (skoroszyt, arkusz), które naprawdę istnieją
+        return [(wb, sh) for w, wb in enumerate(self.workbooks) for s, sh in enumerate(self.sheets)
+                if (self.order[w, s] >= 0).any()]
+
+    def segments(self, workbook, sheet, mappings, active_locations, stages=None):
+        """Dane wykresu jednego arkusza - to samo co compute_population_segments, bez czytania Excela."""
+        stages = self.sheet_stages(workbook, sheet) if stages is None else stages
+        t = [self.stages.index(str(stage)) for stage in stages]
+        rows = category_counts(
+            self.counts[self.workbooks.index(workbook), self.sheets.index(sheet), t],
+            self.codes, [self.stages[i] for i in t], mappings
+        )
+        return [(self.stages[i], stage_segments(row, stage_default_category(self.stages[i]), active_locations))
+                for i, row in zip(t, rows)]
+
+    def stage_label(self, workbook, sheet):
+        return sheet if len(self.workbooks) == 1 else f"{workbook}: {sheet}"
+
+    def compare_segments(self, stage, mappings, active_locations):
+        """Jeden pasek na arkusz (klasztor), który ma dany etap - porównanie między arkuszami i skoroszytami."""
+        t = self.stages.index(stage)
+        cats = category_counts(self.counts[:, :, t:t + 1], self.codes, [stage], mappings)[:, :, 0]
+        default_cat = stage_default_category(stage)
+        return [
+            (self.stage_label(wb, sh), stage_segments(cats[w, s], default_cat, active_locations))
+            for w, wb in enumerate(self.workbooks) for s, sh in enumerate(self.sheets)
+            if self.order[w, s, t] >= 0
+        ]
+
+    def totals_table(self, mappings, stage):
+        """Tabela liczności kategorii na danym etapie: wiersz na arkusz, kolumna na niepustą kategorię + Total."""
+        t = self.stages.index(stage)
+        cats = category_counts(self.counts[:, :, t:t + 1], self.codes, [stage], mappings)[:, :, 0]
+        present = self.order[:, :, t] >= 0
+        used = [c for c in range(len(STATUS_CATEGORIES)) if cats[present][:, c].any()]
+        w_idx, s_idx = np.nonzero(present)
+        table = pd.DataFrame(
+            cats[w_idx, s_idx][:, used], columns=[STATUS_CATEGORIES[c] for c in used],
+            index=pd.MultiIndex.from_arrays(
+                [[self.workbooks[w] for w in w_idx], [self.sheets[s] for s in s_idx]], names=["skoroszyt", "arkusz"]
+            )
+        )
+        table["Total"] = table.sum(axis=1)
+        return table
+
+    def save(self, out):
+        np.savez_compressed(
+            out, version=POPULATION_CUBE_VERSION, counts=self.counts, order=self.order,
+            workbooks=np.array(self.workbooks, dtype=str), sheets=np.array(self.sheets, dtype=str),
+            stages=np.array(self.stages, dtype=str), codes=np.array(self.codes, dtype=str)
+        )
+
+    @classmethod
+    def load(cls, src):
+        with np.load(src, allow_pickle=False) as data:
+            if int(data["version"]) != POPULATION_CUBE_VERSION:
+                raise ValueError("Nieaktualna wersja kostki populacji")
+            return cls(*(tuple(data[k].tolist()) for k in ("workbooks", "sheets", "stages", "codes")),
+                       data["counts"], data["order"])
+
+
+def build_population_cube(workbooks):
+    """Kostka z {nazwa: bajty, ścieżka lub plik} - każdy skoroszyt czytany raz, wszystkie arkusze."""
+    frames = {}
+    for name, src in workbooks.items():
+        with PARSE_SECONDS.time(format="xlsx"):
+            frames[name] = pd.read_excel(io.BytesIO(src) if isinstance(src, bytes) else src, sheet_name=None)
+    return PopulationCube.from_frames(frames)
+
+
+def population_cube_key(workbooks):
+    # Skrót nazw i zawartości skoroszytów (bajty) - nazwa pliku kostki na dysku
+    h = hashlib.sha256(f"v{POPULATION_CUBE_VERSION}".encode())
+    for name, data in workbooks.items():
+        h.update(name.encode("utf-8") + b"\0" + hashlib.sha256(data).digest())
+    return h.hexdigest()
+
+
+def cached_population_cube(workbooks, cache_dir=None):
+    """Kostka dla {nazwa: bajty}: z pliku w cache_dir, a jeśli go nie ma - zbudowana i zapisana."""
+    if not cache_dir:
+        return build_population_cube(workbooks)
+    path = os.path.join(cache_dir, f"kostka_{population_cube_key(workbooks)}.npz")
+    try:
+        return PopulationCube.load(path)
+    except (OSError, ValueError, KeyError):
+        pass
+    cube = build_population_cube(workbooks)
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        # Zapis przez plik tymczasowy - równoległa sesja nie wczyta połowy pliku
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as f:
+            cube.save(f)
+        os.replace(tmp, path)
+    except OSError:
+        pass
+    return cube
+
+
+def compute_population_segments(df, selected_columns, mappings, active_locations):
+    """Segmenty pasków (liczba, kolor, klucz) dla wybranych kolumn arkusza."""
+    cube = PopulationCube.from_frames({"": {"": df}}, columns=selected_columns)
+    return cube.segments("", "", mappings, active_locations)
+
+
+@RENDER_SECONDS.time(chart="nuns", stage="draw")
+def draw_population_chart(segments_data, title, mappings, active_locations, show_values=True, show_total=True,
+                          show_legend=True, legend_loc="upper right", custom_labels=None, fig=None):
+    """Poziomy wykres słupkowy stanu populacji (wersja z aplikacji)."""
+    custom_labels = custom_labels or {}
+    RENDERS.inc(chart="nuns")
+    fig = reuse_figure(fig, FIG_SIZE)
+    ax = fig.add_subplot()
+    y_labels = []
+
+    for i, (lbl, segs) in enumerate(segments_data):
+        y_labels.append(lbl)
+        left = 0
+        for val, col, key in segs:
+            if val > 0:
+                hatch = '////' if key == "Uncertain" else None
+                ax.barh(i, val, left=left, color=col, edgecolor='black', height=0.6, hatch=hatch)
+
+                # Kolor tekstu
+                txt_col = 'white' if col in DARK_SEGMENT_COLORS else 'black'
+
+                if show_values and val >= 0.8:
+                    center_x = left + val / 2
+                    ax.text(center_x, i, str(int(val)), ha='center', va='center', fontsize=10, fontweight='bold', color=txt_col)
+
+                left += val
+
+        if show_total:
+            total = sum([v for v, _, _ in segs])
+            ax.text(left + 0.5, i, f"Total: {total}", ha='left', va='center', fontsize=11, fontweight='bold')
+
+    ax.set_yticks(range(len(y_labels)))
+    ax.set_yticklabels(y_labels, fontsize=10)
+    ax.invert_yaxis()
+    ax.set_xlabel("Liczba zakonnic", fontsize=12)
+    ax.set_title(title, fontsize=16, pad=20)
+
+    # Legenda
+    if show_legend:
+        def get_label(key):
+            user_lbl = custom_labels.get(key, "")
+            if user_lbl.strip(): return user_lbl
+            if key == 'Uncertain': return 'Uncertain (x)'
+            if key == 'Deceased': return 'Deceased (z)'
+            return f'Alive ({key})'
+
+        patches_list = []
+        active_locs = [loc for loc in PRIORITY_ORDER if mappings.get(loc) and active_locations.get(loc)]
+        for loc in active_locs:
+            patches_list.append(mpatches.Patch(facecolor=COLORS_NUNS[loc], edgecolor='black', label=get_label(loc)))
+
+        patches_list.append(mpatches.Patch(facecolor='lightgray', hatch='////', edgecolor='black', label=get_label('Uncertain')))
+        patches_list.append(mpatches.Patch(facecolor=COLORS_NUNS['Deceased'], edgecolor='black', label=get_label('Deceased')))
+
+        ax.legend(handles=patches_list, loc=legend_loc, title="Legenda")
+
+    ax.spines['right'].set_visible(False)
+    ax.spines['top'].set_visible(False)
+    ax.grid(axis='x', linestyle='--', alpha=0.5)
+    fig.tight_layout()
+    return fig
+
+
 # ==========================================
 # 2. PRZETWARZANIE DANYCH Z PLIKU CSV
 # ==========================================
@@ -50,92 +360,43 @@ LABELS = [
 ]
 
 
+# Skróty z pierwotnej wersji skryptu (węższe niż DEFAULT_MAPPINGS w aplikacji)
+SCRIPT_MAPPINGS = {
+    'Gravelines': ['yesg', 'g', 'yellow'],   # Explicit Yellow
+    'London': ['yesn'],                      # Explicit Blue
+    'Gosfield': ['yesz'],                    # Explicit Green
+    'Scorton': ['yesc', 's'],                # Explicit Red
+}
+
+
 def load_and_process_data(filename, sheet_name=0):
     try:
         df = pd.read_excel(filename, sheet_name=sheet_name)
-        
-        # Znajdź indeks kolumny startowej (IMPRISONMENT)
-        start_col_index = 0
-        for idx, col in enumerate(df.columns):
-            if "IMPRISONMENT" in str(col).upper():
-                start_col_index = idx
-                break
-        
-        print(f"Dane zaczynają się od kolumny indeks: {start_col_index} ('{df.columns[start_col_index]}')")
 
-        segments_data = []
+        # Kolumny etapów od IMPRISONMENT, po jednej na etykietę z LABELS
+        columns = stage_columns(df)[:len(LABELS)]
+        print(f"Dane zaczynają się od kolumny: '{columns[0] if columns else df.columns[0]}'")
+        if len(columns) < len(LABELS):
+            print(f"Brak kolumny dla etykiety: {LABELS[len(columns)]}")
+        labels = LABELS[:len(columns)]
+
+        # Zliczanie przez kostkę populacji; domyślna kategoria YES wynika z etykiety etapu
+        cube = PopulationCube.from_frames({"": {"": df}}, columns=columns)
+        rows = category_counts(cube.counts[0, 0], cube.codes, labels, SCRIPT_MAPPINGS)
 
-        for i, label in enumerate(LABELS):
-            # Obliczamy właściwy indeks kolumny
-            current_col_idx = start_col_index + i
-            
-            if current_col_idx >= len(df.columns):
-                print(f"Brak kolumny dla etykiety: {label}")
-                break
-
-            col_name = df.columns[current_col_idx]
-            # print(f"Przetwarzanie: {label} -> Kolumna: {col_name}")
-
-            # Pobieramy dane, czyścimy spacje i zamieniamy na małe litery
-            series = df[col_name].astype(str).str.strip().str.lower()
-
-            # ZLICZANIE WARTOŚCI WSPÓLNYCH
-            uncertain = series[series.isin(['x'])].count()
-            deceased = series[series.isin(['z'])].count()
-            
-            # 1. Determine default category for this column
-            default_category = 'Gravelines' # Default
-            if "LONDON" in label.upper():
-                default_category = 'London'
-            elif "GOSFIELD" in label.upper():
-                default_category = 'Gosfield'
-            # elif "TRANSFER" in label.upper():
-            #     default_category = 'Scorton'  <-- ZMIANA: Domyślnie Gravelines (Żółty), żeby YES było żółte, a YESc czerwone
-            
-            # 2. Count specific values (Explicit overrides)
-            # Normalize: lower case
-            
-            # Counts
-            count_gravelines = series[series.isin(['yesg', 'g', 'yellow'])].count() # Explicit Yellow
-            count_london = series[series.isin(['yesn'])].count()     # Explicit Blue
-            count_gosfield = series[series.isin(['yesz'])].count()   # Explicit Green
-            count_scorton = series[series.isin(['yesc', 's'])].count()    # Explicit Red
-            
-            # Generic YES/Y
-            count_generic = series[series.isin(['yes', 'y'])].count()
-            
-            # Add generic to default
-            if default_category == 'Gravelines':
-                count_gravelines += count_generic
-            elif default_category == 'London':
-                count_london += count_generic
-            elif default_category == 'Gosfield':
-                count_gosfield += count_generic
-            elif default_category == 'Scorton':
-                count_scorton += count_generic
-            
-            # Build segments
+        segments_data = []
+        for label, row in zip(labels, rows):
             # Order: Gravelines, London, Gosfield, Scorton, Uncertain, Deceased
-            bar_segments = []
-            
-            if count_gravelines > 0:
-                bar_segments.append((count_gravelines, COLORS['Gravelines'], "Alive Gravelines"))
-            if count_london > 0:
-                bar_segments.append((count_london, COLORS['London'], "Alive London"))
-            if count_gosfield > 0:
-                bar_segments.append((count_gosfield, COLORS['Gosfield'], "Alive Gosfield"))
-            if count_scorton > 0:
-                bar_segments.append((count_scorton, COLORS['Scorton'], "Alive Scorton"))
-
-            # Dodajemy wspólne segmenty (Uncertain, Deceased)
+            bar_segments = [
+                (int(row[CATEGORY_INDEX[loc]]), COLORS[loc], f"Alive {loc}")
+                for loc in SCRIPT_MAPPINGS if row[CATEGORY_INDEX[loc]] > 0
+            ]
+            uncertain, deceased = row[CATEGORY_INDEX['Uncertain']], row[CATEGORY_INDEX['Deceased']]
             if uncertain > 0:
                 # Kolor kreskowania zależy od głównego koloru etapu
-                base_color = COLORS[default_category]
-                bar_segments.append((uncertain, make_lighter(base_color), "Uncertain"))
-            
+                bar_segments.append((int(uncertain), make_lighter(COLORS[stage_default_category(label)]), "Uncertain"))
             if deceased > 0:
-                bar_segments.append((deceased, COLORS['Deceased'], "Deceased"))
-
+                bar_segments.append((int(deceased), COLORS['Deceased'], "Deceased"))
             segments_data.append((label, bar_segments))
 
         return segments_data
@@ -145,23 +406,18 @@ def load_and_process_data(filename, sheet_name=0):
         return []
 
 
-# Wczytanie danych (Podmień nazwę pliku jeśli uruchamiasz lokalnie i jest inna)
-# Tutaj używam nazwy pliku, który przesłałeś
-file_path = 'ZESTAWIENIE ZAKONNIC_NIEW WYKRES.xlsx'
-# Podaj nazwę arkusza (sheet_name) - może być indeks (0, 1, 2...) lub nazwa np. "GRAVELINES"
-timeline_data = load_and_process_data(file_path, sheet_name="GRAVELINES")
-
-
 # ==========================================
 # 3. RYSOWANIE WYKRESU
 # ==========================================
 
-def create_chart(data):
+def create_chart(data, fig=None):
     if not data:
         print("Brak danych do wyświetlenia.")
         return
 
-    fig, ax = plt.subplots(figsize=FIG_SIZE)
+    # Figura z menedżera (figury.py); przekazana figura jest czyszczona i używana ponownie
+    fig = reuse_figure(fig, FIG_SIZE)
+    ax = fig.add_subplot()
     y_labels = []
 
     for i, (label, segments) in enumerate(data):
@@ -209,9 +465,18 @@ def create_chart(data):
     ax.spines['top'].set_visible(False)
     ax.grid(axis='x', linestyle='--', alpha=0.5)
 
-    plt.tight_layout()
-    plt.show()
+    fig.tight_layout()
+    return fig
+
 
+if __name__ == "__main__":
+    # Wczytanie danych (Podmień nazwę pliku jeśli uruchamiasz lokalnie i jest inna)
+    # Tutaj używam nazwy pliku, który przesłałeś
+    file_path = 'ZESTAWIENIE ZAKONNIC_NIEW WYKRES.xlsx'
+    # Podaj nazwę arkusza (sheet_name) - może być indeks (0, 1, 2...) lub nazwa np. "GRAVELINES"
+    timeline_data = load_and_process_data(file_path, sheet_name="GRAVELINES")
 
-# Uruchomienie
-create_chart(timeline_data)
\ No newline at end of file
+    # Uruchomienie
+    fig = create_chart(timeline_data)
+    if fig is not None:
+        fig.savefig("wykres_GRAVELINES.png", dpi=300, bbox_inches='tight')
\ No newline at end of file
@@ -0,0 +1,322 @@
+import collections
+import contextlib
+import io
+import json
+import threading
+import time
+import zipfile
+
+from figury import figure_scope
+from metryki import EXPORT_SECONDS, ZIP_SECONDS, QUEUE_WAIT_SECONDS
+
+# ==========================================
+# ZADANIA EKSPORTU W TLE
+# ==========================================
+# Moduł nie korzysta ze Streamlit - wątek zadania nie dotyka st.*,
+# a interfejs tylko odpytuje stan zadania przy kolejnych przebiegach skryptu.
+
+STATUS_WAITING = "oczekuje"
+STATUS_QUEUED = "w kolejce"
+STATUS_RUNNING = "w toku"
+STATUS_CANCELLED = "anulowane"
+STATUS_FAILED = "przerwane"
+STATUS_DONE = "gotowe"
+
+EXPORT_MANIFEST = "manifest.json"
+
+
+def load_export_manifest(zf):
+    """Wykresy poprzedniego archiwum (otwarty ZipFile): {skrót: (nazwy_plików, notatka)}.
+
+    Archiwum bez manifestu daje {}; wpisy, których plików brakuje (usunięte ręcznie), są pomijane.
+    """
+    try:
+        manifest = json.loads(zf.read(EXPORT_MANIFEST))
+    except (KeyError, ValueError):
+        return {}
+    names = set(zf.namelist())
+    return {
+        entry["hash"]: (entry["files"], entry.get("note"))
+        for entry in manifest.get("charts", [])
+        if entry.get("files") and names.issuperset(entry["files"])
+    }
+
+
+class ExportJob:
+    """Eksport planu wykresów do ZIP wykonywany w wątku w tle.
+
+    render_chart(chart, fig) rysuje wykres (używając ponownie przekazanej figury),
+    export_pages(fig) zwraca (lista_png, dpi, zastosowana_opcja) jak save_png_within_budget.
+    Gotowe pliki zostają w zadaniu, więc po anulowaniu lub błędzie start() wznawia
+    pracę od pierwszego niewyrenderowanego wykresu.
+
+    Z chart_hash(chart) archiwum dostaje manifest skrótów treści; wykresy, których skrót
+    jest w manifeście previous_archive, są kopiowane z niego zamiast rysowane od nowa.
+    """
+
+    def __init__(self, plan, render_chart, export_pages, archive_name="psalmy_wykresy.zip", meta=None, scheduler=None,
+                 chart_hash=None, previous_archive=None):
+        self.plan = list(plan)
+        self.meta = dict(meta or {})              # dane dla interfejsu (np. liczba wykresów z legendą)
+        self.render_chart = render_chart
+        self.export_pages = export_pages
+        self.archive_name = archive_name
+        self.status = STATUS_WAITING
+        self.error = None
+        self.current_label = ""
+        self.files = collections.OrderedDict()   # nazwa pliku -> PNG
+        self.done_labels = set()
+        self.notes = []                          # informacje o przekroczonym budżecie pikseli
+        self._archive = None
+        self._cancel = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+        self.scheduler = scheduler
+        self._ticket = None
+        self.chart_hash = chart_hash
+        self._previous_archive = previous_archive
+        self.manifest = []                       # wpisy {label, hash, files, note} w kolejności planu
+        self.reused = 0                          # wykresy skopiowane z poprzedniego archiwum
+
+    @property
+    def queue_position(self):
+        if self.scheduler is None or self.status != STATUS_QUEUED:
+            return 0
+        return self._queue_position
+
+    @property
+    def total(self):
+        return len(self.plan)
+
+    @property
+    def done(self):
+        return len(self.done_labels)
+
+    @property
+    def progress(self):
+        return self.done / self.total if self.total else 1.0
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    @property
+    def finished(self):
+        return self.status == STATUS_DONE
+
+    def start(self):
+        with self._lock:
+            if self.running or self.finished:
+                return
+            self._cancel.clear()
+            self.status = STATUS_QUEUED if self.scheduler is not None else STATUS_RUNNING
+            self._queue_position = 0
+            self.error = None
+            self._thread = threading.Thread(target=self._run, name="export-job", daemon=True)
+            self._thread.start()
+
+    def cancel(self):
+        self._cancel.set()
+
+    def _run(self):
+        if self.scheduler is not None:
+            # Cały eksport zajmuje jeden slot wsadowy; w kolejce można go anulować
+            self._ticket = self.scheduler.acquire(
+                "zip", PRIORITY_BATCH,
+                on_wait=lambda position: setattr(self, "_queue_position", position),
+                should_abort=self._cancel.is_set
+            )
+            if self._ticket is None:
+                self.status = STATUS_CANCELLED
+                return
+            self.status = STATUS_RUNNING
+        try:
+            self._render_plan()
+        finally:
+            if self._ticket is not None:
+                self.scheduler.release(self._ticket)
+                self._ticket = None
+
+    def _render_plan(self):
+        # Jedna figura na cały eksport, zwalniana po zakończeniu, anulowaniu lub błędzie
+        with figure_scope(), EXPORT_SECONDS.time(chart="psalm", format="zip"):
+            self._render_charts()
+
+    def _render_charts(self):
+        fig = None
+        previous, previous_zip = {}, None
+        try:
+            if self._previous_archive is not None and self.chart_hash is not None:
+                try:
+                    previous_zip = zipfile.ZipFile(io.BytesIO(self._previous_archive))
+                    previous = load_export_manifest(previous_zip)
+                except zipfile.BadZipFile:
+                    self.notes.append("Poprzednie archiwum jest uszkodzone - wszystkie wykresy narysowano od nowa")
+            for chart in self.plan:
+                if self._cancel.is_set():
+                    self.status = STATUS_CANCELLED
+                    return
+                if chart["label"] in self.done_labels:
+                    continue
+                self.current_label = chart["label"]
+                digest = self.chart_hash(chart) if self.chart_hash is not None else None
+                if digest in previous:
+                    # Te same bajty co w poprzednim eksporcie (PNG są deterministyczne)
+                    previous_names, note = previous[digest]
+                    pages = [previous_zip.read(name) for name in previous_names]
+                    self.reused += 1
+                else:
+                    fig = self.render_chart(chart, fig=fig)
+                    pages, used_dpi, applied = self.export_pages(fig)
+                    note = None
+                    if applied == "dpi":
+                        note = f"obniżono do {used_dpi} DPI"
+                    elif applied == "pages":
+                        note = f"podzielono na {len(pages)} stron(y)"
+                file_stem = f"{chart['psalm']}_{chart['ids']}"
+                if len(pages) == 1:
+                    names = [f"{file_stem}.png"]
+                else:
+                    names = [f"{file_stem}_str{page_no}.png" for page_no in range(1, len(pages) + 1)]
+                self.files.update(zip(names, pages))
+                if note:
+                    self.notes.append(f"{chart['label']}: {note}")
+                if digest is not None:
+                    self.manifest.append({"label": chart["label"], "hash": digest, "files": names, "note": note})
+                self.done_labels.add(chart["label"])
+            self.current_label = ""
+            self.status = STATUS_DONE
+        except Exception as e:
+            self.error = e
+            self.status = STATUS_FAILED
+        finally:
+            if previous_zip is not None:
+                previous_zip.close()
+
+    def archive(self):
+        # Archiwum składane raz, po zakończeniu; później zwracane z pamięci
+        if not self.finished:
+            return None
+        if self._archive is None:
+            buf = io.BytesIO()
+            with ZIP_SECONDS.time(), zipfile.ZipFile(buf, "w", zipfile.ZIP_DEFLATED) as zf:
+                for file_name, data in self.files.items():
+                    zf.writestr(file_name, data)
+                if self.chart_hash is not None:
+                    zf.writestr(EXPORT_MANIFEST, json.dumps({"charts": self.manifest}, ensure_ascii=False, indent=1))
+            self._archive = buf.getvalue()
+        return self._archive
+
+
+# ==========================================
+# KONTROLA DOPUSZCZANIA CIĘŻKICH RENDERÓW
+# ==========================================
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BATCH = 1
+PRIORITY_SPECULATIVE = 2   # renderowanie "na zapas" - ustępuje wszystkiemu innemu
+
+
+class RenderTicket:
+    def __init__(self, kind, priority, seq):
+        self.kind = kind
+        self.priority = priority
+        self.seq = seq
+        self.granted = False
+
+    @property
+    def order(self):
+        return (self.priority, self.seq)
+
+
+class RenderScheduler:
+    """Wspólny dla procesu limit równoczesnych ciężkich renderów.
+
+    Nadmiarowe zgłoszenia czekają w kolejce uporządkowanej wg (priorytet, kolejność).
+    Podglądy interaktywne mają pierwszeństwo, a eksporty wsadowe i prefetch nie mogą
+    zająć ostatnich reserved_interactive slotów, więc interfejs zostaje responsywny.
+    """
+
+    def __init__(self, max_concurrent=2, reserved_interactive=1):
+        self.max_concurrent = max(1, max_concurrent)
+        self.max_batch = max(1, self.max_concurrent - reserved_interactive)
+        self._waiting = []
+        self._running = []
+        self._seq = 0
+        self._cond = threading.Condition()
+
+    def _eligible(self, ticket):
+        if len(self._running) >= self.max_concurrent:
+            return False
+        if ticket.priority >= PRIORITY_BATCH:
+            return sum(1 for t in self._running if t.priority >= PRIORITY_BATCH) < self.max_batch
+        return True
+
+    def _can_start(self, ticket):
+        return self._waiting and min(self._waiting, key=lambda t: t.order) is ticket and self._eligible(ticket)
+
+    def position(self, ticket):
+        # 0 - render trwa, n - miejsce w kolejce
+        with self._cond:
+            if ticket.granted:
+                return 0
+            ahead = sum(1 for t in self._waiting if t.order < ticket.order)
+            return ahead + 1
+
+    def stats(self):
+        with self._cond:
+            return {"running": len(self._running), "waiting": len(self._waiting)}
+
+    def acquire(self, kind, priority, on_wait=None, should_abort=None, poll=0.5):
+        """Czeka na slot i zwraca bilet (albo None, gdy should_abort() przerwało czekanie).
+
+        on_wait(pozycja) jest wołane co poll sekund, dopóki zgłoszenie stoi w kolejce.
+        """
+        t0 = time.perf_counter()
+        with self._cond:
+            self._seq += 1
+            ticket = RenderTicket(kind, priority, self._seq)
+            self._waiting.append(ticket)
+            try:
+                while not self._can_start(ticket):
+                    if should_abort is not None and should_abort():
+                        self._waiting.remove(ticket)
+                        self._cond.notify_all()
+                        return None
+                    if on_wait is not None:
+                        ahead = sum(1 for t in self._waiting if t.order < ticket.order)
+                        self._cond.release()
+                        try:
+                            on_wait(ahead + 1)
+                        finally:
+                            self._cond.acquire()
+                        if self._can_start(ticket):
+                            break
+                    self._cond.wait(poll)
+            except BaseException:
+                # Np. przerwanie przebiegu skryptu Streamlit w trakcie czekania - zwalniamy miejsce w kolejce
+                if ticket in self._waiting:
+                    self._waiting.remove(ticket)
+                self._cond.notify_all()
+                raise
+            self._waiting.remove(ticket)
+            self._running.append(ticket)
+            ticket.granted = True
+            QUEUE_WAIT_SECONDS.observe(time.perf_counter() - t0, kind=kind)
+            # Kolejny w kolejce może móc ruszyć równolegle (np. podgląd obok eksportu)
+            self._cond.notify_all()
+            return ticket
+
+    def release(self, ticket):
+        with self._cond:
+            if ticket in self._running:
+                self._running.remove(ticket)
+            ticket.granted = False
+            self._cond.notify_all()
+
+    @contextlib.contextmanager
+    def slot(self, kind, priority, on_wait=None):
+        ticket = self.acquire(kind, priority, on_wait=on_wait)
+        try:
+            yield ticket
+        finally:
+            self.release(ticket)
@@ -0,0 +1,120 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+# ==========================================
+# POMIAR ZIMNEGO STARTU APLIKACJI
+# ==========================================
+# Uruchomienie: python zimny_start.py [--runs 3] [--think 3] [--cold-font-cache] [--json wynik.json]
+#
+# Każdy pomiar to świeży proces Pythona (jak pierwszy użytkownik po wdrożeniu): import Streamlit,
+# pierwszy przebieg app.py aż do ekranu logowania, logowanie po "namyśle" użytkownika (--think s)
+# i pierwszy wykres psalmu po wgraniu .docx. Porównywane są tryby PRELOAD_MODULES=0 i 1;
+# z --cold-font-cache proces dostaje pusty MPLCONFIGDIR (obraz bez zbudowanej listy czcionek).
+# Moduł importuje na górze tylko bibliotekę standardową, żeby nie zawyżać pomiaru dziecka.
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "app.py")
+STAGES = ("import_streamlit", "ekran_logowania", "logowanie", "pierwszy_wykres")
+
+
+def measure_child(docx_path, think, timeout):
+    """Jeden pomiar w bieżącym (świeżym) procesie. Zwraca słownik czasów etapów w sekundach."""
+    t0 = time.perf_counter()
+    import streamlit.logger
+    from streamlit.testing.v1 import AppTest
+    streamlit.logger.set_log_level("error")
+    timings = {"import_streamlit": time.perf_counter() - t0}
+
+    t0 = time.perf_counter()
+    at = AppTest.from_file(APP_PATH, default_timeout=timeout)
+    at.run()
+    timings["ekran_logowania"] = time.perf_counter() - t0
+
+    time.sleep(think)
+    t0 = time.perf_counter()
+    at.text_input[0].input(os.environ.get("APP_PASSWORD", "b12345"))
+    at.button[0].click()
+    at.run()
+    timings["logowanie"] = time.perf_counter() - t0
+
+    # Po zalogowaniu pandas i tak jest już załadowany - import wstrzykiwania plików nie psuje pomiaru
+    from obciazenie import UPLOADS_STATE_KEY, install_upload_injection
+    install_upload_injection()
+    with open(docx_path, "rb") as f:
+        at.session_state[UPLOADS_STATE_KEY] = {"upl_docx_psalms_new": ("psalmy.docx", f.read())}
+    t0 = time.perf_counter()
+    at.run()
+    while not any(node.type == "image" for node in _walk(at._tree)):
+        if at.exception or time.perf_counter() - t0 > timeout:
+            raise RuntimeError("brak wykresu: " + "; ".join(str(e.value) for e in at.exception))
+        time.sleep(0.2)
+        at.run()
+    timings["pierwszy_wykres"] = time.perf_counter() - t0
+    return timings
+
+
+def _walk(node):
+    yield node
+    for child in getattr(node, "children", {}).values():
+        yield from _walk(child)
+
+
+def run_child(docx_path, preload, think, timeout, cold_font_cache):
+    env = dict(os.environ, PRELOAD_MODULES="1" if preload else "0")
+    with tempfile.TemporaryDirectory() as mpl_dir:
+        if cold_font_cache:
+            env["MPLCONFIGDIR"] = mpl_dir
+        out = subprocess.run(
+            [sys.executable, __file__, "--child", docx_path, "--think", str(think), "--timeout", str(timeout)],
+            env=env, capture_output=True, text=True, timeout=timeout * 2
+        )
+    if out.returncode != 0:
+        raise RuntimeError(out.stderr.strip().splitlines()[-1] if out.stderr.strip() else "proces dziecka padł")
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+def print_report(results):
+    print(f"{'tryb':<12} " + " ".join(f"{s:>16}" for s in STAGES) + f" {'do wykresu':>11}")
+    for mode, runs in results.items():
+        medians = {s: statistics.median(r[s] for r in runs) for s in STAGES}
+        # Czas od startu procesu do pierwszego wykresu bez namysłu użytkownika
+        total = sum(medians.values())
+        print(f"{mode:<12} " + " ".join(f"{medians[s]:>15.2f}s" for s in STAGES) + f" {total:>10.2f}s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pomiar czasu do ekranu logowania i do pierwszego wykresu.")
+    parser.add_argument("--runs", type=int, default=3, help="pomiarów na tryb (mediana)")
+    parser.add_argument("--think", type=float, default=3.0, help="sekundy między ekranem logowania a kliknięciem")
+    parser.add_argument("--timeout", type=float, default=300)
+    parser.add_argument("--cold-font-cache", action="store_true", help="pusty MPLCONFIGDIR w każdym pomiarze")
+    parser.add_argument("--json", help="zapisz wyniki do pliku JSON")
+    parser.add_argument("--child", metavar="DOCX", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(measure_child(args.child, args.think, args.timeout)))
+        sys.exit(0)
+
+    from obciazenie import make_docx
+    with tempfile.NamedTemporaryFile(suffix=".docx", delete=False) as f:
+        f.write(make_docx(0))
+    try:
+        results = {}
+        for preload in (False, True):
+            mode = "preload" if preload else "bez preload"
+            print(f"Tryb: {mode}...", flush=True)
+            results[mode] = [run_child(f.name, preload, args.think, args.timeout, args.cold_font_cache)
+                             for _ in range(args.runs)]
+    finally:
+        os.unlink(f.name)
+    print()
+    print_report(results)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as out:
+            json.dump(results, out, ensure_ascii=False, indent=2)